@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from triphecta import distance_matrix
+
+
+def test_distance_matrix():
+    matrix = distance_matrix.DistanceMatrix(4, dtype=np.uint32)
+    assert len(matrix) == 4
+    assert len(matrix.data) == 6
+    full = np.array(
+        [[0, 1, 2, 3], [1, 0, 4, 5], [2, 4, 0, 6], [3, 5, 6, 0]], dtype=np.uint32
+    )
+    for i in range(4):
+        for j in range(i + 1, 4):
+            matrix[j, i] = full[i][j]
+    np.testing.assert_array_equal(matrix.data, [1, 2, 3, 4, 5, 6])
+
+    for i in range(4):
+        for j in range(4):
+            assert matrix[i, j] == full[i][j]
+        np.testing.assert_array_equal(matrix.row(i), full[i])
+
+    with pytest.raises(IndexError):
+        matrix[1, 1] = 42
+    with pytest.raises(IndexError):
+        matrix[1, 4]
+
+    expect = distance_matrix.DistanceMatrix.from_dict(
+        4, {(0, 1): 1, (0, 2): 2, (0, 3): 3, (1, 2): 4, (1, 3): 5, (2, 3): 6}
+    )
+    assert matrix == expect
+    expect[2, 3] = 7
+    assert matrix != expect
+
+    matrix = distance_matrix.DistanceMatrix(4, dtype=np.uint32)
+    for i in range(4):
+        matrix.set_lower_row(i, full[i][:i])
+    np.testing.assert_array_equal(matrix.data, [1, 2, 3, 4, 5, 6])
+    with pytest.raises(RuntimeError):
+        matrix.set_lower_row(2, [1, 2, 3])
+
+    with pytest.raises(RuntimeError):
+        distance_matrix.DistanceMatrix(4, data=np.zeros(5))
@@ -1,20 +1,244 @@
 import filecmp
+import itertools
+import multiprocessing
+import numpy as np
 import os
 import pytest
 
-from triphecta import distances, utils, variant_counts
+from triphecta import distance_matrix, distances, site_index, utils, variant_counts
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "distances")
 
 
+def test_all_vs_all_distances(monkeypatch):
+    rng = np.random.default_rng(42)
+    genos = rng.integers(0, 4, size=(11, 50), dtype=np.uint16)
+    expect = distance_matrix.DistanceMatrix(genos.shape[0], dtype=np.uint32)
+    for i in range(genos.shape[0]):
+        for j in range(i + 1, genos.shape[0]):
+            expect[i, j] = np.sum(
+                (genos[i] != 0) & (genos[j] != 0) & (genos[i] != genos[j])
+            )
+
+    for tile_size in (1, 3, 11, 20):
+        got = distances._all_vs_all_distances(genos, threads=2, tile_size=tile_size)
+        assert got == expect
+
+    monkeypatch.setattr(distances, "SITES_CHUNK_SIZE", 7)
+    assert distances._all_vs_all_distances(genos, tile_size=4) == expect
+
+    # Reusing existing distances of the first samples. Make the existing
+    # distances wrong, to check they are copied and not recalculated
+    existing = distances._all_vs_all_distances(genos[:5])
+    existing.data += 100
+    for tile_size in (1, 2, 4, 20):
+        got = distances._all_vs_all_distances(
+            genos, threads=2, tile_size=tile_size, existing=existing
+        )
+        for i in range(11):
+            for j in range(11):
+                if i < 5 and j < 5:
+                    assert got[i, j] == existing[i, j]
+                else:
+                    assert got[i, j] == expect[i, j]
+
+    # Make sites 0-39 biallelic, so some of the sites are packed into bits
+    genos[:, :40] %= 3
+    expect = distances._all_vs_all_distances(genos)
+    packed = distances._stack_genotypes(list(genos), packed=True)
+    multiallelic_count = np.count_nonzero(np.any(genos > 2, axis=0))
+    assert 0 < multiallelic_count <= 10
+    assert packed.multiallelic.shape == (11, multiallelic_count)
+    expect_bytes = (50 - multiallelic_count + 7) // 8
+    assert packed.ref.shape == packed.alt.shape == (11, expect_bytes)
+    for tile_size in (1, 3, 11):
+        got = distances._all_vs_all_distances(packed, threads=2, tile_size=tile_size)
+        assert got == expect
+    monkeypatch.setattr(distances, "SITES_CHUNK_SIZE", 16)
+    assert distances._all_vs_all_distances(packed, tile_size=4) == expect
+    distances._unlink_genotypes(packed)
+
+    # Workers attach to the shared genotypes by name, so other start
+    # methods work, as well as fork
+    monkeypatch.setattr(
+        distances.multiprocessing, "Pool", multiprocessing.get_context("spawn").Pool
+    )
+    shared = distances._stack_genotypes(list(genos))
+    np.testing.assert_array_equal(shared.array, genos)
+    assert distances._all_vs_all_distances(shared, threads=2, tile_size=4) == expect
+    distances._unlink_genotypes(shared)
+
+
+def test_pack_genotypes():
+    genos = np.array([[0, 1, 2, 3, 1, 2, 0, 1, 2], [2, 2, 1, 1, 0, 0, 1, 1, 2]])
+    multiallelic = np.array([False, False, False, True] + [False] * 5)
+    got = distances.pack_genotypes(genos, multiallelic)
+    np.testing.assert_array_equal(got.ref, [[0b01010010], [0b00100110]])
+    np.testing.assert_array_equal(got.alt, [[0b00101001], [0b11000001]])
+    np.testing.assert_array_equal(got.multiallelic, [[3], [1]])
+    with pytest.raises(RuntimeError):
+        distances.pack_genotypes(genos, np.zeros(9, dtype=bool))
+
+
+def test_nearest_neighbours(monkeypatch):
+    rng = np.random.default_rng(42)
+    genos = rng.integers(0, 3, size=(40, 100), dtype=np.uint16)
+    genos[:, :5] = rng.integers(0, 5, size=(40, 5), dtype=np.uint16)
+    # Make some ties
+    genos[20] = genos[21] = genos[22]
+    all_dists = distances._all_vs_all_distances(genos)
+    monkeypatch.setattr(distances, "SITES_CHUNK_SIZE", 16)
+    monkeypatch.setattr(distances, "NEIGHBOURS_BATCH_SIZE", 5)
+
+    for packed in False, True:
+        if packed:
+            shared = distances._stack_genotypes(list(genos), packed=True)
+        else:
+            shared = distances._share_genotypes(genos)
+        for k in 1, 3, 10, 50:
+            queries = [0, 5, 21, 30]
+            got = distances._run_nearest_neighbours(shared, queries, 10, 40, k)
+            for query, (indexes, dists) in zip(queries, got):
+                candidates = [i for i in range(10, 40) if i != query]
+                expect = sorted((all_dists[query, i], i) for i in candidates)
+                if k < len(expect):
+                    expect = [x for x in expect if x[0] <= expect[k - 1][0]]
+                assert list(zip(dists, indexes)) == expect
+        distances._unlink_genotypes(shared)
+
+    with pytest.raises(RuntimeError):
+        distances._run_nearest_neighbours(shared, [0], 10, 40, 0)
+
+
+def test_query_neighbours_between_vcf_files():
+    all_vcfs_tsv = os.path.join(data_dir, "distances_between_vcf_files.vcfs.tsv")
+    mask_bed_file = os.path.join(data_dir, "distances_between_vcf_files.mask.bed")
+    query_tsv = "tmp.query_neighbours_between_vcf_files.query.tsv"
+    reference_tsv = "tmp.query_neighbours_between_vcf_files.ref.tsv"
+    outprefix = "tmp.query_neighbours_between_vcf_files.out"
+    utils.rm_rf(f"{outprefix}.*")
+    with open(all_vcfs_tsv) as f:
+        lines = [x.rstrip() for x in f]
+    with open(query_tsv, "w") as f:
+        print("sample\tvcf_file", lines[1], lines[3], sep="\n", file=f)
+    with open(reference_tsv, "w") as f:
+        print(lines[0], *lines[1:], sep="\n", file=f)
+
+    got_names, got_neighbours, got_var_counts = (
+        distances.query_neighbours_between_vcf_files(
+            query_tsv,
+            reference_tsv,
+            outprefix,
+            1,
+            threads=2,
+            het_to_hom_key="ignore",
+            mask_bed_file=mask_bed_file,
+        )
+    )
+    assert got_names == ["s1", "s3"]
+    expect_neighbours = [[("s1", 0)], [("s2", 0), ("s3", 0)]]
+    assert got_neighbours == expect_neighbours
+    assert got_var_counts == [
+        variant_counts.VariantCounts(hom=3, het=1, null=1, het_to_hom=0),
+        variant_counts.VariantCounts(hom=3, het=1, null=1, het_to_hom=0),
+    ]
+    loaded = distances.load_neighbours_file(f"{outprefix}.query_neighbours.tsv.gz")
+    assert loaded == dict(zip(got_names, expect_neighbours))
+    utils.rm_rf(f"{outprefix}.*", query_tsv, reference_tsv)
+
+
+def test_load_genotypes_and_distances():
+    file_numbers = [1, 2, 3, 1, 3, 2, 2]
+    vcf_files = [
+        os.path.join(data_dir, f"distances_between_vcf_files.{i}.vcf")
+        for i in file_numbers
+    ]
+    mask_bed_file = os.path.join(data_dir, "distances_between_vcf_files.mask.bed")
+    file_dists = {(1, 2): 1, (1, 3): 2, (2, 3): 0}
+    expect_dists = distance_matrix.DistanceMatrix(len(vcf_files), dtype=np.uint32)
+    for i, j in itertools.combinations(range(len(vcf_files)), 2):
+        key = tuple(sorted([file_numbers[i], file_numbers[j]]))
+        expect_dists[i, j] = file_dists.get(key, 0)
+    expect_counts = [
+        variant_counts.VariantCounts(hom=3, het=1, null=1, het_to_hom=0),
+        variant_counts.VariantCounts(hom=3, het=0, null=2, het_to_hom=0),
+        variant_counts.VariantCounts(hom=3, het=1, null=1, het_to_hom=0),
+    ]
+    expect_counts = [expect_counts[i - 1] for i in file_numbers]
+
+    for threads, tile_size, packed in itertools.product((1, 2), (1, 3, 10), (0, 1)):
+        got_dists, got_counts = distances._load_genotypes_and_distances(
+            vcf_files,
+            threads=threads,
+            tile_size=tile_size,
+            packed_genotypes=packed,
+            het_to_hom_key="ignore",
+            mask_bed_file=mask_bed_file,
+        )
+        assert got_dists == expect_dists
+        assert got_counts == expect_counts
+
+    tmp_vcf = "tmp.load_genotypes_and_distances.vcf"
+    with open(vcf_files[0]) as f_in, open(tmp_vcf, "w") as f_out:
+        print(*f_in.readlines()[:-1], sep="", end="", file=f_out)
+    with pytest.raises(RuntimeError):
+        distances._load_genotypes_and_distances(vcf_files + [tmp_vcf], threads=2)
+    os.unlink(tmp_vcf)
+
+
+def test_load_shared_genotypes_packed():
+    vcf_files = [
+        os.path.join(data_dir, f"distances_between_vcf_files.{i}.vcf")
+        for i in (1, 2, 3, 2)
+    ]
+    mask_bed_file = os.path.join(data_dir, "distances_between_vcf_files.mask.bed")
+    tmp_site_index = "tmp.load_shared_genotypes_packed.site_index.npz"
+    sites = site_index.SiteIndex.from_vcf_file(
+        vcf_files[0], mask_bed_file=mask_bed_file
+    )
+    sites.save(tmp_site_index)
+
+    for mask_options in (
+        {"mask_bed_file": mask_bed_file},
+        {"site_index_file": tmp_site_index},
+    ):
+        wide, expect_counts = distances._load_shared_genotypes(
+            vcf_files, het_to_hom_key="ignore", **mask_options
+        )
+        wide_array = wide.array.copy()
+        distances._unlink_genotypes(wide)
+        # The masked site is removed, and the multiallelic sites are the
+        # ones with more than one ALT
+        multiallelic_sites = np.array([False, False, True, True, True])
+        assert wide_array.shape == (4, 5)
+
+        for threads in 1, 2:
+            packed, got_counts = distances._load_shared_genotypes(
+                vcf_files,
+                threads=threads,
+                packed_genotypes=True,
+                het_to_hom_key="ignore",
+                **mask_options,
+            )
+            got = distances._shared_genotypes_to_arrays(packed)
+            expect = distances.pack_genotypes(wide_array, multiallelic_sites)
+            for got_array, expect_array in zip(got, expect):
+                np.testing.assert_array_equal(got_array, expect_array)
+            assert got_counts == expect_counts
+            distances._unlink_genotypes(packed)
+
+    os.unlink(tmp_site_index)
+
+
 def test_distances_between_vcf_files():
     vcf_names_tsv = os.path.join(data_dir, "distances_between_vcf_files.vcfs.tsv")
     mask_bed_file = os.path.join(data_dir, "distances_between_vcf_files.mask.bed")
     outprefix = "tmp.distances_between_vcf_files"
     got_matrix_file = f"{outprefix}.distance_matrix.txt.gz"
+    got_binary_matrix_file = f"{outprefix}.distance_matrix.bin"
     got_variant_counts_file = f"{outprefix}.variant_counts.tsv.gz"
-    utils.rm_rf(got_matrix_file, got_variant_counts_file)
+    utils.rm_rf(got_matrix_file, got_binary_matrix_file, got_variant_counts_file)
 
     (
         got_sample_names,
@@ -28,7 +252,9 @@ def test_distances_between_vcf_files():
         mask_bed_file=mask_bed_file,
     )
     expect_sample_names = ["s1", "s2", "s3"]
-    expect_dists = {(0, 1): 1, (0, 2): 2, (1, 2): 0}
+    expect_dists = distance_matrix.DistanceMatrix.from_dict(
+        3, {(0, 1): 1, (0, 2): 2, (1, 2): 0}
+    )
     expect_variant_counts = [
         variant_counts.VariantCounts(hom=3, het=1, null=1, het_to_hom=0),
         variant_counts.VariantCounts(hom=3, het=0, null=2, het_to_hom=0),
@@ -44,15 +270,115 @@ def test_distances_between_vcf_files():
     )
     assert got_sample_names == loaded_sample_names
     assert got_dists == loaded_dists
+    loaded_sample_names, loaded_dists = distances.load_distance_matrix_file(
+        got_binary_matrix_file
+    )
+    assert got_sample_names == loaded_sample_names
+    assert got_dists == loaded_dists
+    assert loaded_dists.data.dtype == np.float32
     loaded_variant_counts = variant_counts.load_variant_count_list_from_tsv(
         got_variant_counts_file
     )
     assert got_variant_counts == loaded_variant_counts
 
     os.unlink(got_matrix_file)
+    os.unlink(got_binary_matrix_file)
     os.unlink(got_variant_counts_file)
 
 
+def test_query_distances_between_vcf_files():
+    all_vcfs_tsv = os.path.join(data_dir, "distances_between_vcf_files.vcfs.tsv")
+    mask_bed_file = os.path.join(data_dir, "distances_between_vcf_files.mask.bed")
+    query_tsv = "tmp.query_distances_between_vcf_files.query.tsv"
+    reference_tsv = "tmp.query_distances_between_vcf_files.ref.tsv"
+    outprefix = "tmp.query_distances_between_vcf_files.out"
+    utils.rm_rf(f"{outprefix}.*")
+    with open(all_vcfs_tsv) as f:
+        lines = [x.rstrip() for x in f]
+    with open(query_tsv, "w") as f:
+        print("sample\tvcf_file", lines[3], lines[1], sep="\n", file=f)
+    with open(reference_tsv, "w") as f:
+        print("sample\tvcf_file", lines[1], lines[2], sep="\n", file=f)
+
+    for packed in False, True:
+        got = distances.query_distances_between_vcf_files(
+            query_tsv,
+            reference_tsv,
+            outprefix,
+            threads=2,
+            het_to_hom_key="ignore",
+            mask_bed_file=mask_bed_file,
+            packed_genotypes=packed,
+        )
+        got_query_names, got_ref_names, got_dists, got_var_counts = got
+        assert got_query_names == ["s1", "s3"]
+        assert got_ref_names == ["s1", "s2"]
+        np.testing.assert_array_equal(got_dists, [[0, 1], [2, 0]])
+        assert got_var_counts == [
+            variant_counts.VariantCounts(hom=3, het=1, null=1, het_to_hom=0),
+            variant_counts.VariantCounts(hom=3, het=1, null=1, het_to_hom=0),
+        ]
+        loaded = distances.load_query_distances_file(
+            f"{outprefix}.query_distances.tsv.gz"
+        )
+        assert loaded[:2] == (got_query_names, got_ref_names)
+        np.testing.assert_array_equal(loaded[2], got_dists)
+        loaded_var_counts = variant_counts.load_variant_count_list_from_tsv(
+            f"{outprefix}.query_variant_counts.tsv.gz"
+        )
+        assert loaded_var_counts == got_var_counts
+
+    utils.rm_rf(f"{outprefix}.*", query_tsv, reference_tsv)
+
+
+def test_add_samples_to_distances():
+    all_vcfs_tsv = os.path.join(data_dir, "distances_between_vcf_files.vcfs.tsv")
+    mask_bed_file = os.path.join(data_dir, "distances_between_vcf_files.mask.bed")
+    old_vcfs_tsv = "tmp.add_samples_to_distances.old_vcfs.tsv"
+    new_vcfs_tsv = "tmp.add_samples_to_distances.new_vcfs.tsv"
+    with open(all_vcfs_tsv) as f_in, open(old_vcfs_tsv, "w") as f_old, open(
+        new_vcfs_tsv, "w"
+    ) as f_new:
+        lines = f_in.readlines()
+        print(*lines[0:2], sep="", end="", file=f_old)
+        print(lines[0], *lines[2:], sep="", end="", file=f_new)
+    old_prefix = "tmp.add_samples_to_distances.old"
+    new_prefix = "tmp.add_samples_to_distances.new"
+    all_prefix = "tmp.add_samples_to_distances.all"
+    utils.rm_rf(f"{old_prefix}.*", f"{new_prefix}.*", f"{all_prefix}.*")
+    options = {"het_to_hom_key": "ignore", "mask_bed_file": mask_bed_file}
+    distances.distances_between_vcf_files(old_vcfs_tsv, old_prefix, **options)
+    expect = distances.distances_between_vcf_files(all_vcfs_tsv, all_prefix, **options)
+    got = distances.add_samples_to_distances(
+        old_prefix, all_vcfs_tsv, new_vcfs_tsv, new_prefix, threads=2, **options
+    )
+    assert got == expect
+    for suffix in "distance_matrix.txt.gz", "distance_matrix.bin":
+        assert distances.load_distance_matrix_file(
+            f"{new_prefix}.{suffix}"
+        ) == distances.load_distance_matrix_file(f"{all_prefix}.{suffix}")
+
+    # Adding samples that are already there is an error
+    with pytest.raises(RuntimeError):
+        distances.add_samples_to_distances(
+            new_prefix, all_vcfs_tsv, new_vcfs_tsv, new_prefix, **options
+        )
+
+    # Using different options from the original run is an error
+    with pytest.raises(RuntimeError):
+        distances.add_samples_to_distances(
+            old_prefix, all_vcfs_tsv, new_vcfs_tsv, new_prefix, het_to_hom_key="ignore"
+        )
+
+    utils.rm_rf(
+        old_vcfs_tsv,
+        new_vcfs_tsv,
+        f"{old_prefix}.*",
+        f"{new_prefix}.*",
+        f"{all_prefix}.*",
+    )
+
+
 def test_load_one_sample_distances_file():
     dist_file = os.path.join(data_dir, "load_one_sample_distances_file.tsv")
     expect = [("s1", 0.0), ("s2", 42.0), ("s3", 100.0)]
@@ -66,17 +392,19 @@ def test_update_distances_for_one_sample():
     data1 = [("s1", 0.0), ("s2", 42.0), ("s3", 100.0)]
     data2 = [("s1", 42.0), ("s3", 50.0)]
     data3 = [("s1", 200.0)]
-    all_dists = {}
+    all_dists = distance_matrix.DistanceMatrix(3, fill=np.nan)
     distances._update_distances_for_one_sample(
         0, data1, all_dists, sample_names_to_index
     )
-    expect_distances = {(0, 1): 42, (0, 2): 100}
+    expect_distances = distance_matrix.DistanceMatrix.from_dict(
+        3, {(0, 1): 42, (0, 2): 100}, fill=np.nan
+    )
     assert expect_distances == all_dists
 
     distances._update_distances_for_one_sample(
         1, data2, all_dists, sample_names_to_index
     )
-    expect_distances[(1, 2)] = 50
+    expect_distances[1, 2] = 50
     assert expect_distances == all_dists
 
     # This has distance s3 to s1 of 200, which doesn't agree with the
@@ -97,7 +425,8 @@ def test_load_sample_distances_file_of_filenames():
 def test_distances_from_all_one_sample_distances_files():
     tmp_tsv = "tmp.test_distances_from_all_one_sample_distances_files.in.tsv"
     tmp_out = "tmp.test_distances_from_all_one_sample_distances_files.out.tsv"
-    utils.rm_rf(tmp_out)
+    tmp_bin = "tmp.test_distances_from_all_one_sample_distances_files.out.bin"
+    utils.rm_rf(tmp_out, tmp_bin)
     with open(tmp_tsv, "w") as f:
         print("sample", "distance_file", sep="\t", file=f)
         for i in range(4):
@@ -110,42 +439,79 @@ def test_distances_from_all_one_sample_distances_files():
                 file=f,
             )
     got_names, got_dists = distances.distances_from_all_one_sample_distances_files(
-        tmp_tsv, tmp_out, threads=2
+        tmp_tsv, tmp_out, threads=2, binary_outfile=tmp_bin
     )
     expect_names = ["s1", "s2", "s3", "s4"]
-    expect_dists = {
-        (0, 1): 3.0,
-        (0, 2): 4.0,
-        (0, 3): 6.0,
-        (1, 2): 10.0,
-        (1, 3): 8.0,
-        (2, 3): 5.0,
-    }
+    expect_dists = distance_matrix.DistanceMatrix.from_dict(
+        4,
+        {
+            (0, 1): 3.0,
+            (0, 2): 4.0,
+            (0, 3): 6.0,
+            (1, 2): 10.0,
+            (1, 3): 8.0,
+            (2, 3): 5.0,
+        },
+    )
     assert got_names == expect_names
     assert got_dists == expect_dists
 
-    loaded_names, loaded_dists = distances.load_distance_matrix_file(tmp_out)
-    assert loaded_names == expect_names
-    assert loaded_dists == expect_dists
+    for filename in tmp_out, tmp_bin:
+        loaded_names, loaded_dists = distances.load_distance_matrix_file(filename)
+        assert loaded_names == expect_names
+        assert loaded_dists == expect_dists
     os.unlink(tmp_tsv)
     os.unlink(tmp_out)
+    os.unlink(tmp_bin)
+
+
+def test_distances_to_tsv_string():
+    for values in [], [0, 1, 42], [3.0, 0.1, 5.5], [1e6, 2], [np.nan, 1], [-0.0, 1]:
+        for dtype in np.uint32, np.float32, np.float64:
+            if dtype == np.uint32 and not all(float(x).is_integer() for x in values):
+                continue
+            array = np.array(values, dtype=dtype)
+            expect = "\t".join(str(x) for x in array)
+            assert distances._distances_to_tsv_string(array) == expect
 
 
 def test_write_distance_matrix_file():
     tmp_out = "tmp.distances.write_distance_matrix_file.txt"
     utils.rm_rf(tmp_out)
     sample_names = ["sample1", "sample2", "sample3"]
-    dists = {(0, 1): 3, (0, 2): 4, (1, 2): 42}
+    dists = distance_matrix.DistanceMatrix.from_dict(
+        3, {(0, 1): 3, (0, 2): 4, (1, 2): 42}, dtype=np.uint32
+    )
     distances.write_distance_matrix_file(sample_names, dists, tmp_out)
     expect = os.path.join(data_dir, "write_distance_matrix_file.txt")
     assert filecmp.cmp(tmp_out, expect, shallow=False)
     os.unlink(tmp_out)
 
+    sample_names.append("sample4")
+    dists = distance_matrix.DistanceMatrix.from_dict(
+        4,
+        {
+            (0, 1): 3.0,
+            (0, 2): 4.5,
+            (0, 3): 0.25,
+            (1, 2): 10.0,
+            (1, 3): 8.125,
+            (2, 3): 5.0,
+        },
+        dtype=np.float32,
+    )
+    distances.write_distance_matrix_file(sample_names, dists, tmp_out)
+    expect = os.path.join(data_dir, "write_distance_matrix_file.float.txt")
+    assert filecmp.cmp(tmp_out, expect, shallow=False)
+    os.unlink(tmp_out)
+
 
 def test_load_distance_matrix_file():
     infile = os.path.join(data_dir, "load_distance_matrix_file.txt")
     expect_names = ["sample1", "sample2", "sample3"]
-    expect_distances = {(0, 1): 3, (0, 2): 4, (1, 2): 42}
+    expect_distances = distance_matrix.DistanceMatrix.from_dict(
+        3, {(0, 1): 3, (0, 2): 4, (1, 2): 42}
+    )
     got_names, got_distances = distances.load_distance_matrix_file(infile)
     assert got_names == expect_names
     assert got_distances == expect_distances
@@ -155,3 +521,38 @@ def test_load_distance_matrix_file():
     )
     with pytest.raises(RuntimeError):
         distances.load_distance_matrix_file(bad_infile)
+
+    tmp_file = "tmp.distances.load_distance_matrix_file.txt"
+    with open(tmp_file, "w") as f:
+        print(3, "sample1\t0", "sample2\t3", "sample3\t4", sep="\n", file=f)
+    with pytest.raises(RuntimeError):
+        distances.load_distance_matrix_file(tmp_file)
+    os.unlink(tmp_file)
+
+
+def test_write_and_load_binary_distance_matrix_file():
+    tmp_out = "tmp.distances.write_binary_distance_matrix_file.bin"
+    utils.rm_rf(tmp_out)
+    for sample_names in ["s1"], ["s1", "s2", "s3", "s4"]:
+        n = len(sample_names)
+        dists = distance_matrix.DistanceMatrix(
+            n, data=np.arange(n * (n - 1) // 2, dtype=np.float32) + 0.5
+        )
+        distances.write_binary_distance_matrix_file(sample_names, dists, tmp_out)
+        assert distances.is_binary_distance_matrix_file(tmp_out)
+        got_names, got_dists = distances.load_binary_distance_matrix_file(tmp_out)
+        assert got_names == sample_names
+        assert got_dists == dists
+        assert got_dists.data.dtype == np.float32
+        distances.write_binary_distance_matrix_file(
+            sample_names, dists, tmp_out, dtype=np.float64
+        )
+        got_names, got_dists = distances.load_binary_distance_matrix_file(tmp_out)
+        assert got_dists == dists
+        assert got_dists.data.dtype == np.float64
+        os.unlink(tmp_out)
+
+    text_file = os.path.join(data_dir, "load_distance_matrix_file.txt")
+    assert not distances.is_binary_distance_matrix_file(text_file)
+    with pytest.raises(RuntimeError):
+        distances.load_binary_distance_matrix_file(text_file)
@@ -0,0 +1,50 @@
+import os
+import shutil
+
+import numpy as np
+
+from triphecta import genotype_cache, utils, variant_counts
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "vcf")
+
+
+def test_genotype_cache():
+    cache_dir = "tmp.genotype_cache"
+    vcf_file = "tmp.genotype_cache.vcf"
+    utils.rm_rf(cache_dir, vcf_file)
+    shutil.copy(os.path.join(data_dir, "load_vcf_file_for_distance_calc.vcf"), vcf_file)
+    cache = genotype_cache.GenotypeCache(cache_dir)
+    assert os.path.exists(cache_dir)
+    assert cache.get(vcf_file) is None
+
+    genos = np.array([0, 2, 2, 3, 4], dtype=np.uint16)
+    counts = variant_counts.VariantCounts(het=0, hom=3, null=1, het_to_hom=1)
+    cache.put(vcf_file, genos, counts)
+    got_genos, got_counts = cache.get(vcf_file)
+    np.testing.assert_array_equal(got_genos, genos)
+    assert got_genos.dtype == np.uint16
+    assert got_counts == counts
+
+    # Any change to the options used to load the VCF means a cache miss
+    assert genotype_cache.GenotypeCache(cache_dir).get(vcf_file) is not None
+    assert (
+        genotype_cache.GenotypeCache(cache_dir, only_use_pass=False).get(vcf_file)
+        is None
+    )
+    assert (
+        genotype_cache.GenotypeCache(
+            cache_dir, numeric_filters={"GT_CONF": (True, 10)}
+        ).get(vcf_file)
+        is None
+    )
+    assert (
+        genotype_cache.GenotypeCache(cache_dir, mask={"ref_42": {10}}).get(vcf_file)
+        is None
+    )
+
+    # Changing the VCF file also means a cache miss
+    with open(vcf_file, "a") as f:
+        print("", file=f)
+    assert cache.get(vcf_file) is None
+    utils.rm_rf(cache_dir, vcf_file)
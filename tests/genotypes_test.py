@@ -1,7 +1,7 @@
 import os
 import pytest
 
-from triphecta import genotypes, variant_counts
+from triphecta import distance_matrix, genotypes, knn_index, variant_counts
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "genotypes")
@@ -11,7 +11,9 @@ def test_distance():
     genos = genotypes.Genotypes(testing=True)
     genos.sample_names_list = ["s1", "s2", "s3"]
     genos._make_sample_name_to_index()
-    genos.distances = {(0, 1): 0, (0, 2): 3, (1, 2): 5}
+    genos.distances = distance_matrix.DistanceMatrix.from_dict(
+        3, {(0, 1): 0, (0, 2): 3, (1, 2): 5}
+    )
     assert genos.distance("s1", "s2") == 0
     assert genos.distance("s2", "s1") == 0
     assert genos.distance("s1", "s3") == 3
@@ -24,7 +26,9 @@ def test_distance_dict():
     genos = genotypes.Genotypes(testing=True)
     genos.sample_names_list = ["s1", "s2", "s3", "s4", "s5", "s6", "s7"]
     genos._make_sample_name_to_index()
-    genos.distances = {(0, 1): 0, (0, 2): 3, (0, 3): 3, (0, 4): 4, (0, 5): 4, (0, 6): 5}
+    genos.distances = distance_matrix.DistanceMatrix.from_dict(
+        7, {(0, 1): 0, (0, 2): 3, (0, 3): 3, (0, 4): 4, (0, 5): 4, (0, 6): 5}
+    )
     assert genos.distance_dict("s1") == {
         "s2": 0,
         "s3": 3,
@@ -82,3 +86,60 @@ def test_update_excluded_samples_using_variant_counts():
     genos.update_excluded_samples_using_variant_counts(minimum_percent_hom_calls=95)
     expect = {x: {"Too few hom calls"} for x in [1, 2, 3, 4]}
     assert genos.excluded_samples == expect
+
+
+def test_distance_and_distance_dict_using_knn_index():
+    matrix = distance_matrix.DistanceMatrix.from_dict(
+        5,
+        {
+            (0, 1): 0,
+            (0, 2): 3,
+            (0, 3): 3,
+            (0, 4): 4,
+            (1, 2): 1,
+            (1, 3): 2,
+            (1, 4): 6,
+            (2, 3): 5,
+            (2, 4): 6,
+            (3, 4): 7,
+        },
+    )
+    genos = genotypes.Genotypes(testing=True)
+    genos.sample_names_list = ["s1", "s2", "s3", "s4", "s5"]
+    genos._make_sample_name_to_index()
+    genos.distances = None
+    genos.knn = knn_index.KnnIndex.from_distance_matrix(
+        genos.sample_names_list, matrix, 2
+    )
+
+    assert genos.distance("s1", "s1") == 0
+    assert genos.distance("s1", "s2") == 0
+    assert genos.distance("s5", "s2") == 6
+    with pytest.raises(RuntimeError):
+        genos.distance("s4", "s5")
+
+    assert genos.distance_dict("s1", top_n=1) == {"s2": 0}
+    assert genos.distance_dict("s1", top_n=2) == {"s2": 0, "s3": 3, "s4": 3}
+    assert genos.distance_dict("s5", top_n=2) == {"s1": 4, "s2": 6, "s3": 6}
+    assert genos.distance_dict("s5", top_n=3) == {"s1": 4, "s2": 6, "s3": 6}
+    with pytest.raises(RuntimeError):
+        genos.distance_dict("s1", top_n=4)
+    with pytest.raises(RuntimeError):
+        genos.distance_dict("s1")
+
+    genos.excluded_samples = {"s2": "reason"}
+    assert genos.distance_dict("s1", top_n=1) == {"s3": 3, "s4": 3}
+    with pytest.raises(RuntimeError):
+        genos.distance_dict("s3", top_n=2)
+
+    # Everything is in the index if k is big enough
+    genos.knn = knn_index.KnnIndex.from_distance_matrix(
+        genos.sample_names_list, matrix, 4
+    )
+    genos.excluded_samples = {}
+    for sample in genos.sample_names_list:
+        assert genos.distance_dict(sample) == {
+            other: matrix[genos.sample_name_to_index[sample], i]
+            for i, other in enumerate(genos.sample_names_list)
+            if other != sample
+        }
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from triphecta import distance_matrix, knn_index, utils
+
+
+def test_from_distance_matrix():
+    matrix = distance_matrix.DistanceMatrix.from_dict(
+        4, {(0, 1): 3, (0, 2): 1, (0, 3): 3, (1, 2): 2, (1, 3): 5, (2, 3): 4}
+    )
+    index = knn_index.KnnIndex.from_distance_matrix(["a", "b", "c", "d"], matrix, 1)
+    assert len(index) == 4
+    assert index.k == 1
+    neighbours, dists = index.neighbours_of(0)
+    np.testing.assert_array_equal(neighbours, [2])
+    np.testing.assert_array_equal(dists, [1])
+    neighbours, dists = index.neighbours_of(3)
+    np.testing.assert_array_equal(neighbours, [0])
+    np.testing.assert_array_equal(dists, [3])
+    assert not index.is_complete(0)
+
+    # Ties with the k-th nearest neighbour are kept
+    index = knn_index.KnnIndex.from_distance_matrix(["a", "b", "c", "d"], matrix, 2)
+    neighbours, dists = index.neighbours_of(0)
+    np.testing.assert_array_equal(neighbours, [2, 1, 3])
+    np.testing.assert_array_equal(dists, [1, 3, 3])
+    assert index.is_complete(0)
+    neighbours, dists = index.neighbours_of(1)
+    np.testing.assert_array_equal(neighbours, [2, 0])
+    np.testing.assert_array_equal(dists, [2, 3])
+    assert not index.is_complete(1)
+
+    expect = knn_index.KnnIndex.from_neighbours(
+        ["a", "b", "c", "d"],
+        2,
+        [
+            ([2, 1, 3], [1, 3, 3]),
+            ([2, 0], [2, 3]),
+            ([0, 1], [1, 2]),
+            ([0, 2], [3, 4]),
+        ],
+    )
+    assert index == expect
+
+
+def test_save_and_load():
+    tmp_file = "tmp.knn_index.bin"
+    utils.rm_rf(tmp_file)
+    index = knn_index.KnnIndex.from_neighbours(
+        ["a", "b", "c"], 1, [([1], [0.5]), ([0], [0.5]), ([0, 1], [2, 2])]
+    )
+    index.save(tmp_file)
+    assert knn_index.is_knn_index_file(tmp_file)
+    got = knn_index.load(tmp_file)
+    assert got == index
+    assert got.distances.dtype == np.float32
+    os.unlink(tmp_file)
+
+    empty = knn_index.KnnIndex.from_neighbours([], 1, [])
+    empty.save(tmp_file)
+    assert knn_index.load(tmp_file) == empty
+    os.unlink(tmp_file)
+
+    with open(tmp_file, "w") as f:
+        print("a", "b", sep="\t", file=f)
+    assert not knn_index.is_knn_index_file(tmp_file)
+    with pytest.raises(RuntimeError):
+        knn_index.load(tmp_file)
+    os.unlink(tmp_file)
@@ -1,6 +1,10 @@
+import copy
+import itertools
+import os
+
 import pytest
 
-from triphecta import phenotype_compare
+from triphecta import phenotype_compare, phenotypes
 
 
 def test_init_in_particular_sanity_check_constraints():
@@ -245,3 +249,78 @@ def test_differences():
     assert pheno_compare.differences(p4, p1) == 2
     assert pheno_compare.differences(p1, p5) == 3
     assert pheno_compare.differences(p5, p1) == 3
+
+
+def test_compiled_compare_same_as_not_compiled():
+    tmp_tsv = "tmp.phenotype_compare.compiled.tsv"
+    float_values = ["0", "-1", "1.1", "1.5", "2", "2.5", "-90", "100", "NA"]
+    bool_values = ["T", "F", "NA"]
+    with open(tmp_tsv, "w") as f:
+        print("sample", "b1", "b2", "f1", "f2", "f3", sep="\t", file=f)
+        for i, values in enumerate(
+            itertools.product(bool_values, bool_values, float_values)
+        ):
+            b1, b2, f1 = values
+            f2 = float_values[i % len(float_values)]
+            f3 = float_values[(i * 7) % len(float_values)]
+            print(f"s{i}", b1, b2, f1, f2, f3, sep="\t", file=f)
+    phenos = phenotypes.Phenotypes(tmp_tsv)
+    os.unlink(tmp_tsv)
+    sample_names = sorted(phenos.sample_names)
+
+    constraints = {
+        "b1": {"must_be_same": False, "method": "equal", "params": {}},
+        "b2": {"must_be_same": True, "method": "equal", "params": {}},
+        "f1": {
+            "must_be_same": True,
+            "method": "range",
+            "params": {"low": 1, "high": 2},
+        },
+        "f2": {
+            "must_be_same": True,
+            "method": "abs_distance",
+            "params": {"max_dist": 1},
+        },
+        "f3": {
+            "must_be_same": True,
+            "method": "percent_distance",
+            "params": {"max_percent": 10},
+        },
+    }
+    for count_unknown_as_diff, b1_must_be_same in itertools.product(
+        [True, False], [True, False]
+    ):
+        constraints["b1"]["must_be_same"] = b1_must_be_same
+        pheno_compare = phenotype_compare.PhenotypeCompare(
+            copy.deepcopy(constraints), count_unknown_as_diff=count_unknown_as_diff
+        )
+        compiled = pheno_compare.compile(phenos, sample_names)
+        for i, sample in enumerate(sample_names):
+            got_satisfy, got_diffs = compiled.compare(i)
+            expect_satisfy = [
+                pheno_compare.satisfy_required_differences(phenos[sample], phenos[x])
+                for x in sample_names
+            ]
+            expect_diffs = [
+                pheno_compare.differences(phenos[sample], phenos[x])
+                for x in sample_names
+            ]
+            assert got_satisfy.tolist() == expect_satisfy
+            assert got_diffs.tolist() == expect_diffs
+
+        got_satisfy, got_diffs = compiled.compare(0, [3, 1])
+        assert got_satisfy.tolist() == [
+            pheno_compare.satisfy_required_differences(
+                phenos[sample_names[0]], phenos[sample_names[x]]
+            )
+            for x in [3, 1]
+        ]
+
+    compiled = pheno_compare.compile(phenos, ["s0", "not_a_sample"])
+    compiled.compare(0, [0])
+    with pytest.raises(RuntimeError):
+        compiled.compare(0, [1])
+    constraints["f4"] = constraints["f3"]
+    pheno_compare = phenotype_compare.PhenotypeCompare(constraints)
+    with pytest.raises(RuntimeError):
+        pheno_compare.compile(phenos, sample_names)
@@ -1,7 +1,9 @@
 import filecmp
+import itertools
 import os
 import subprocess
 
+import numpy as np
 import pytest
 
 from triphecta import phenotype_compare, phenotypes
@@ -30,16 +32,63 @@ def test_convert_one_variable_string():
 
 def test_load_phenotypes_tsv_file():
     infile = os.path.join(data_dir, "load_phenotype_file.tsv")
-    got_pheno, got_types = phenotypes.Phenotypes._load_phenotypes_tsv_file(infile)
-    expected_pheno = {
-        "s1": {"pheno1": 1, "pheno2": True},
-        "s2": {"pheno1": 2, "pheno2": False},
-    }
-    assert got_pheno == expected_pheno
+    (
+        got_names,
+        got_values,
+        got_valid,
+        got_types,
+    ) = phenotypes.Phenotypes._load_phenotypes_tsv_file(infile)
+    assert got_names == ["s1", "s2"]
+    assert list(got_values) == list(got_valid) == ["pheno1", "pheno2"]
+    assert got_values["pheno1"].dtype == np.float64
+    np.testing.assert_array_equal(got_values["pheno1"], [1, 2])
+    assert got_values["pheno2"].dtype == bool
+    np.testing.assert_array_equal(got_values["pheno2"], [True, False])
+    for valid in got_valid.values():
+        np.testing.assert_array_equal(valid, [True, True])
     expected_types = {"pheno1": {float}, "pheno2": {bool}}
     assert got_types == expected_types
 
 
+def test_phenotypes_columns_and_getitem():
+    tmp_tsv = "tmp.phenotypes.columns.tsv"
+    with open(tmp_tsv, "w") as f:
+        print("sample", "p1", "p2", "p3", sep="\t", file=f)
+        print("s1", "1.5", "R", "NA", sep="\t", file=f)
+        print("s2", "NA", "s", ".", sep="\t", file=f)
+        print("s3", "-2", "", "", sep="\t", file=f)
+    phenos = phenotypes.Phenotypes(tmp_tsv)
+    assert len(phenos) == 3
+    assert "s1" in phenos
+    assert "s4" not in phenos
+    assert phenos["s1"] == {"p1": 1.5, "p2": True, "p3": None}
+    assert phenos["s2"] == {"p1": None, "p2": False, "p3": None}
+    assert phenos["s3"] == {"p1": -2, "p2": None, "p3": None}
+    assert type(phenos["s1"]["p2"]) is bool
+    for sample in "s1", "s2", "s3":
+        for pheno in "p1", "p2", "p3":
+            assert phenos.value(sample, pheno) == phenos[sample][pheno]
+    assert type(phenos.value("s1", "p2")) is bool
+    assert phenos.pheno_types == {"p1": float, "p2": bool, "p3": type(None)}
+    values, valid = phenos.column("p1")
+    np.testing.assert_array_equal(values, [1.5, np.nan, -2])
+    np.testing.assert_array_equal(valid, [True, False, True])
+    values, valid = phenos.column("p2")
+    np.testing.assert_array_equal(values, [True, False, False])
+    np.testing.assert_array_equal(valid, [True, True, False])
+
+    with open(tmp_tsv, "a") as f:
+        print("s1", "1", "R", "NA", sep="\t", file=f)
+    with pytest.raises(RuntimeError):
+        phenotypes.Phenotypes(tmp_tsv)
+    with open(tmp_tsv, "w") as f:
+        print("sample", "p1", sep="\t", file=f)
+        print("s1", "1", "2", sep="\t", file=f)
+    with pytest.raises(RuntimeError):
+        phenotypes.Phenotypes(tmp_tsv)
+    os.unlink(tmp_tsv)
+
+
 def test_get_pheno_types():
     types = {"p1": {float}, "p2": {bool}, "p3": {float, type(None)}}
     got_all, got_bools = phenotypes.Phenotypes._get_pheno_types(types)
@@ -110,3 +159,66 @@ def test_find_matching_cases():
     assert got == ["s2"]
     got = phenos.find_matching_cases({"pheno1": 199, "pheno2": "S"}, pheno_compare)
     assert got == ["s3"]
+
+
+def test_find_matching_cases_same_as_phenos_agree_on_features():
+    tmp_tsv = "tmp.phenotypes.find_matching_cases.tsv"
+    float_values = ["0", "1", "1.5", "2.5", "-3", "NA"]
+    with open(tmp_tsv, "w") as f:
+        print("sample", "b1", "f1", "f2", "f3", sep="\t", file=f)
+        for i, values in enumerate(
+            itertools.product(["R", "S", "NA"], float_values, float_values)
+        ):
+            f3 = float_values[i % len(float_values)]
+            print(f"s{i}", *values, f3, sep="\t", file=f)
+    phenos = phenotypes.Phenotypes(tmp_tsv)
+    os.unlink(tmp_tsv)
+
+    constraints = {
+        "b1": {"method": "equal", "must_be_same": False, "params": {}},
+        "f1": {
+            "method": "range",
+            "must_be_same": True,
+            "params": {"low": 1, "high": 2},
+        },
+        "f2": {
+            "method": "abs_distance",
+            "must_be_same": True,
+            "params": {"max_dist": 1},
+        },
+        "f3": {
+            "method": "percent_distance",
+            "must_be_same": True,
+            "params": {"max_percent": 50},
+        },
+    }
+    wanted_values = [None, True, False, -3, 0, 1.5, 2.5]
+    for count_unknown_as_diff in True, False:
+        pheno_compare = phenotype_compare.PhenotypeCompare(
+            constraints, count_unknown_as_diff=count_unknown_as_diff
+        )
+        for pheno in constraints:
+            for value in wanted_values:
+                if pheno == "b1" and value not in [None, True, False]:
+                    continue
+                wanted = {pheno: value}
+                expect = sorted(
+                    x
+                    for x in phenos.sample_names
+                    if pheno_compare.phenos_agree_on_features(phenos[x], wanted, wanted)
+                )
+                assert phenos.find_matching_cases(wanted, pheno_compare) == expect
+
+        wanted = {"b1": "R", "f1": 1.5, "f2": 0}
+        expect = sorted(
+            x
+            for x in phenos.sample_names
+            if pheno_compare.phenos_agree_on_features(
+                phenos[x], {"b1": True, "f1": 1.5, "f2": 0}, wanted
+            )
+        )
+        assert len(expect) > 0
+        assert phenos.find_matching_cases(wanted, pheno_compare) == expect
+
+    with pytest.raises(RuntimeError):
+        phenos.find_matching_cases({"not_a_pheno": True}, pheno_compare)
@@ -1,8 +1,11 @@
+import itertools
 import os
 
+import numpy as np
 import pytest
 
 from triphecta import (
+    distance_matrix,
     genotypes,
     phenotypes,
     phenotype_compare,
@@ -18,19 +21,21 @@ def genos(request):
     genos = genotypes.Genotypes(testing=True)
     genos.sample_names_list = ["s1", "s2", "s3", "s4", "s5"]
     genos._make_sample_name_to_index()
-    genos.distances = {
-        (0, 1): 0,
-        (0, 2): 3,
-        (0, 3): 2,
-        (0, 4): 1,
-        (1, 2): 1,
-        (1, 3): 4,
-        (1, 4): 3,
-        (2, 3): 5,
-        (2, 4): 2,
-        (3, 3): 5,
-        (3, 4): 1,
-    }
+    genos.distances = distance_matrix.DistanceMatrix.from_dict(
+        5,
+        {
+            (0, 1): 0,
+            (0, 2): 3,
+            (0, 3): 2,
+            (0, 4): 1,
+            (1, 2): 1,
+            (1, 3): 4,
+            (1, 4): 3,
+            (2, 3): 5,
+            (2, 4): 2,
+            (3, 4): 1,
+        },
+    )
     return genos
 
 
@@ -187,3 +192,71 @@ def test_ranked_neighbours_for_one_sample(genos, phenos, constraints):
         )
     ]
     assert got == expect
+
+
+def test_dense_ranks():
+    groups = np.array([0, 0, 0, 0, 1, 1, 2, 2, 2])
+    values = np.array([5, 1, 5, 3, 2, 2, 0, 9, 4])
+    got = sample_neighbours_finding._dense_ranks(groups, values)
+    np.testing.assert_array_equal(got, [2, 0, 2, 1, 0, 0, 0, 2, 1])
+    got = sample_neighbours_finding._dense_ranks(groups[:0], values[:0])
+    assert len(got) == 0
+
+
+def test_ranked_neighbours_for_samples(genos, phenos, constraints, monkeypatch):
+    pheno_compare = phenotype_compare.PhenotypeCompare(constraints)
+    samples = ["s3", "s1", "s5", "s2", "s4"]
+    # Small batches, to check that results from all batches are combined
+    # in the right order
+    monkeypatch.setattr(sample_neighbours_finding, "RANKING_BATCH_SIZE", 2)
+    for top_n_genos, max_pheno_dist, processes in itertools.product(
+        [None, 1, 2, 3], [None, 0, 1, 2], [1, 2]
+    ):
+        expect = [
+            sample_neighbours_finding.ranked_neighbours_for_one_sample(
+                genos,
+                phenos,
+                pheno_compare,
+                sample,
+                top_n_genos=top_n_genos,
+                max_pheno_dist=max_pheno_dist,
+            )
+            for sample in samples
+        ]
+        got = sample_neighbours_finding.ranked_neighbours_for_samples(
+            genos,
+            phenos,
+            pheno_compare,
+            samples,
+            top_n_genos=top_n_genos,
+            max_pheno_dist=max_pheno_dist,
+            processes=processes,
+        )
+        assert got == expect
+
+    assert (
+        sample_neighbours_finding.ranked_neighbours_for_samples(
+            genos, phenos, pheno_compare, []
+        )
+        == []
+    )
+
+
+def test_ranked_neighbours_for_batch_in_worker(genos, phenos, constraints, monkeypatch):
+    with pytest.raises(RuntimeError):
+        sample_neighbours_finding._ranked_neighbours_for_batch_in_worker(
+            ["s1"], None, None
+        )
+
+    pheno_compare = phenotype_compare.PhenotypeCompare(constraints)
+    compiled_compare = pheno_compare.compile(phenos, genos.sample_names_list)
+    monkeypatch.setattr(sample_neighbours_finding, "ranking_genos", None)
+    monkeypatch.setattr(sample_neighbours_finding, "ranking_compiled_compare", None)
+    sample_neighbours_finding._init_ranking_worker(genos, compiled_compare)
+    got = sample_neighbours_finding._ranked_neighbours_for_batch_in_worker(
+        ["s1", "s2"], None, None
+    )
+    expect = sample_neighbours_finding._ranked_neighbours_for_batch(
+        genos, compiled_compare, ["s1", "s2"], top_n_genos=None, max_pheno_dist=None
+    )
+    assert got == expect
@@ -0,0 +1,31 @@
+import multiprocessing
+import numpy as np
+
+from triphecta import shared_array
+
+
+def _sum_and_increment(shared):
+    total = shared.array.sum()
+    shared.array += 1
+    shared.close()
+    return total
+
+
+def test_shared_array():
+    array = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    shared = shared_array.SharedArray.from_array(array)
+    assert shared.array.shape == (3, 4)
+    assert shared.array.dtype == np.uint16
+    np.testing.assert_array_equal(shared.array, array)
+
+    for method in "fork", "spawn":
+        with multiprocessing.get_context(method).Pool(1) as p:
+            assert p.apply(_sum_and_increment, (shared,)) == array.sum()
+        array += 1
+        np.testing.assert_array_equal(shared.array, array)
+
+    shared.unlink()
+
+    empty = shared_array.SharedArray((0, 5), np.uint8)
+    assert empty.array.shape == (0, 5)
+    empty.unlink()
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pytest
+
+from triphecta import site_index, vcf
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "site_index")
+
+
+def test_from_vcf_file():
+    vcf_file = os.path.join(data_dir, "from_vcf_file.vcf")
+    bed_file = os.path.join(data_dir, "from_vcf_file.mask.bed")
+    sites = site_index.SiteIndex.from_vcf_file(vcf_file)
+    assert len(sites) == 12
+    assert sites.masked is None
+    assert sites.records_to_mask() is None
+    assert sites.variant(2) == vcf.Variant(
+        CHROM="ref_43", POS=41, REF="T", ALTS=["A", "CT"]
+    )
+    assert sites.variant(5) == vcf.Variant(
+        CHROM="ref_43", POS=59, REF="TACGT", ALTS=["G"]
+    )
+    assert sites.chrom_names == ["ref_42", "ref_43", "ref_44", "ref_45", "ref_46"]
+    assert sites.alt_counts().tolist() == [1, 1, 2, 1, 1, 1, 2, 1, 1, 1, 1, 1]
+
+    sites = site_index.SiteIndex.from_vcf_file(vcf_file, mask_bed_file=bed_file)
+    expect_mask = vcf.vcf_to_variant_positions_to_mask_from_bed_file(vcf_file, bed_file)
+    assert sites.records_to_mask() == expect_mask
+    assert sites.masked.tolist() == [
+        False,
+        True,
+        False,
+        True,
+        True,
+        False,
+        True,
+        False,
+        False,
+        False,
+        False,
+        False,
+    ]
+
+
+def test_from_variants_and_check_positions():
+    variants = [
+        vcf.Variant(CHROM="ref_1", POS=9, REF="A", ALTS=["C"]),
+        vcf.Variant(CHROM="ref_1", POS=10, REF="ACGT", ALTS=["C", "G"]),
+        vcf.Variant(CHROM="ref_2", POS=0, REF="T", ALTS=["TA"]),
+    ]
+    sites = site_index.SiteIndex.from_variants(variants)
+    assert sites.variants() == variants
+    sites.check_positions(["ref_1", "ref_1", "ref_2"], [9, 10, 0], "foo.vcf")
+    with pytest.raises(RuntimeError):
+        sites.check_positions(["ref_1", "ref_1"], [9, 10], "foo.vcf")
+    with pytest.raises(RuntimeError):
+        sites.check_positions(["ref_1", "ref_1", "ref_2"], [9, 11, 0], "foo.vcf")
+    with pytest.raises(RuntimeError):
+        sites.check_positions(["ref_1", "ref_2", "ref_2"], [9, 10, 0], "foo.vcf")
+    with pytest.raises(RuntimeError):
+        sites.check_positions(["ref_1", "ref_1", "ref_3"], [9, 10, 0], "foo.vcf")
+
+
+def test_save_and_load():
+    vcf_file = os.path.join(data_dir, "from_vcf_file.vcf")
+    bed_file = os.path.join(data_dir, "from_vcf_file.mask.bed")
+    tmp_file = "tmp.site_index.save_and_load.npz"
+    for mask_file in None, bed_file:
+        sites = site_index.SiteIndex.from_vcf_file(vcf_file, mask_bed_file=mask_file)
+        sites.save(tmp_file)
+        got = site_index.load(tmp_file)
+        assert got == sites
+        assert got.variants() == sites.variants()
+        assert got.records_to_mask() == sites.records_to_mask()
+        os.unlink(tmp_file)
+
+    with pytest.raises(RuntimeError):
+        site_index.load(vcf_file)
+    with open(tmp_file, "wb") as f:
+        np.savez(f, positions=np.zeros(3))
+    with pytest.raises(RuntimeError):
+        site_index.load(tmp_file)
+    os.unlink(tmp_file)
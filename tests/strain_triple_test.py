@@ -1,5 +1,8 @@
 import filecmp
 import os
+import random
+
+import numpy as np
 import pytest
 
 from triphecta import strain_triple, vcf
@@ -8,6 +11,17 @@ this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "strain_triple")
 
 
+def _calls_to_lists(variant_calls):
+    return {k: v.tolist() for k, v in variant_calls.items()}
+
+
+def _sets_to_calls(variant_calls):
+    return {
+        k: vcf.genotype_bitmasks_to_array([vcf.alleles_to_bitmask(x) for x in v])
+        for k, v in variant_calls.items()
+    }
+
+
 def test_load_variants_from_vcf_files():
     triple = strain_triple.StrainTriple("case", "control1", "control2")
     case_vcf = os.path.join(data_dir, "load_variants_from_vcf_files.case.vcf")
@@ -20,23 +34,59 @@ def test_load_variants_from_vcf_files():
     ]
     assert triple.variants == expect_variants
     expect_variant_calls = {
-        "case": [{0}, {1}],
-        "control1": [{0}, {2}],
-        "control2": [{0}, {2}],
+        "case": [1, 2],
+        "control1": [1, 4],
+        "control2": [1, 4],
     }
-    assert triple.variant_calls == expect_variant_calls
+    assert _calls_to_lists(triple.variant_calls) == expect_variant_calls
 
     triple = strain_triple.StrainTriple("case", "control1", "control2")
     triple.set_variants(expect_variants)
     triple.load_variants_from_vcf_files(case_vcf, control1_vcf, control2_vcf)
     assert triple.variants == expect_variants
-    assert triple.variant_calls == expect_variant_calls
+    assert _calls_to_lists(triple.variant_calls) == expect_variant_calls
     triple.clear_variant_calls()
     assert triple.variant_calls == {"case": None, "control1": None, "control2": None}
+    triple.set_variant_calls(
+        expect_variant_calls["case"],
+        expect_variant_calls["control1"],
+        expect_variant_calls["control2"],
+    )
+    assert triple.variant_calls == expect_variant_calls
+
+
+def test_eq():
+    case_vcf = os.path.join(data_dir, "load_variants_from_vcf_files.case.vcf")
+    control1_vcf = os.path.join(data_dir, "load_variants_from_vcf_files.control1.vcf")
+    control2_vcf = os.path.join(data_dir, "load_variants_from_vcf_files.control2.vcf")
+    triple1 = strain_triple.StrainTriple("case", "control1", "control2")
+    triple2 = strain_triple.StrainTriple("case", "control1", "control2")
+    assert triple1 == triple2
+    triple1.load_variants_from_vcf_files(case_vcf, control1_vcf, control2_vcf)
+    assert triple1 != triple2
+    assert triple2 != triple1
+    triple2.load_variants_from_vcf_files(case_vcf, control1_vcf, control2_vcf)
+    assert triple1 == triple2
+
+    triple2.load_variants_from_vcf_files(case_vcf, case_vcf, control2_vcf)
+    assert triple1 != triple2
+    triple2.load_variants_from_vcf_files(case_vcf, control1_vcf, control2_vcf)
+    triple2.case = "other_case"
+    assert triple1 != triple2
+    triple2.case = "case"
+    triple2.variant_indexes_of_interest = {0}
+    assert triple1 != triple2
+    assert triple1 != "not a triple"
 
 
 def test_genotypes_are_of_interest():
-    f = strain_triple.StrainTriple.genotypes_are_of_interest
+    def f(case, control1, control2):
+        return strain_triple.StrainTriple.genotypes_are_of_interest(
+            vcf.alleles_to_bitmask(case),
+            vcf.alleles_to_bitmask(control1),
+            vcf.alleles_to_bitmask(control2),
+        )
+
     assert not f(None, None, None)
     assert not f({0}, {1}, None)
     assert not f({0}, None, {1})
@@ -67,16 +117,46 @@ def test_update_variants_of_interest():
         vcf.Variant(CHROM="ref_42", POS=12, REF="G", ALTS=["T"]),
         vcf.Variant(CHROM="ref_42", POS=13, REF="T", ALTS=["A"]),
     ]
-    triple.variant_calls = {
-        "case": [{0}, {0}, None, {0}, {0}],
-        "control1": [{1}, None, {1}, {0}, {1}],
-        "control2": [None, {1}, {1}, {1}, {1}],
-    }
+    triple.variant_calls = _sets_to_calls(
+        {
+            "case": [{0}, {0}, None, {0}, {0}],
+            "control1": [{1}, None, {1}, {0}, {1}],
+            "control2": [None, {1}, {1}, {1}, {1}],
+        }
+    )
     assert triple.variant_indexes_of_interest == set()
     triple.update_variants_of_interest()
     assert triple.variant_indexes_of_interest == {4}
 
 
+def test_variants_of_interest_bitmap(monkeypatch):
+    random.seed(42)
+    site_count = 50
+    sample_count = 6
+    genotypes = vcf.genotype_bitmasks_to_array(
+        [random.choice([0, 1, 2, 4, 3]) for _ in range(site_count * sample_count)]
+    ).reshape(sample_count, site_count)
+    triples = [random.sample(range(sample_count), 3) for _ in range(11)]
+
+    expect_triples = []
+    for case, c1, c2 in triples:
+        triple = strain_triple.StrainTriple("case", "control1", "control2")
+        triple.set_variant_calls(genotypes[case], genotypes[c1], genotypes[c2])
+        triple.update_variants_of_interest()
+        expect_triples.append(triple)
+
+    expect_bitmap = strain_triple.bitmap_from_triples(expect_triples, site_count)
+    assert expect_bitmap.shape == (site_count, 2)
+    for chunk_elements in [1, 30, 2**24]:
+        monkeypatch.setattr(strain_triple, "BITMAP_CHUNK_ELEMENTS", chunk_elements)
+        got = strain_triple.variants_of_interest_bitmap(genotypes, triples)
+        np.testing.assert_array_equal(got, expect_bitmap)
+
+    for i, triple in enumerate(expect_triples):
+        got = strain_triple.bitmap_triple_sites(expect_bitmap, i)
+        assert set(got.tolist()) == triple.variant_indexes_of_interest
+
+
 def test_genotype_to_string():
     f = strain_triple.StrainTriple.genotype_to_string
     assert f(None) == "./."
@@ -94,11 +174,13 @@ def test_write_variants_of_interest_file():
         vcf.Variant(CHROM="ref_42", POS=13, REF="T", ALTS=["A"]),
         vcf.Variant(CHROM="ref_43", POS=42, REF="A", ALTS=["C,G"]),
     ]
-    triple.variant_calls = {
-        "case": [{0}, {0}, None, {0}, {0}, {0, 1}],
-        "control1": [{1}, None, {1}, {0}, {1}, {2}],
-        "control2": [None, {1}, {1}, {1}, {1}, {2}],
-    }
+    triple.variant_calls = _sets_to_calls(
+        {
+            "case": [{0}, {0}, None, {0}, {0}, {0, 1}],
+            "control1": [{1}, None, {1}, {0}, {1}, {2}],
+            "control2": [None, {1}, {1}, {1}, {1}, {2}],
+        }
+    )
     triple.variant_indexes_of_interest = {4, 5}
 
     outfile = "tmp.out.write_variants_of_interest_file.tsv"
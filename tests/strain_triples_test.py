@@ -2,16 +2,19 @@ import collections
 import filecmp
 import os
 import logging
+import numpy as np
 import pytest
 import subprocess
 
 from triphecta import (
+    distance_matrix,
     genotypes,
     phenotypes,
     phenotype_compare,
     sample_neighbours_finding,
     strain_triple,
     strain_triples,
+    utils,
     vcf,
 )
 
@@ -24,29 +27,32 @@ def genos(request):
     genos = genotypes.Genotypes(testing=True)
     genos.sample_names_list = ["s1", "s2", "s3", "s4", "s5", "s6", "s7"]
     genos._make_sample_name_to_index()
-    genos.distances = {
-        (0, 1): 0,
-        (0, 2): 1,
-        (0, 3): 1,
-        (0, 4): 3,
-        (0, 5): 5,
-        (0, 6): 6,
-        (1, 2): 6,
-        (1, 3): 4,
-        (1, 4): 7,
-        (1, 5): 1,
-        (1, 6): 2,
-        (2, 3): 6,
-        (2, 4): 4,
-        (2, 5): 2,
-        (2, 6): 3,
-        (3, 4): 5,
-        (3, 5): 8,
-        (3, 6): 10,
-        (4, 5): 4,
-        (4, 6): 7,
-        (5, 6): 1,
-    }
+    genos.distances = distance_matrix.DistanceMatrix.from_dict(
+        7,
+        {
+            (0, 1): 0,
+            (0, 2): 1,
+            (0, 3): 1,
+            (0, 4): 3,
+            (0, 5): 5,
+            (0, 6): 6,
+            (1, 2): 6,
+            (1, 3): 4,
+            (1, 4): 7,
+            (1, 5): 1,
+            (1, 6): 2,
+            (2, 3): 6,
+            (2, 4): 4,
+            (2, 5): 2,
+            (2, 6): 3,
+            (3, 4): 5,
+            (3, 5): 8,
+            (3, 6): 10,
+            (4, 5): 4,
+            (4, 6): 7,
+            (5, 6): 1,
+        },
+    )
     genos.vcf_files = {
         "s1": os.path.join(data_dir, "genos.vcf.1"),
         "s2": os.path.join(data_dir, "genos.vcf.1"),
@@ -168,6 +174,62 @@ def test_write_variants_summary_file():
     os.unlink(tmp_out)
 
 
+def test_write_sparse_variants_files():
+    triples = [
+        strain_triple.StrainTriple("case1", "control1", "control2"),
+        strain_triple.StrainTriple("case2", "control2", "control2"),
+        strain_triple.StrainTriple("case3", "control3", "control3"),
+    ]
+    triples[0].variants = [
+        vcf.Variant(CHROM="ref_1", POS=9, REF="A", ALTS=["C"]),
+        vcf.Variant(CHROM="ref_1", POS=10, REF="A", ALTS=["G"]),
+        vcf.Variant(CHROM="ref_2", POS=42, REF="T", ALTS=["A"]),
+    ]
+    triples[0].variant_indexes_of_interest = {0, 2}
+    triples[1].variant_indexes_of_interest = set()
+    triples[2].variant_indexes_of_interest = {2}
+    bitmap = strain_triple.bitmap_from_triples(triples, 3)
+    variant_indexes = np.array([0, 2])
+
+    tmp_out = "tmp.strain_triples.write_sparse_variants_files.tsv"
+    subprocess.check_output(f"rm -f {tmp_out}", shell=True)
+    strain_triples.StrainTriples._write_variants_summary_file(
+        triples,
+        tmp_out,
+        bitmap=bitmap,
+        variant_indexes=variant_indexes,
+        per_triple_columns=False,
+    )
+    with open(tmp_out) as f:
+        got = [x.rstrip().split("\t") for x in f]
+    assert got == [
+        ["variant_id", "in_mask", "chrom", "pos", "ref", "alt", "freq"],
+        ["1", "0", "ref_1", "10", "A", "C", "0.3333"],
+        ["3", "0", "ref_2", "43", "T", "A", "0.6667"],
+    ]
+    os.unlink(tmp_out)
+
+    strain_triples.StrainTriples._write_variant_triples_file(
+        bitmap, len(triples), tmp_out, variant_indexes
+    )
+    with open(tmp_out) as f:
+        got = [x.rstrip().split("\t") for x in f]
+    assert got == [["variant_id", "triple_id"], ["1", "1"], ["3", "1"], ["3", "3"]]
+    os.unlink(tmp_out)
+
+    tmp_npz = "tmp.strain_triples.write_sparse_variants_files.npz"
+    strain_triples.StrainTriples._write_variants_bitmap_file(
+        bitmap, len(triples), tmp_npz, variant_indexes
+    )
+    variant_ids, got_bitmap, triple_count = strain_triples.load_variants_bitmap_file(
+        tmp_npz
+    )
+    assert variant_ids.tolist() == [1, 3]
+    np.testing.assert_array_equal(got_bitmap, bitmap[variant_indexes])
+    assert triple_count == 3
+    os.unlink(tmp_npz)
+
+
 def test_run_analysis(genos, phenos, constraints, caplog):
     caplog.set_level(logging.INFO)
     pheno_compare = phenotype_compare.PhenotypeCompare(constraints)
@@ -184,3 +246,57 @@ def test_run_analysis(genos, phenos, constraints, caplog):
     for filename in got.values():
         assert os.path.exists(filename)
     subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
+
+
+def test_run_analysis_sparse(genos, phenos, constraints):
+    pheno_compare = phenotype_compare.PhenotypeCompare(constraints)
+    triples = strain_triples.StrainTriples(genos, phenos, pheno_compare, top_n_genos=10)
+    case_sample_names = ["s1", "s2"]
+    tmp_dir = "tmp.strain_triples.run_analysis_sparse"
+    subprocess.check_output(f"rm -rf {tmp_dir}", shell=True)
+    os.mkdir(tmp_dir)
+    wide = triples.run_analysis(case_sample_names, os.path.join(tmp_dir, "wide"))
+    sparse = triples.run_analysis(
+        case_sample_names,
+        os.path.join(tmp_dir, "sparse"),
+        variants_format="sparse",
+        skip_zero_freq=True,
+    )
+
+    # The sparse output should have the same information as the wide output,
+    # minus the variants that are not in any triple
+    with open(wide["variants_file"]) as f:
+        wide_lines = [x.rstrip().split("\t") for x in f]
+    expect_variants = [x[:7] for x in wide_lines if x[6] != "0.0"]
+    expect_pairs = [
+        [int(x[0]), i + 1]
+        for x in wide_lines[1:]
+        for i, in_triple in enumerate(x[7:])
+        if in_triple == "1"
+    ]
+    assert len(expect_pairs) > 0
+    assert len(expect_variants) < len(wide_lines)
+    with open(sparse["variants_file"]) as f:
+        assert [x.rstrip().split("\t") for x in f] == expect_variants
+    with utils.open_file(sparse["variant_triples_file"]) as f:
+        assert next(f).rstrip() == "variant_id\ttriple_id"
+        got_pairs = [list(map(int, x.rstrip().split("\t"))) for x in f]
+    assert got_pairs == expect_pairs
+    variant_ids, bitmap, triple_count = strain_triples.load_variants_bitmap_file(
+        sparse["variants_bitmap_file"]
+    )
+    assert triple_count == 2
+    assert variant_ids.tolist() == [int(x[0]) for x in expect_variants[1:]]
+    got_pairs = [
+        [int(variant_ids[i]), t + 1]
+        for i, t in zip(
+            *np.nonzero(np.unpackbits(bitmap, axis=1, count=2, bitorder="little"))
+        )
+    ]
+    assert got_pairs == expect_pairs
+
+    with pytest.raises(RuntimeError):
+        triples.run_analysis(
+            case_sample_names, os.path.join(tmp_dir, "x"), variants_format="oops"
+        )
+    subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
@@ -1,11 +1,12 @@
 import filecmp
+import itertools
 import logging
 import os
 import pytest
 import subprocess
 from unittest import mock
 
-from triphecta import distances, tasks, utils
+from triphecta import distances, knn_index, tasks, utils
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "tasks")
@@ -13,6 +14,8 @@ data_dir = os.path.join(this_dir, "data", "tasks")
 
 def test_pheno_constraints_template():
     options = mock.Mock()
+    options.gzip_level = utils.GZIP_WRITE_LEVEL
+    options.gzip_threads = utils.GZIP_WRITE_THREADS
     options.phenos_tsv = os.path.join(data_dir, "pheno_constraints_template.tsv")
     options.json_out = "tmp.tasks.pheno_constraints_template.json"
     utils.rm_rf(options.json_out)
@@ -22,17 +25,49 @@ def test_pheno_constraints_template():
     os.unlink(options.json_out)
 
 
+def test_distance_matrix_bad_options():
+    options = mock.Mock()
+    options.filenames_tsv = "does_not_exist.tsv"
+    options.out = "tmp.tasks.distance_matrix_bad_options"
+    for method, query, top_k, knn in [
+        ("vcf", None, 5, None),
+        ("vcf", "query.tsv", None, 5),
+        ("add", "query.tsv", None, None),
+        ("add", None, None, 5),
+        ("premade", "query.tsv", None, None),
+        ("premade", None, None, 5),
+    ]:
+        options.method = method
+        options.query = query
+        options.top_k = top_k
+        options.knn = knn
+        with pytest.raises(RuntimeError):
+            tasks.distance_matrix.run(options)
+
+
 def test_pipeline(caplog):
     caplog.set_level(logging.INFO)
     vcf_names_file = "tmp.tasks.vcfs_to_names.tsv"
     mask_bed_file = os.path.join(data_dir, "mask.bed")
     distance_matrix_prefix = "tmp.distance_matrix"
     dist_matrix_file = f"{distance_matrix_prefix}.distance_matrix.txt.gz"
+    binary_dist_matrix_file = f"{distance_matrix_prefix}.distance_matrix.bin"
     variant_counts_file = f"{distance_matrix_prefix}.variant_counts.tsv.gz"
-    utils.rm_rf(vcf_names_file, dist_matrix_file, variant_counts_file)
+    knn_index_file = f"{distance_matrix_prefix}.knn_index.bin"
+    site_index_file = "tmp.tasks.site_index.npz"
+    utils.rm_rf(
+        site_index_file,
+        vcf_names_file,
+        dist_matrix_file,
+        binary_dist_matrix_file,
+        variant_counts_file,
+        knn_index_file,
+    )
 
     # ------------------ vcfs_to_names ----------------------------------------
     options = mock.Mock()
+    options.gzip_level = utils.GZIP_WRITE_LEVEL
+    options.gzip_threads = utils.GZIP_WRITE_THREADS
     options.file_of_vcf_filenames = os.path.join(data_dir, "vcfs.fofn")
     options.out_tsv = vcf_names_file
     options.threads = 1
@@ -40,8 +75,20 @@ def test_pipeline(caplog):
     expect = os.path.join(data_dir, "vcfs_to_names.expect.tsv")
     assert filecmp.cmp(options.out_tsv, expect, shallow=False)
 
+    # ----------------- site_index --------------------------------------------
+    options = mock.Mock()
+    options.gzip_level = utils.GZIP_WRITE_LEVEL
+    options.gzip_threads = utils.GZIP_WRITE_THREADS
+    options.vcf_file = os.path.join(data_dir, "vcfs.1.vcf")
+    options.mask_bed_file = mask_bed_file
+    options.outfile = site_index_file
+    tasks.site_index.run(options)
+    assert os.path.exists(site_index_file)
+
     # ----------------- distance_matrix ---------------------------------------
     options = mock.Mock()
+    options.gzip_level = utils.GZIP_WRITE_LEVEL
+    options.gzip_threads = utils.GZIP_WRITE_THREADS
     options.method = "vcf"
     options.out = distance_matrix_prefix
     options.filenames_tsv = vcf_names_file
@@ -50,7 +97,13 @@ def test_pipeline(caplog):
     options.het_to_hom_key = None
     options.het_to_hom_cutoff = None
     options.mask_bed_file = mask_bed_file
+    options.site_index = None
     options.vcf_ignore_filter_pass = True
+    options.packed_genotypes = True
+    options.genotype_cache = None
+    options.query = None
+    options.top_k = None
+    options.knn = None
     expect_matrix_file = os.path.join(data_dir, "distance_matrix.txt")
     expect_names, expect_distances = distances.load_distance_matrix_file(
         expect_matrix_file
@@ -58,12 +111,55 @@ def test_pipeline(caplog):
     tasks.distance_matrix.run(options)
     assert os.path.exists(dist_matrix_file)
     assert os.path.exists(variant_counts_file)
+    for filename in dist_matrix_file, binary_dist_matrix_file:
+        got_names, got_distances = distances.load_distance_matrix_file(filename)
+        assert got_names == expect_names
+        assert got_distances == expect_distances
+
+    # Query mode, using all the samples as both query and reference
+    options.query = vcf_names_file
+    tasks.distance_matrix.run(options)
+    query_distances_file = f"{distance_matrix_prefix}.query_distances.tsv.gz"
+    got = distances.load_query_distances_file(query_distances_file)
+    assert got[0] == got[1] == expect_names
+    for i, j in itertools.combinations(range(len(expect_names)), 2):
+        assert got[2][i, j] == got[2][j, i] == expect_distances[i, j]
+    options.top_k = 1
+    tasks.distance_matrix.run(options)
+    neighbours_file = f"{distance_matrix_prefix}.query_neighbours.tsv.gz"
+    got_neighbours = distances.load_neighbours_file(neighbours_file)
+    assert sorted(got_neighbours) == expect_names
+    for sample, neighbours in got_neighbours.items():
+        assert (sample, 0) in neighbours
+    utils.rm_rf(
+        query_distances_file,
+        neighbours_file,
+        f"{distance_matrix_prefix}.query_variant_counts.tsv.gz",
+    )
+    options.query = None
+    options.top_k = None
+
+    # Nearest neighbours index instead of the full matrix
+    options.knn = 5
+    tasks.distance_matrix.run(options)
+    got_index = knn_index.load(knn_index_file)
+    assert got_index == knn_index.KnnIndex.from_distance_matrix(
+        expect_names, expect_distances, 5
+    )
+    options.knn = None
+
+    # Take the mask from the site index instead of the BED file
+    options.mask_bed_file = None
+    options.site_index = site_index_file
+    tasks.distance_matrix.run(options)
     got_names, got_distances = distances.load_distance_matrix_file(dist_matrix_file)
     assert got_names == expect_names
     assert got_distances == expect_distances
 
     # ----------------- tree --------------------------------------------------
     options = mock.Mock()
+    options.gzip_level = utils.GZIP_WRITE_LEVEL
+    options.gzip_threads = utils.GZIP_WRITE_THREADS
     options.distance_matrix = dist_matrix_file
     options.out = "tmp.tree.out"
 
@@ -76,7 +172,10 @@ def test_pipeline(caplog):
 
     # ----------------- find_cases --------------------------------------------
     options = mock.Mock()
+    options.gzip_level = utils.GZIP_WRITE_LEVEL
+    options.gzip_threads = utils.GZIP_WRITE_THREADS
     options.wanted_pheno = ["drug1,R"]
+    options.wanted_phenos_tsv = None
     options.phenos_tsv = os.path.join(data_dir, "phenos.tsv")
     options.pheno_constraints_json = os.path.join(data_dir, "pheno_constraint.json")
     options.outfile = "tmp.find_cases.out"
@@ -87,38 +186,79 @@ def test_pipeline(caplog):
     assert got_samples == ["sample_1", "sample_2", "sample_6"]
     os.unlink(options.outfile)
 
+    # Many sets of wanted phenotypes at once
+    options.wanted_pheno = None
+    options.wanted_phenos_tsv = os.path.join(data_dir, "wanted_phenos.tsv")
+    expect_samples = {
+        "drug1_R": ["sample_1", "sample_2", "sample_6"],
+        "drug2_R": ["sample_10", "sample_6", "sample_7", "sample_8", "sample_9"],
+        "drug1_drug2_R": ["sample_6"],
+        "drug4_high": ["sample_1", "sample_2", "sample_4", "sample_7", "sample_8"],
+        "drug1_S_drug2_R_drug4_high": ["sample_7", "sample_8"],
+    }
+    tasks.find_cases.run(options)
+    for name, expect in expect_samples.items():
+        outfile = f"{options.outfile}.{name}.txt"
+        with open(outfile) as f:
+            got_samples = [x.rstrip() for x in f]
+        assert got_samples == expect
+        os.unlink(outfile)
+    options.wanted_pheno = ["drug1,R"]
+    with pytest.raises(RuntimeError):
+        tasks.find_cases.run(options)
+
     # ----------------- triples -----------------------------------------------
-    options = mock.Mock()
-    options.case_names_file = os.path.join(data_dir, "triples.case_sample_names.txt")
-    options.vcfs_tsv = vcf_names_file
-    options.distance_matrix = dist_matrix_file
-    options.var_counts_file = variant_counts_file
-    options.phenos_tsv = os.path.join(data_dir, "phenos.tsv")
-    options.pheno_constraints_json = os.path.join(data_dir, "pheno_constraint.json")
-    options.out = "tmp.tasks.triples.out"
-    options.processes = 2
-    utils.rm_rf("{options.out}.*")
-    options.top_n_genos = 5
-    options.max_pheno_diffs = 1
-    options.mask_bed_file = mask_bed_file
-    tasks.triples.run(options)
+    # Run using the phylip and the binary distance matrix, and the nearest
+    # neighbours index, and with the mask from the BED file or from the site
+    # index: results should be the same
+    for matrix_file, use_site_index in itertools.product(
+        [dist_matrix_file, binary_dist_matrix_file, knn_index_file], [False, True]
+    ):
+        options = mock.Mock()
+        options.gzip_level = utils.GZIP_WRITE_LEVEL
+        options.gzip_threads = utils.GZIP_WRITE_THREADS
+        options.case_names_file = os.path.join(
+            data_dir, "triples.case_sample_names.txt"
+        )
+        options.vcfs_tsv = vcf_names_file
+        options.distance_matrix = matrix_file
+        options.var_counts_file = variant_counts_file
+        options.phenos_tsv = os.path.join(data_dir, "phenos.tsv")
+        options.pheno_constraints_json = os.path.join(data_dir, "pheno_constraint.json")
+        options.out = "tmp.tasks.triples.out"
+        options.processes = 2
+        utils.rm_rf(f"{options.out}.*")
+        options.top_n_genos = 5
+        options.max_pheno_diffs = 1
+        if use_site_index:
+            options.mask_bed_file = None
+            options.site_index = site_index_file
+        else:
+            options.mask_bed_file = mask_bed_file
+            options.site_index = None
+        options.variants_format = "wide"
+        options.skip_zero_freq = False
+        tasks.triples.run(options)
 
-    got_triple_ids_tsv = f"{options.out}.triple_ids.tsv"
-    expect_triple_ids_tsv = os.path.join(data_dir, "triples.triple_ids.tsv")
-    assert filecmp.cmp(got_triple_ids_tsv, expect_triple_ids_tsv, shallow=False)
-    os.unlink(got_triple_ids_tsv)
+        got_triple_ids_tsv = f"{options.out}.triple_ids.tsv"
+        expect_triple_ids_tsv = os.path.join(data_dir, "triples.triple_ids.tsv")
+        assert filecmp.cmp(got_triple_ids_tsv, expect_triple_ids_tsv, shallow=False)
+        os.unlink(got_triple_ids_tsv)
 
-    got_variants_tsv = f"{options.out}.variants.tsv"
-    expect_variants_tsv = os.path.join(data_dir, "triples.variants.tsv")
-    assert filecmp.cmp(got_variants_tsv, expect_variants_tsv, shallow=False)
-    os.unlink(got_variants_tsv)
+        got_variants_tsv = f"{options.out}.variants.tsv"
+        expect_variants_tsv = os.path.join(data_dir, "triples.variants.tsv")
+        assert filecmp.cmp(got_variants_tsv, expect_variants_tsv, shallow=False)
+        os.unlink(got_variants_tsv)
 
-    for i in (1, 2, 3):
-        expect_tsv = os.path.join(data_dir, "triples", f"{i}.tsv")
-        got_tsv = os.path.join(f"{options.out}.triples", f"{i}.tsv")
-        assert filecmp.cmp(got_tsv, expect_tsv, shallow=False)
+        for i in (1, 2, 3):
+            expect_tsv = os.path.join(data_dir, "triples", f"{i}.tsv")
+            got_tsv = os.path.join(f"{options.out}.triples", f"{i}.tsv")
+            assert filecmp.cmp(got_tsv, expect_tsv, shallow=False)
+        subprocess.check_output(f"rm -r {options.out}.triples", shell=True)
 
     os.unlink(vcf_names_file)
     os.unlink(dist_matrix_file)
+    os.unlink(binary_dist_matrix_file)
     os.unlink(variant_counts_file)
-    subprocess.check_output(f"rm -r {options.out}.triples", shell=True)
+    os.unlink(knn_index_file)
+    os.unlink(site_index_file)
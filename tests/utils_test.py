@@ -1,3 +1,4 @@
+import numpy as np
 import os
 import pytest
 import subprocess
@@ -8,6 +9,14 @@ this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "utils")
 
 
+def test_popcount(monkeypatch):
+    array = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    expect = np.array([[bin(x).count("1") for x in row] for row in array.tolist()])
+    assert np.array_equal(utils.popcount(array), expect)
+    monkeypatch.delattr(np, "bitwise_count", raising=False)
+    assert np.array_equal(utils.popcount(array), expect)
+
+
 def test_open_file():
     tmp_file = "tmp.open_file"
     subprocess.check_output(f"rm -f {tmp_file}", shell=True)
@@ -26,6 +35,61 @@ def test_open_file():
         os.unlink(tmp_file)
 
 
+def test_open_file_gzip_read_command(monkeypatch):
+    monkeypatch.setattr(utils, "GZIP_READ_COMMANDS", [["gzip", "-dc"]])
+    tmp_file = "tmp.open_file_gzip_read_command.gz"
+    utils.rm_rf(tmp_file)
+    with pytest.raises(OSError):
+        with utils.open_file(tmp_file) as f:
+            pass
+
+    lines = [f"line{i}" for i in range(100000)]
+    with utils.open_file(tmp_file, "w") as f:
+        print(*lines, sep="\n", file=f)
+    with utils.open_file(tmp_file) as f:
+        assert [x.rstrip() for x in f] == lines
+    with utils.open_file(tmp_file, "rb") as f:
+        assert f.read() == ("\n".join(lines) + "\n").encode()
+
+    # Stopping reading early is ok
+    with utils.open_file(tmp_file) as f:
+        assert f.readline() == "line0\n"
+
+    with open(tmp_file, "w") as f:
+        print("not gzipped", file=f)
+    with pytest.raises(OSError):
+        with utils.open_file(tmp_file) as f:
+            f.read()
+    os.unlink(tmp_file)
+
+
+def test_open_file_gzip_write(monkeypatch):
+    tmp_file = "tmp.open_file_gzip_write.gz"
+    utils.rm_rf(tmp_file)
+    lines = [f"line{i}" for i in range(1000)]
+    with utils.open_file(tmp_file, "w", gzip_level=1) as f:
+        print(*lines, sep="\n", file=f)
+    with utils.open_file(tmp_file) as f:
+        assert [x.rstrip() for x in f] == lines
+    os.unlink(tmp_file)
+
+    monkeypatch.setattr(utils, "GZIP_READ_COMMANDS", [])
+    monkeypatch.setattr(utils.shutil, "which", lambda x: None)
+    assert utils._gzip_write_command(1, 2) is None
+    monkeypatch.setattr(utils.shutil, "which", lambda x: f"/bin/{x}")
+    assert utils._gzip_write_command(1, 1) is None
+    assert utils._gzip_write_command(1, 2) == ["pigz", "-c", "-1", "-p", "2"]
+
+    monkeypatch.setattr(
+        utils, "_gzip_write_command", lambda level, threads: ["gzip", "-c", f"-{level}"]
+    )
+    with utils.open_file(tmp_file, "w", gzip_level=1, gzip_threads=2) as f:
+        print(*lines, sep="\n", file=f)
+    with utils.open_file(tmp_file, "rb") as f:
+        assert f.read() == ("\n".join(lines) + "\n").encode()
+    os.unlink(tmp_file)
+
+
 def test_load_file_of_vcf_filenames():
     infile = os.path.join(data_dir, "load_file_of_vcf_filenames.tsv")
     vcf_files = ["sample1.vcf", "sample2.vcf"]
@@ -57,3 +121,10 @@ def test_command_line_wanted_phenos_to_dict():
     got = utils.command_line_wanted_phenos_to_dict(pheno_list)
     expect = {"Drug1": True, "Drug2": 42.0}
     assert got == expect
+
+
+def test_load_wanted_phenos_tsv():
+    infile = os.path.join(data_dir, "load_wanted_phenos_tsv.tsv")
+    got = utils.load_wanted_phenos_tsv(infile)
+    expect = {"set1": {"p1": True}, "set2": {"p1": 1.5, "p2": False}}
+    assert got == expect
@@ -5,7 +5,7 @@ import os
 
 import pytest
 
-from triphecta import variant_counts, vcf
+from triphecta import site_index, utils, variant_counts, vcf
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "vcf")
@@ -67,7 +67,7 @@ def test_vcf_line_to_variant_and_gt():
 
 def test_load_variant_calls_from_vcf_file():
     infile = os.path.join(data_dir, "load_variants_from_vcf_file.vcf")
-    expect_calls = [{0}, {0, 1}, {1}, None, None]
+    expect_calls = [1, 3, 2, 0, 0]
     expect_variants = [
         vcf.Variant(CHROM="ref_42", POS=10, REF="C", ALTS=["G"]),
         vcf.Variant(CHROM="ref_42", POS=11, REF="A", ALTS=["C"]),
@@ -76,13 +76,14 @@ def test_load_variant_calls_from_vcf_file():
         vcf.Variant(CHROM="ref_43", POS=43, REF="T", ALTS=["G"]),
     ]
     got_calls, got_variants = vcf.load_variant_calls_from_vcf_file(infile)
-    assert got_calls == expect_calls
+    assert got_calls.dtype == np.uint16
+    assert got_calls.tolist() == expect_calls
     assert got_variants == expect_variants
 
     got_calls, got_variants = vcf.load_variant_calls_from_vcf_file(
         infile, expected_variants=expect_variants
     )
-    assert got_calls == expect_calls
+    assert got_calls.tolist() == expect_calls
     assert got_variants == expect_variants
 
     expect_variants = copy.copy(got_variants)
@@ -95,6 +96,51 @@ def test_load_variant_calls_from_vcf_file():
         vcf.load_variant_calls_from_vcf_file(infile, expected_variants=expect_variants)
 
 
+def test_load_variant_calls_from_vcf_file_using_site_index():
+    infile = os.path.join(data_dir, "load_variants_from_vcf_file.vcf")
+    expect_calls, variants = vcf.load_variant_calls_from_vcf_file(infile)
+    sites = site_index.SiteIndex.from_variants(variants)
+    got_calls = vcf.load_variant_calls_from_vcf_file_using_site_index(infile, sites)
+    assert got_calls.dtype == expect_calls.dtype
+    np.testing.assert_array_equal(got_calls, expect_calls)
+
+    wrong_variants = copy.copy(variants)
+    wrong_variants[0] = vcf.Variant(CHROM="wrong_ref", POS=10, REF="C", ALTS=["G"])
+    sites = site_index.SiteIndex.from_variants(wrong_variants)
+    with pytest.raises(RuntimeError):
+        vcf.load_variant_calls_from_vcf_file_using_site_index(infile, sites)
+
+    sites = site_index.SiteIndex.from_variants(variants[:-1])
+    with pytest.raises(RuntimeError):
+        vcf.load_variant_calls_from_vcf_file_using_site_index(infile, sites)
+
+
+def test_alleles_to_bitmask_and_bitmask_to_alleles():
+    for alleles, bitmask in [
+        (None, 0),
+        ({0}, 1),
+        ({1}, 2),
+        ({0, 1}, 3),
+        ({2, 5}, 36),
+        ({20}, 2**20),
+    ]:
+        assert vcf.alleles_to_bitmask(alleles) == bitmask
+        assert vcf.bitmask_to_alleles(bitmask) == alleles
+    assert vcf.bitmask_to_alleles(np.uint16(3)) == {0, 1}
+
+
+def test_genotype_bitmasks_to_array():
+    got = vcf.genotype_bitmasks_to_array([1, 0, 2**15])
+    assert got.dtype == np.uint16
+    assert got.tolist() == [1, 0, 2**15]
+    got = vcf.genotype_bitmasks_to_array([1, 2**16])
+    assert got.dtype == np.uint64
+    assert got.tolist() == [1, 2**16]
+    assert len(vcf.genotype_bitmasks_to_array([])) == 0
+    with pytest.raises(RuntimeError):
+        vcf.genotype_bitmasks_to_array([2**64])
+
+
 def test_convert_het_to_hom():
     genos = {"0", "1"}
     info = {"COV": "9,90,1"}
@@ -159,6 +205,28 @@ def test_load_vcf_file_for_distance_calc():
     assert got_counts == expect_counts
 
 
+def test_load_vcf_file_for_distance_calc_format_changes():
+    tmp_vcf = "tmp.load_vcf_file_for_distance_calc_format_changes.vcf"
+    with open(tmp_vcf, "w") as f:
+        print("#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", sep="\t", file=f)
+        common = ["ref", "1", ".", "A", "C,G", ".", "PASS", "."]
+        print(*common, "GT:COV:GT_CONF", "1/1:0,20,0:20", sep="\t", file=f)
+        print(*common, "GT_CONF:COV:GT", "20:1,19,0:0/1", sep="\t", file=f)
+        print(*common, "GT_CONF:COV:GT", "5:1,19,0:1/1", sep="\t", file=f)
+        print(*common, "GT", "2/2", sep="\t", file=f)
+        print(*common, "GT", "1/2", sep="\t", file=f)
+        print(*common, "COV:GT", "0,20,0:./.", sep="\t", file=f)
+
+    got_genos, got_counts = vcf.load_vcf_file_for_distance_calc(
+        tmp_vcf, numeric_filters={"GT_CONF": (True, 10)}
+    )
+    np.testing.assert_array_equal(got_genos, [2, 2, 0, 3, 0, 0])
+    assert got_counts == variant_counts.VariantCounts(
+        het=1, hom=2, null=2, het_to_hom=1
+    )
+    os.unlink(tmp_vcf)
+
+
 def test_load_vcf_files_for_distance_calc():
     filenames = [
         os.path.join(data_dir, f"load_vcf_files_for_distance_calc.{i}.vcf")
@@ -223,6 +291,26 @@ def test_load_vcf_files_for_distance_calc():
     ]
     check_got_equal_expect(got, expect)
 
+    # Using a cache should give the same results, whether or not the
+    # VCF files are already in the cache
+    cache_dir = "tmp.load_vcf_files_for_distance_calc.cache"
+    utils.rm_rf(cache_dir)
+    for i in range(2):
+        got = vcf.load_vcf_files_for_distance_calc(
+            filenames,
+            threads=2,
+            only_use_pass=False,
+            numeric_filters={"GT_CONF": (True, 12)},
+            het_to_hom_key="ignore",
+            mask_bed_file=os.path.join(
+                data_dir, "load_vcf_files_for_distance_calc.mask.bed"
+            ),
+            cache_dir=cache_dir,
+        )
+        check_got_equal_expect(got, expect)
+        assert len(os.listdir(cache_dir)) == 4
+    utils.rm_rf(cache_dir)
+
 
 def test_sample_name_from_vcf():
     good_file = os.path.join(data_dir, "sample_name_from_vcf.good.vcf")
@@ -7,11 +7,16 @@ except:
 
 
 __all__ = [
+    "distance_matrix",
     "distances",
+    "genotype_cache",
     "genotypes",
+    "knn_index",
     "phenotypes",
     "phenotype_compare",
     "sample_neighbours_finding",
+    "shared_array",
+    "site_index",
     "strain_triple",
     "strain_triples",
     "tasks",
@@ -26,6 +26,21 @@ def main(args=None):
     parser.add_argument("--version", action="version", version=triphecta.__version__)
     parser.add_argument("--debug", help="Debug mode", action="store_true")
     parser.add_argument("--triphenotops", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--gzip_level",
+        type=int,
+        choices=range(1, 10),
+        help="Compression level (1-9) of all gzipped output files [%(default)s]",
+        default=triphecta.utils.GZIP_WRITE_LEVEL,
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--gzip_threads",
+        type=int,
+        help="Number of threads used to write each gzipped output file. Needs pigz to be installed if more than 1 [%(default)s]",
+        default=triphecta.utils.GZIP_WRITE_THREADS,
+        metavar="INT",
+    )
 
     subparsers = parser.add_subparsers(title="Available commands", help="", metavar="")
 
@@ -53,28 +68,79 @@ def main(args=None):
 
     subparser_vcfs_to_names.set_defaults(func=triphecta.tasks.vcfs_to_names.run)
 
+    # ------------------------ site_index -------------------------------------
+    subparser_site_index = subparsers.add_parser(
+        "site_index",
+        help="Make site index file from a VCF file",
+        usage="triphecta site_index [options] <vcf_file> <outfile>",
+        description="Makes a site index file of the positions and alleles of the records of one VCF file, plus which records are masked. All the VCF files must have the same records, so any one of them can be used. 'distance_matrix' and 'triples' can use the site index instead of reading the mask and variant positions again",
+    )
+
+    subparser_site_index.add_argument(
+        "--mask_bed_file",
+        help="BED file of regions to mask (tab-delimited, 3 columns: ref_name start end, coords 0-based and end coord not included)",
+        metavar="FILENAME",
+    )
+
+    subparser_site_index.add_argument("vcf_file", help="Name of VCF file")
+    subparser_site_index.add_argument("outfile", help="Name of output file")
+
+    subparser_site_index.set_defaults(func=triphecta.tasks.site_index.run)
+
     # ----------------------- distance_matrix ---------------------------------
     subparser_distance_matrix = subparsers.add_parser(
         "distance_matrix",
         help="Make distance matrix from VCFs or from pairwise pre-made distance files",
-        usage="triphecta distance_matrix [options] <vcf|premade> <filenames_tsv> <out>",
-        description="Calculates distance between genomes using VCF files, or loads pre-made distances. Saves distance matrix in phylip format",
+        usage="triphecta distance_matrix [options] <vcf|premade|add> <filenames_tsv> <out>",
+        description="Calculates distance between genomes using VCF files, or loads pre-made distances, or adds new samples from VCF files to an existing distance matrix. Saves distance matrix in phylip format, and in a binary format that is faster for 'triples' to load",
     )
 
     subparser_distance_matrix.add_argument(
         "method",
-        choices=["vcf", "premade"],
-        help="Method to use. Either calculate from VCF files, or use pre-made distances",
+        choices=["vcf", "premade", "add"],
+        help="Method to use. Either calculate from VCF files, or use pre-made distances, or add samples to an existing matrix made by method vcf or add (see --existing_prefix)",
     )
 
     subparser_distance_matrix.add_argument(
         "filenames_tsv",
-        help="Name of input data TSV file. Must have 'sample' column, and either 'vcf_file' or 'distance_file' column, depending on method",
+        help="Name of input data TSV file. Must have 'sample' column, and either 'vcf_file' or 'distance_file' column, depending on method. If method=add, only has the new samples",
     )
 
     subparser_distance_matrix.add_argument(
         "out",
-        help="If method=vcf, prefix of output files. If method=premade, name of single output file",
+        help="If method=vcf or add, prefix of output files. If method=premade, name of output file (a binary copy of the matrix is also written to this name plus '.bin')",
+    )
+
+    subparser_distance_matrix.add_argument(
+        "--existing_prefix",
+        help="REQUIRED if method=add. Prefix of output files from a previous run of method=vcf or add. The new samples are added after the existing samples in the output matrix. Use the same VCF loading options as the previous run",
+        metavar="PREFIX",
+    )
+
+    subparser_distance_matrix.add_argument(
+        "--existing_vcfs_tsv",
+        help="REQUIRED if method=add. TSV file (with 'sample' and 'vcf_file' columns) of the VCF files of the samples in the existing matrix",
+        metavar="FILENAME",
+    )
+
+    subparser_distance_matrix.add_argument(
+        "--query",
+        help="Only allowed if method=vcf. TSV file (with 'sample' and 'vcf_file' columns) of query samples. Using this means only calculating the distances from each query sample to each sample in filenames_tsv, which are the reference samples. Writes a query x reference matrix of distances to out.query_distances.tsv.gz, instead of the full distance matrix",
+        metavar="FILENAME",
+    )
+
+    subparser_distance_matrix.add_argument(
+        "--top_k",
+        type=int,
+        help="Only allowed with --query. Instead of all query x reference distances, find the nearest INT reference samples to each query sample (plus any more that are tied with the INT-th nearest one). This is faster than calculating all the distances. Writes the neighbours to out.query_neighbours.tsv.gz",
+        metavar="INT",
+    )
+
+    subparser_distance_matrix.add_argument(
+        "--knn",
+        type=int,
+        help="Only allowed if method=vcf, and not with --query. Instead of the full distance matrix, find the nearest INT samples to each sample (plus any more that are tied with the INT-th nearest one). Writes them to a nearest neighbours index file out.knn_index.bin, which uses much less RAM and disk than the full matrix. 'triples' can use this file instead of a distance matrix, as long as its option --top_n_genos is at most INT",
+        metavar="INT",
     )
 
     subparser_distance_matrix.add_argument(
@@ -91,6 +157,12 @@ def main(args=None):
         metavar="FILENAME",
     )
 
+    subparser_distance_matrix.add_argument(
+        "--site_index",
+        help="Only used if method=vcf or add. Site index file made by 'triphecta site_index'. If used, the mask is taken from this file, instead of using --mask_bed_file",
+        metavar="FILENAME",
+    )
+
     subparser_distance_matrix.add_argument(
         "--vcf_ignore_filter_pass",
         action="store_true",
@@ -120,6 +192,18 @@ def main(args=None):
         metavar="FLOAT",
     )
 
+    subparser_distance_matrix.add_argument(
+        "--packed_genotypes",
+        action="store_true",
+        help="Only used if method=vcf or add. Store genotypes bit-packed when calculating distances. Each sample is packed as soon as it is loaded, so this uses much less RAM when most records have only one ALT allele. Distances are the same as without this option",
+    )
+
+    subparser_distance_matrix.add_argument(
+        "--genotype_cache",
+        help="Only used if method=vcf or add. Directory of cached genotypes loaded from VCF files (created if it does not exist). VCF files already in the cache, and loaded with the same options, are not parsed again",
+        metavar="DIRNAME",
+    )
+
     subparser_distance_matrix.set_defaults(func=triphecta.tasks.distance_matrix.run)
 
     # ------------------------------ tree -------------------------------------
@@ -173,7 +257,7 @@ def main(args=None):
         "find_cases",
         help="Find cases, by looking for samples matching certain phenotypes",
         usage="triphecta find_cases [options] <phenos.tsv> <pheno_constraints_json> <outfile>",
-        description="Find cases, by looking for samples matching certain phenotypes",
+        description="Find cases, by looking for samples matching certain phenotypes. Must use exactly one of --wanted_pheno or --wanted_phenos_tsv",
     )
 
     subparser_find_cases.set_defaults(func=triphecta.tasks.find_cases.run)
@@ -181,12 +265,17 @@ def main(args=None):
     subparser_find_cases.add_argument(
         "--wanted_pheno",
         "-w",
-        help="REQUIRED. Phenotype of interest and the value. eg: 'Drug_x,Resistant'. This option can be used more than once, and must be used at least once.",
+        help="Phenotype of interest and the value. eg: 'Drug_x,Resistant'. This option can be used more than once",
         action="append",
-        required=True,
         metavar="Drug,value",
     )
 
+    subparser_find_cases.add_argument(
+        "--wanted_phenos_tsv",
+        help="TSV file of sets of phenotypes of interest, to find the cases of many sets at once. Must have a column 'name', plus one column per phenotype. Each line is one set, with an empty value meaning that phenotype is not used. The cases of each set are written to the file outfile.name.txt",
+        metavar="FILENAME",
+    )
+
     subparser_find_cases.add_argument("phenos_tsv", help="Name of phenotypes TSV file")
 
     subparser_find_cases.add_argument(
@@ -195,7 +284,8 @@ def main(args=None):
     )
 
     subparser_find_cases.add_argument(
-        "outfile", help="Name of output file of sample names",
+        "outfile",
+        help="Name of output file of sample names. If --wanted_phenos_tsv is used, this is the prefix of the output files",
     )
 
     # ------------------------ triples ----------------------------------------
@@ -217,7 +307,7 @@ def main(args=None):
 
     subparser_triples.add_argument(
         "distance_matrix",
-        help="Name of distance matrix file, made by 'triphecta distance_matrix'",
+        help="Name of distance matrix file (phylip or binary format), or nearest neighbours index file (made using --knn), made by 'triphecta distance_matrix'",
     )
 
     subparser_triples.add_argument("phenos_tsv", help="Name of phenotypes TSV file")
@@ -249,6 +339,12 @@ def main(args=None):
         metavar="FILENAME",
     )
 
+    subparser_triples.add_argument(
+        "--site_index",
+        help="Site index file made by 'triphecta site_index'. If used, the variants and the mask are taken from this file, instead of reading the first VCF file and using --mask_bed_file",
+        metavar="FILENAME",
+    )
+
     subparser_triples.add_argument(
         "--top_n_genos",
         help="When finding triples, only consider closest n samples in terms of genetic distance [%(default)s]",
@@ -265,6 +361,19 @@ def main(args=None):
         default=1,
     )
 
+    subparser_triples.add_argument(
+        "--variants_format",
+        choices=triphecta.strain_triples.VARIANTS_OUTPUT_FORMATS,
+        help="Format of variants output. wide: out.variants.tsv has one column per triple. sparse: out.variants.tsv only has the frequency of each variant, and the triples that each variant is in are written to the long-format file out.variant_triples.tsv.gz and the bit-packed matrix out.variants_bitmap.npz. Use sparse when there are many triples [%(default)s]",
+        default="wide",
+    )
+
+    subparser_triples.add_argument(
+        "--skip_zero_freq",
+        action="store_true",
+        help="Do not write variants that are not of interest in any triple to the variants output files",
+    )
+
     subparser_triples.set_defaults(func=triphecta.tasks.triples.run)
 
     args = parser.parse_args()
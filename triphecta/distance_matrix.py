@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class DistanceMatrix:
+    """Symmetric matrix of distances between samples, with zero on the
+    diagonal. Only the upper triangle is stored, in a condensed 1D numpy
+    array (same layout as scipy.spatial.distance.squareform), where the
+    distance between samples i < j is at index n*i - i*(i+1)/2 + j - i - 1"""
+
+    def __init__(self, sample_count, dtype=np.float32, fill=0, data=None):
+        self.sample_count = sample_count
+        expect_length = sample_count * (sample_count - 1) // 2
+        if data is None:
+            self.data = np.full(expect_length, fill, dtype=dtype)
+        elif len(data) != expect_length:
+            raise RuntimeError(
+                f"Condensed distance matrix for {sample_count} samples must have length {expect_length}, but got {len(data)}"
+            )
+        else:
+            self.data = data
+
+    def __eq__(self, other):
+        return (
+            type(other) is type(self)
+            and self.sample_count == other.sample_count
+            and np.array_equal(self.data, other.data, equal_nan=True)
+        )
+
+    def __len__(self):
+        return self.sample_count
+
+    def _index(self, i, j):
+        if i == j:
+            raise IndexError(f"No stored distance between sample {i} and itself")
+        elif i > j:
+            i, j = j, i
+        if i < 0 or j >= self.sample_count:
+            raise IndexError(
+                f"Sample index out of range for {self.sample_count} samples: {(i, j)}"
+            )
+        return self.sample_count * i - i * (i + 1) // 2 + j - i - 1
+
+    def __getitem__(self, key):
+        i, j = key
+        if i == j:
+            return self.data.dtype.type(0)
+        return self.data[self._index(i, j)]
+
+    def __setitem__(self, key, value):
+        self.data[self._index(*key)] = value
+
+    def _lower_row_indexes(self, i):
+        """Returns array of the indexes in self.data of the distances from
+        sample i to samples 0, 1, ..., i - 1"""
+        others = np.arange(i, dtype=np.int64)
+        return self.sample_count * others - others * (others + 1) // 2 + i - others - 1
+
+    def row(self, i):
+        """Returns a new array of the distances from sample i to all the
+        samples (including zero for the distance to itself)"""
+        n = self.sample_count
+        row = np.zeros(n, dtype=self.data.dtype)
+        if i < n - 1:
+            start = self._index(i, i + 1)
+            row[i + 1 :] = self.data[start : start + n - i - 1]
+        row[:i] = self.data[self._lower_row_indexes(i)]
+        return row
+
+    def set_lower_row(self, i, distances):
+        """Sets the distances from sample i to samples 0, 1, ..., i - 1"""
+        if len(distances) != i:
+            raise RuntimeError(
+                f"Expected {i} distances for sample {i}, but got {len(distances)}"
+            )
+        self.data[self._lower_row_indexes(i)] = distances
+
+    @classmethod
+    def from_dict(cls, sample_count, distances, dtype=np.float32, fill=0):
+        """Makes a new DistanceMatrix from a dictionary of (i, j) -> distance"""
+        matrix = cls(sample_count, dtype=dtype, fill=fill)
+        for key, distance in distances.items():
+            matrix[key] = distance
+        return matrix
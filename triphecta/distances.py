@@ -1,28 +1,734 @@
+import collections
 import csv
-import itertools
+import json
 import logging
 import multiprocessing
+import os
 
 import numpy as np
 
-from triphecta import utils, variant_counts, vcf
+from triphecta import (
+    distance_matrix,
+    knn_index,
+    shared_array,
+    utils,
+    variant_counts,
+    vcf,
+)
 
-global vcf_data
+# Distances are calculated in square tiles of the distance matrix, with one
+# tile per task sent to the pool of workers. Within a tile, sites are
+# processed in chunks, which keeps the temporary arrays small and means the
+# float32 matrix products below are exact (each value is at most the chunk
+# size, which is much less than 2^24)
+TILE_SIZE = 256
+SITES_CHUNK_SIZE = 16384
 
-# This ended up here so multiprocessing works. vcf_data is a global variable,
-# so that no copies of it are made. It is likely to be huge. This function uses
-# it read-only, so is ok to have multiple processes all using it.
-def _dist_two_samples2(i, j):
-    global vcf_data
-    return (
-        i,
-        j,
-        np.sum(
-            vcf_data[i][0] * vcf_data[j][0] * (vcf_data[i][0] - vcf_data[j][0]) != 0
+# Distances between bit-packed genotypes use (rows x cols x bytes) temporary
+# arrays. Chunks of bytes are chosen so that these have at most this many
+# elements
+PACKED_CHUNK_ELEMENTS = 2**24
+
+# When finding the nearest neighbours of a sample, candidate neighbours are
+# processed in batches of this size. For each batch, distances are added up
+# one chunk of sites at a time, dropping candidates as soon as they are
+# further away than the current k-th nearest neighbour
+NEIGHBOURS_BATCH_SIZE = 512
+
+# Binary distance matrix files start with this, followed by the length of
+# a JSON header as a little-endian uint64, then the header (padded so that
+# the data is aligned), and then the raw condensed distance matrix
+BINARY_MAGIC = b"TRIPHDM1"
+BINARY_ALIGNMENT = 64
+
+# Bit-packed genotypes. ref and alt are samples x bytes arrays made by
+# np.packbits of the biallelic sites, where a bit is set if the sample has
+# the ref (or alt) allele. Genotypes at the multiallelic sites are kept in
+# the usual uint16 format in the samples x sites array multiallelic.
+PackedGenotypes = collections.namedtuple(
+    "PackedGenotypes", ["ref", "alt", "multiallelic"]
+)
+
+global genotype_matrix, shared_genotypes, vcf_loader, packed_multiallelic_sites
+
+
+def pack_genotypes(genos, multiallelic_sites):
+    """Returns PackedGenotypes made from genos (a samples x sites array, or
+    one sample's 1D array), where the boolean array multiallelic_sites marks
+    which sites can have more than one alt allele"""
+    biallelic = genos[..., ~multiallelic_sites]
+    if np.any(biallelic > 2):
+        raise RuntimeError(
+            "Found a genotype with more than one alt allele at a biallelic site. Cannot continue"
+        )
+    return PackedGenotypes(
+        ref=np.packbits(biallelic == 1, axis=-1),
+        alt=np.packbits(biallelic == 2, axis=-1),
+        multiallelic=genos[..., multiallelic_sites],
+    )
+
+
+def _map_genotypes(function, genos):
+    """Returns the result of applying function to genos, or to each of
+    the arrays in genos if it is PackedGenotypes"""
+    if isinstance(genos, PackedGenotypes):
+        return PackedGenotypes(*[function(x) for x in genos])
+    else:
+        return function(genos)
+
+
+def _share_genotypes(genos):
+    """Returns copy of genos (a numpy array or PackedGenotypes of arrays),
+    where each array is a SharedArray"""
+    return _map_genotypes(shared_array.SharedArray.from_array, genos)
+
+
+def _shared_genotypes_to_arrays(genos):
+    return _map_genotypes(lambda x: x.array, genos)
+
+
+def _unlink_genotypes(genos):
+    """Frees the shared memory used by genos, where each array in genos is
+    a SharedArray"""
+    _map_genotypes(lambda x: x.unlink(), genos)
+
+
+def _new_shared_packed_genotypes(sample_count, multiallelic_sites, dtype):
+    """Returns PackedGenotypes of empty SharedArrays, for sample_count
+    samples with the sites in the boolean array multiallelic_sites"""
+    multiallelic_count = np.count_nonzero(multiallelic_sites)
+    packed_bytes = (len(multiallelic_sites) - multiallelic_count + 7) // 8
+    return PackedGenotypes(
+        ref=shared_array.SharedArray((sample_count, packed_bytes), np.uint8),
+        alt=shared_array.SharedArray((sample_count, packed_bytes), np.uint8),
+        multiallelic=shared_array.SharedArray(
+            (sample_count, multiallelic_count), dtype
         ),
     )
 
 
+def _set_genotypes_row(genos, row_index, sample_genos, multiallelic_sites=None):
+    """Puts the 1D array sample_genos into row row_index of genos, which
+    is a samples x sites array, or PackedGenotypes with the layout given
+    by multiallelic_sites"""
+    if isinstance(genos, PackedGenotypes):
+        expect_sites = len(multiallelic_sites)
+    else:
+        expect_sites = genos.shape[1]
+    if len(sample_genos) != expect_sites:
+        raise RuntimeError(
+            "VCF files do not all have the same number of records. Cannot continue"
+        )
+    if isinstance(genos, PackedGenotypes):
+        packed_row = pack_genotypes(sample_genos, multiallelic_sites)
+        for array, row in zip(genos, packed_row):
+            array[row_index] = row
+    else:
+        genos[row_index] = sample_genos
+
+
+def _stack_genotypes(genos_list, packed=False):
+    """Returns all the 1D arrays of genotypes in genos_list stacked into
+    a samples x sites array, or into PackedGenotypes if packed is True.
+    The arrays are made in shared memory (ie each is a SharedArray), and so
+    must be freed using _unlink_genotypes()"""
+    if len({len(x) for x in genos_list}) > 1:
+        raise RuntimeError(
+            "VCF files do not all have the same number of records. Cannot continue"
+        )
+    sample_count = len(genos_list)
+    site_count = len(genos_list[0])
+    dtype = genos_list[0].dtype
+    if not packed:
+        genos = shared_array.SharedArray((sample_count, site_count), dtype)
+        np.stack(genos_list, out=genos.array)
+        return genos
+
+    multiallelic_sites = np.zeros(site_count, dtype=bool)
+    for genos in genos_list:
+        multiallelic_sites |= genos > 2
+    genos = _new_shared_packed_genotypes(sample_count, multiallelic_sites, dtype)
+    for i, sample_genos in enumerate(genos_list):
+        packed_row = pack_genotypes(sample_genos, multiallelic_sites)
+        for array, row in zip(genos, packed_row):
+            array.array[i] = row
+    return genos
+
+
+def _sample_count(genos):
+    if isinstance(genos, PackedGenotypes):
+        return genos.ref.shape[0]
+    else:
+        return genos.shape[0]
+
+
+def _wide_distances(rows, cols):
+    """Returns distances between each of the rows of the (samples x sites)
+    genotypes arrays rows and cols"""
+    dists = np.zeros((rows.shape[0], cols.shape[0]), dtype=np.uint32)
+
+    for start in range(0, rows.shape[1], SITES_CHUNK_SIZE):
+        row_genos = rows[:, start : start + SITES_CHUNK_SIZE]
+        col_genos = cols[:, start : start + SITES_CHUNK_SIZE]
+        # Count sites where both are called, then subtract the sites where
+        # both are called and have the same allele
+        row_called = (row_genos != 0).astype(np.float32)
+        col_called = (col_genos != 0).astype(np.float32)
+        tile_chunk = row_called @ col_called.T
+        max_allele = max(row_genos.max(initial=0), col_genos.max(initial=0))
+        for allele in range(1, max_allele + 1):
+            row_allele = (row_genos == allele).astype(np.float32)
+            col_allele = (col_genos == allele).astype(np.float32)
+            tile_chunk -= row_allele @ col_allele.T
+        dists += tile_chunk.astype(np.uint32)
+
+    return dists
+
+
+def _packed_distances(rows, cols):
+    """Same as _wide_distances, but rows and cols are PackedGenotypes.
+    At biallelic sites, the genotypes are different and both called when
+    one sample is ref and the other is alt"""
+    dists = _wide_distances(rows.multiallelic, cols.multiallelic)
+    pairs = rows.ref.shape[0] * cols.ref.shape[0]
+    bytes_chunk_size = max(
+        1, min(SITES_CHUNK_SIZE // 8, PACKED_CHUNK_ELEMENTS // max(1, pairs))
+    )
+
+    for start in range(0, rows.ref.shape[1], bytes_chunk_size):
+        end = start + bytes_chunk_size
+        row_ref = rows.ref[:, np.newaxis, start:end]
+        row_alt = rows.alt[:, np.newaxis, start:end]
+        col_ref = cols.ref[np.newaxis, :, start:end]
+        col_alt = cols.alt[np.newaxis, :, start:end]
+        diffs = (row_ref & col_alt) | (row_alt & col_ref)
+        dists += utils.popcount(diffs).sum(axis=2, dtype=np.uint32)
+
+    return dists
+
+
+def _init_distance_worker(shared_genos, loader=None, multiallelic_sites=None):
+    """Initializer for the pool of workers in _all_vs_all_distances and
+    _load_genotypes_and_distances. shared_genos has the genotypes in shared
+    memory. Attaching to it here means that each worker uses the same
+    memory, instead of a copy. loader is the function used to load a VCF
+    file, made by vcf.make_distance_calc_loader. multiallelic_sites is the
+    layout of shared_genos if it is PackedGenotypes"""
+    global genotype_matrix, shared_genotypes, vcf_loader, packed_multiallelic_sites
+    shared_genotypes = shared_genos
+    genotype_matrix = _shared_genotypes_to_arrays(shared_genos)
+    vcf_loader = loader
+    packed_multiallelic_sites = multiallelic_sites
+
+
+def _load_genotypes_row(row_index, vcf_file):
+    """Loads the VCF file and puts its genotypes into row row_index of the
+    global genotype_matrix, packing them first if it is PackedGenotypes.
+    Returns the VariantCounts of the VCF file"""
+    global genotype_matrix, vcf_loader, packed_multiallelic_sites
+    genos, var_counts = vcf_loader(vcf_file)
+    _set_genotypes_row(genotype_matrix, row_index, genos, packed_multiallelic_sites)
+    return var_counts
+
+
+# This ended up here so multiprocessing works. genotype_matrix is a global
+# variable, set by _init_distance_worker, pointing to the genotypes in shared
+# memory. It is likely to be huge. This function uses it read-only, so is ok
+# to have multiple processes all using it.
+def _distance_tile(tile):
+    """Returns the distances for one tile of the distance matrix.
+    tile = (row_start, row_end, col_start, col_end), where rows and columns
+    are indexes of samples in the global genotype_matrix. Returns tuple:
+    (row_start, col_start, 2D array of distances). Distance is the number of
+    sites where both samples have a called genotype, and they are different"""
+    global genotype_matrix
+    row_start, row_end, col_start, col_end = tile
+    rows = _map_genotypes(lambda x: x[row_start:row_end], genotype_matrix)
+    cols = _map_genotypes(lambda x: x[col_start:col_end], genotype_matrix)
+    return row_start, col_start, _distances(rows, cols)
+
+
+def _distances(rows, cols):
+    """Returns distances between each of the samples in rows and cols,
+    which are both samples x sites arrays, or both PackedGenotypes"""
+    if isinstance(rows, PackedGenotypes):
+        return _packed_distances(rows, cols)
+    else:
+        return _wide_distances(rows, cols)
+
+
+def _site_chunks(genos):
+    """Yields genos split into chunks of sites, where genos is a samples x
+    sites array, or PackedGenotypes. The chunks are views, not copies"""
+    if not isinstance(genos, PackedGenotypes):
+        for start in range(0, genos.shape[1], SITES_CHUNK_SIZE):
+            yield genos[:, start : start + SITES_CHUNK_SIZE]
+        return
+
+    no_ref_alt = genos.ref[:, :0]
+    for start in range(0, genos.multiallelic.shape[1], SITES_CHUNK_SIZE):
+        end = start + SITES_CHUNK_SIZE
+        yield PackedGenotypes(no_ref_alt, no_ref_alt, genos.multiallelic[:, start:end])
+    bytes_chunk_size = max(1, SITES_CHUNK_SIZE // 8)
+    no_multiallelic = genos.multiallelic[:, :0]
+    for start in range(0, genos.ref.shape[1], bytes_chunk_size):
+        end = start + bytes_chunk_size
+        yield PackedGenotypes(
+            genos.ref[:, start:end], genos.alt[:, start:end], no_multiallelic
+        )
+
+
+def _select_samples(genos, indexes):
+    """Returns the samples in genos (samples x sites array, or
+    PackedGenotypes) with the given sorted indexes. Returns a view instead
+    of a copy if the indexes are consecutive"""
+    if len(indexes) > 0 and indexes[-1] - indexes[0] + 1 == len(indexes):
+        return _map_genotypes(lambda x: x[indexes[0] : indexes[-1] + 1], genos)
+    else:
+        return _map_genotypes(lambda x: x[indexes], genos)
+
+
+def _nearest_neighbours(task):
+    """Finds the nearest neighbours of some samples in the global
+    genotype_matrix. task = (queries, candidate_start, candidate_end, k),
+    where queries is a sorted list of sample indexes. The candidate
+    neighbours of each query are the samples with indexes in
+    [candidate_start, candidate_end), not including the query itself.
+    Returns a list of tuples, one per query: (query, array of neighbour
+    indexes, array of distances), sorted by distance then index. Has the k
+    nearest neighbours, plus any more that have the same distance as the
+    k-th nearest one.
+
+    Distances only get bigger as more sites are added up, which is used to
+    avoid calculating most of the distances:
+    1. Add up the distances to all candidates using only the first chunk
+       of sites.
+    2. For each query, calculate the exact distances to the k candidates
+       that are closest in the first chunk. The largest of these is an
+       upper bound on the distance to the k-th nearest neighbour.
+    3. For each batch of candidates, continue adding up distances one chunk
+       of sites at a time. A candidate is dropped as soon as its distance
+       is more than the upper bound of every query in this task. The bounds
+       are lowered as closer neighbours are found"""
+    global genotype_matrix
+    queries, candidate_start, candidate_end, k = task
+    queries = np.array(queries, dtype=np.int64)
+    candidates = np.arange(candidate_start, candidate_end, dtype=np.int64)
+    chunks = list(_site_chunks(genotype_matrix))
+    query_chunks = [_select_samples(x, queries) for x in chunks]
+    batches = [
+        np.arange(i, min(i + NEIGHBOURS_BATCH_SIZE, len(candidates)))
+        for i in range(0, len(candidates), NEIGHBOURS_BATCH_SIZE)
+    ]
+    no_bound = np.iinfo(np.uint32).max
+    is_self = queries[:, None] == candidates[None, :]
+
+    first_chunk_dists = np.zeros((len(queries), len(candidates)), dtype=np.uint32)
+    if len(chunks) > 0:
+        for batch in batches:
+            first_chunk_dists[:, batch] = _distances(
+                query_chunks[0], _select_samples(chunks[0], candidates[batch])
+            )
+    first_chunk_dists[is_self] = no_bound
+
+    max_dists = np.full(len(queries), no_bound, dtype=np.uint32)
+    if len(candidates) > k:
+        seeds = np.argpartition(first_chunk_dists, k - 1, axis=1)[:, :k]
+        seed_candidates, seed_columns = np.unique(seeds, return_inverse=True)
+        seed_dists = np.zeros((len(queries), len(seed_candidates)), dtype=np.uint32)
+        for start in range(0, len(seed_candidates), NEIGHBOURS_BATCH_SIZE):
+            end = start + NEIGHBOURS_BATCH_SIZE
+            seed_dists[:, start:end] = _distances(
+                _select_samples(genotype_matrix, queries),
+                _select_samples(
+                    genotype_matrix, candidates[seed_candidates[start:end]]
+                ),
+            )
+        seed_dists = np.take_along_axis(
+            seed_dists, seed_columns.reshape(seeds.shape), axis=1
+        )
+        max_dists = seed_dists.max(axis=1).astype(np.uint32)
+
+    best = [np.zeros(0, dtype=np.int64) for _ in queries]
+    best_dists = [np.zeros(0, dtype=np.uint32) for _ in queries]
+    for batch in batches:
+        batch_dists = first_chunk_dists[:, batch]
+        for query_chunk, chunk in zip(query_chunks[1:], chunks[1:]):
+            keep = np.any(batch_dists <= max_dists[:, None], axis=0)
+            batch = batch[keep]
+            batch_dists = batch_dists[:, keep]
+            if len(batch) == 0:
+                break
+            batch_dists += _distances(
+                query_chunk, _select_samples(chunk, candidates[batch])
+            )
+
+        for i in range(len(queries)):
+            keep = (batch_dists[i] <= max_dists[i]) & ~is_self[i, batch]
+            best[i] = np.concatenate([best[i], candidates[batch[keep]]])
+            best_dists[i] = np.concatenate([best_dists[i], batch_dists[i][keep]])
+            if len(best[i]) >= k:
+                max_dists[i] = np.partition(best_dists[i], k - 1)[k - 1]
+                keep = best_dists[i] <= max_dists[i]
+                best[i] = best[i][keep]
+                best_dists[i] = best_dists[i][keep]
+
+    results = []
+    for query, indexes, dists in zip(queries, best, best_dists):
+        order = np.lexsort((indexes, dists))
+        results.append((query, indexes[order], dists[order]))
+    return results
+
+
+def _run_nearest_neighbours(
+    shared_genos, queries, candidate_start, candidate_end, k, threads=1
+):
+    """Finds the nearest neighbours of each sample in queries, using
+    _nearest_neighbours with <threads> processes. Returns a list of tuples
+    (array of neighbour indexes, array of distances), one per query"""
+    if k < 1:
+        raise RuntimeError(f"Number of nearest neighbours must be at least 1. Got {k}")
+    queries = list(queries)
+    # Each task has a block of queries, so that each batch of candidates is
+    # compared to all the queries in one go
+    block_size = max(1, min(TILE_SIZE, -(-len(queries) // threads)))
+    tasks = [
+        (sorted(queries[i : i + block_size]), candidate_start, candidate_end, k)
+        for i in range(0, len(queries), block_size)
+    ]
+    neighbours = {}
+    with multiprocessing.Pool(
+        processes=threads,
+        initializer=_init_distance_worker,
+        initargs=(shared_genos,),
+    ) as p:
+        for results in p.imap_unordered(_nearest_neighbours, tasks):
+            for query, indexes, dists in results:
+                neighbours[query] = (indexes, dists)
+    return [neighbours[q] for q in queries]
+
+
+def _upper_triangle_tiles(sample_count, tile_size, first_col=0):
+    """Yields the tiles needed to calculate the distance between each pair
+    of samples i < j, where j >= first_col"""
+    for row_start in range(0, sample_count, tile_size):
+        row_end = min(row_start + tile_size, sample_count)
+        for col_start in range(first_col, sample_count, tile_size):
+            col_end = min(col_start + tile_size, sample_count)
+            if col_end - 1 > row_start:
+                yield row_start, row_end, col_start, col_end
+
+
+def _all_vs_all_distances(genos, threads=1, tile_size=TILE_SIZE, existing=None):
+    """Calculates distances between all pairs of samples in genos (either
+    a samples x sites array, or PackedGenotypes), using <threads> processes,
+    each calculating one tile of the matrix at a time. Returns a DistanceMatrix.
+    The arrays in genos can be SharedArrays, otherwise they are temporarily
+    copied into shared memory for the workers to use.
+    If existing is a DistanceMatrix of the first k samples, then its
+    distances are reused and only the distances to the remaining samples
+    are calculated"""
+    if isinstance(genos, PackedGenotypes):
+        is_shared = isinstance(genos.ref, shared_array.SharedArray)
+    else:
+        is_shared = isinstance(genos, shared_array.SharedArray)
+    if is_shared:
+        shared_genos = genos
+    else:
+        shared_genos = _share_genotypes(genos)
+
+    try:
+        return _all_vs_all_shared_distances(
+            shared_genos, threads=threads, tile_size=tile_size, existing=existing
+        )
+    finally:
+        if not is_shared:
+            _unlink_genotypes(shared_genos)
+
+
+def _new_distances(sample_count, existing=None):
+    """Returns a new DistanceMatrix for sample_count samples. If existing is
+    a DistanceMatrix of the first k samples, then its distances are copied"""
+    dists = distance_matrix.DistanceMatrix(sample_count, dtype=np.uint32)
+    if existing is not None:
+        first_new = existing.sample_count
+        for i in range(first_new - 1):
+            old_start = existing._index(i, i + 1)
+            new_start = dists._index(i, i + 1)
+            length = first_new - i - 1
+            dists.data[new_start : new_start + length] = existing.data[
+                old_start : old_start + length
+            ]
+    return dists
+
+
+def _add_tile_to_distances(dists, tile_result):
+    """Puts the distances returned by _distance_tile into the DistanceMatrix
+    dists"""
+    row_start, col_start, tile_dists = tile_result
+    col_end = col_start + tile_dists.shape[1]
+    # The part of each row of the tile that is in the upper triangle
+    # is contiguous in the condensed matrix
+    for i, row in enumerate(tile_dists, start=row_start):
+        first_col = max(col_start, i + 1)
+        if first_col < col_end:
+            start = dists._index(i, first_col)
+            dists.data[start : start + col_end - first_col] = row[
+                first_col - col_start :
+            ]
+
+
+def _run_tiles(shared_genos, tiles, tile_callback, threads=1):
+    """Calculates the distances for each tile in tiles, using the genotypes
+    shared_genos (made by _share_genotypes or _stack_genotypes) and
+    <threads> processes. Calls tile_callback with each result of
+    _distance_tile"""
+    with multiprocessing.Pool(
+        processes=threads,
+        initializer=_init_distance_worker,
+        initargs=(shared_genos,),
+    ) as p:
+        for tile_result in p.imap_unordered(_distance_tile, tiles):
+            tile_callback(tile_result)
+
+
+def _all_vs_all_shared_distances(shared_genos, threads, tile_size, existing):
+    sample_count = _sample_count(_shared_genotypes_to_arrays(shared_genos))
+    dists = _new_distances(sample_count, existing)
+    first_new = 0 if existing is None else existing.sample_count
+    _run_tiles(
+        shared_genos,
+        _upper_triangle_tiles(sample_count, tile_size, first_new),
+        lambda x: _add_tile_to_distances(dists, x),
+        threads=threads,
+    )
+    return dists
+
+
+def _load_shared_genotypes(
+    vcf_files,
+    threads=1,
+    packed_genotypes=False,
+    tiles=None,
+    tile_callback=None,
+    **load_options,
+):
+    """Loads genotypes from the VCF files. Returns tuple: (genotypes, list
+    of VariantCounts), where the genotypes are in shared memory and must
+    be freed using _unlink_genotypes(). load_options are passed to
+    vcf.make_distance_calc_loader. If tiles is given, then the distances
+    for each tile are calculated while loading, calling tile_callback with
+    each result of _distance_tile.
+
+    The first VCF file is loaded here, to get the number of sites. Then
+    the rest are loaded by the pool of workers, which put the genotypes
+    straight into a matrix in shared memory, and only send back the
+    variant counts. A tile is calculated as soon as all of its samples are
+    loaded, by the same pool of workers. Loading is in the order of
+    vcf_files, so tiles are calculated sooner if their samples are near
+    the start of the list.
+
+    If packed_genotypes is True, each sample is packed as soon as it is
+    loaded, so the unpacked genotypes of all the samples are never in
+    memory. The multiallelic sites (see PackedGenotypes) are the records
+    with more than one ALT allele, found using the first VCF file or the
+    site index file"""
+    logging.info(f"Getting genotypes from {len(vcf_files)} VCF files")
+    loader = vcf.make_distance_calc_loader(vcf_files, **load_options)
+    first_genos, first_var_counts = loader(vcf_files[0])
+    sample_count = len(vcf_files)
+    if packed_genotypes:
+        multiallelic_sites = vcf.multiallelic_sites_for_distance_calc(
+            vcf_files,
+            mask_bed_file=load_options.get("mask_bed_file"),
+            site_index_file=load_options.get("site_index_file"),
+        )
+        genos = _new_shared_packed_genotypes(
+            sample_count, multiallelic_sites, first_genos.dtype
+        )
+    else:
+        multiallelic_sites = None
+        genos = shared_array.SharedArray(
+            (sample_count, len(first_genos)), first_genos.dtype
+        )
+    try:
+        _set_genotypes_row(
+            _shared_genotypes_to_arrays(genos), 0, first_genos, multiallelic_sites
+        )
+    except:
+        _unlink_genotypes(genos)
+        raise
+    del first_genos
+    var_counts = [first_var_counts] + [None] * (sample_count - 1)
+    tiles = [] if tiles is None else sorted(tiles, key=lambda x: max(x[1], x[3]))
+    tile_errors = []
+
+    try:
+        with multiprocessing.Pool(
+            processes=threads,
+            initializer=_init_distance_worker,
+            initargs=(genos, loader, multiallelic_sites),
+        ) as p:
+            # Only have a few VCF files queued at once, so that tiles can
+            # be calculated while the remaining files are loading
+            loading = {}
+            next_to_load = 1
+            loaded = 1
+            next_tile = 0
+            while loaded < sample_count or next_tile < len(tiles):
+                while next_to_load < sample_count and len(loading) < threads:
+                    loading[next_to_load] = p.apply_async(
+                        _load_genotypes_row, (next_to_load, vcf_files[next_to_load])
+                    )
+                    next_to_load += 1
+
+                if loaded < sample_count:
+                    var_counts[loaded] = loading.pop(loaded).get()
+                    loaded += 1
+                    if loaded % 1000 == 0:
+                        logging.info(f"Loaded {loaded} VCF files")
+
+                while next_tile < len(tiles) and max(tiles[next_tile][1::2]) <= loaded:
+                    p.apply_async(
+                        _distance_tile,
+                        (tiles[next_tile],),
+                        callback=tile_callback,
+                        error_callback=tile_errors.append,
+                    )
+                    next_tile += 1
+
+            p.close()
+            p.join()
+
+        if len(tile_errors):
+            raise tile_errors[0]
+        logging.info("Finished loading genotypes")
+    except:
+        _unlink_genotypes(genos)
+        raise
+
+    return genos, var_counts
+
+
+def _load_genotypes_and_run_tiles(
+    vcf_files, tiles, tile_callback, threads=1, packed_genotypes=False, **load_options
+):
+    """Loads genotypes from the VCF files, calculates the distances for each
+    tile in tiles, and calls tile_callback with each result of _distance_tile.
+    Returns a list of VariantCounts, one per VCF file. load_options are
+    passed to vcf.make_distance_calc_loader. The tiles are calculated while
+    loading (see _load_shared_genotypes)"""
+    genos, var_counts = _load_shared_genotypes(
+        vcf_files,
+        threads=threads,
+        packed_genotypes=packed_genotypes,
+        tiles=tiles,
+        tile_callback=tile_callback,
+        **load_options,
+    )
+    _unlink_genotypes(genos)
+
+    logging.info("Finished calculating distances")
+    return var_counts
+
+
+def _load_genotypes_and_distances(
+    vcf_files,
+    threads=1,
+    packed_genotypes=False,
+    existing=None,
+    tile_size=TILE_SIZE,
+    **load_options,
+):
+    """Loads genotypes from the VCF files and calculates the distances
+    between all pairs of samples. Returns tuple: (DistanceMatrix, list of
+    VariantCounts). load_options are passed to vcf.make_distance_calc_loader.
+    existing is the same as for _all_vs_all_distances"""
+    sample_count = len(vcf_files)
+    dists = _new_distances(sample_count, existing)
+    first_new = 0 if existing is None else existing.sample_count
+    var_counts = _load_genotypes_and_run_tiles(
+        vcf_files,
+        list(_upper_triangle_tiles(sample_count, tile_size, first_new)),
+        lambda x: _add_tile_to_distances(dists, x),
+        threads=threads,
+        packed_genotypes=packed_genotypes,
+        **load_options,
+    )
+    return dists, var_counts
+
+
+def _rectangle_tiles(row_start, row_end, col_start, col_end, tile_size):
+    """Yields the tiles that cover the rows and columns in the ranges
+    [row_start, row_end) and [col_start, col_end)"""
+    for tile_row_start in range(row_start, row_end, tile_size):
+        tile_row_end = min(tile_row_start + tile_size, row_end)
+        for tile_col_start in range(col_start, col_end, tile_size):
+            tile_col_end = min(tile_col_start + tile_size, col_end)
+            yield tile_row_start, tile_row_end, tile_col_start, tile_col_end
+
+
+def _load_genotypes_and_query_distances(
+    query_vcf_files,
+    reference_vcf_files,
+    threads=1,
+    packed_genotypes=False,
+    tile_size=TILE_SIZE,
+    **load_options,
+):
+    """Loads genotypes from the VCF files and calculates the distance from
+    each query sample to each reference sample. Returns tuple:
+    (queries x references numpy array of distances, list of VariantCounts
+    of the query samples, list of VariantCounts of the reference samples).
+    load_options are passed to vcf.make_distance_calc_loader"""
+    query_count = len(query_vcf_files)
+    dists = np.zeros((query_count, len(reference_vcf_files)), dtype=np.uint32)
+
+    def add_tile(tile_result):
+        row_start, col_start, tile_dists = tile_result
+        col_start -= query_count
+        dists[
+            row_start : row_start + tile_dists.shape[0],
+            col_start : col_start + tile_dists.shape[1],
+        ] = tile_dists
+
+    # Queries first, so that each tile can be calculated as soon as its
+    # reference samples are loaded
+    vcf_files = list(query_vcf_files) + list(reference_vcf_files)
+    tiles = _rectangle_tiles(0, query_count, query_count, len(vcf_files), tile_size)
+    var_counts = _load_genotypes_and_run_tiles(
+        vcf_files,
+        list(tiles),
+        add_tile,
+        threads=threads,
+        packed_genotypes=packed_genotypes,
+        **load_options,
+    )
+    return dists, var_counts[:query_count], var_counts[query_count:]
+
+
+def _write_distances_and_variant_counts(
+    outprefix, sample_names, dists, var_counts, gzip_level=None, gzip_threads=None
+):
+    matrix_file = f"{outprefix}.distance_matrix.txt.gz"
+    write_distance_matrix_file(
+        sample_names,
+        dists,
+        matrix_file,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
+    )
+    logging.info(f"Saved distance matrix to file {matrix_file}")
+    binary_matrix_file = f"{outprefix}.distance_matrix.bin"
+    write_binary_distance_matrix_file(sample_names, dists, binary_matrix_file)
+    logging.info(f"Saved binary distance matrix to file {binary_matrix_file}")
+    var_counts_file = f"{outprefix}.variant_counts.tsv.gz"
+    variant_counts.save_variant_count_list_to_tsv(
+        var_counts, var_counts_file, gzip_level=gzip_level, gzip_threads=gzip_threads
+    )
+    logging.info(f"Saved variant counts file {var_counts_file}")
+
+
 def distances_between_vcf_files(
     vcf_names_tsv,
     outprefix,
@@ -32,6 +738,11 @@ def distances_between_vcf_files(
     het_to_hom_key="COV",
     het_to_hom_min_pc_depth=90.0,
     mask_bed_file=None,
+    site_index_file=None,
+    packed_genotypes=False,
+    genotype_cache_dir=None,
+    gzip_level=None,
+    gzip_threads=None,
 ):
     logging.info(f"Loading file of VCF filenames {vcf_names_tsv}")
     filenames = utils.load_file_of_vcf_filenames(
@@ -40,40 +751,347 @@ def distances_between_vcf_files(
     sample_names, vcf_files = zip(*sorted(filenames.items()))
     sample_names = list(sample_names)
     logging.info(f"Found {len(filenames)} VCF files to load")
-    logging.info("Getting genotypes from VCF files")
-
-    global vcf_data
-    vcf_data = vcf.load_vcf_files_for_distance_calc(
+    dists, var_counts = _load_genotypes_and_distances(
         vcf_files,
         threads=threads,
+        packed_genotypes=packed_genotypes,
         only_use_pass=only_use_pass,
         numeric_filters=numeric_filters,
         het_to_hom_key=het_to_hom_key,
         het_to_hom_min_pc_depth=het_to_hom_min_pc_depth,
         mask_bed_file=mask_bed_file,
+        site_index_file=site_index_file,
+        cache_dir=genotype_cache_dir,
+    )
+    _write_distances_and_variant_counts(
+        outprefix,
+        sample_names,
+        dists,
+        var_counts,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
     )
-    logging.info("Finished loading genotypes. Calculating distance matrix")
+    return sample_names, dists, var_counts
 
-    with multiprocessing.Pool(processes=threads) as p:
-        distance_list = p.starmap(
-            _dist_two_samples2, itertools.combinations(range(len(vcf_files)), 2)
-        )
 
-    var_counts = [x[1] for x in vcf_data]
-    dists = {}
-    for i, j, dist in distance_list:
-        dists[tuple(sorted([i, j]))] = dist
+def knn_index_between_vcf_files(
+    vcf_names_tsv,
+    outprefix,
+    k,
+    threads=1,
+    only_use_pass=True,
+    numeric_filters=None,
+    het_to_hom_key="COV",
+    het_to_hom_min_pc_depth=90.0,
+    mask_bed_file=None,
+    site_index_file=None,
+    packed_genotypes=False,
+    genotype_cache_dir=None,
+    gzip_level=None,
+    gzip_threads=None,
+):
+    """Finds the k nearest neighbours of each sample (see _nearest_neighbours),
+    instead of the full distance matrix. Writes a KnnIndex to
+    outprefix.knn_index.bin and the variant counts to
+    outprefix.variant_counts.tsv.gz. Returns tuple: (sample names, KnnIndex,
+    list of VariantCounts)"""
+    logging.info(f"Loading file of VCF filenames {vcf_names_tsv}")
+    filenames = utils.load_file_of_vcf_filenames(
+        vcf_names_tsv, check_vcf_files_exist=False
+    )
+    sample_names, vcf_files = zip(*sorted(filenames.items()))
+    sample_names = list(sample_names)
+    logging.info(f"Found {len(filenames)} VCF files to load")
+    genos, var_counts = _load_shared_genotypes(
+        vcf_files,
+        threads=threads,
+        packed_genotypes=packed_genotypes,
+        only_use_pass=only_use_pass,
+        numeric_filters=numeric_filters,
+        het_to_hom_key=het_to_hom_key,
+        het_to_hom_min_pc_depth=het_to_hom_min_pc_depth,
+        mask_bed_file=mask_bed_file,
+        site_index_file=site_index_file,
+        cache_dir=genotype_cache_dir,
+    )
+    logging.info(f"Finding {k} nearest neighbours of each sample")
+    try:
+        neighbours = _run_nearest_neighbours(
+            genos, range(len(sample_names)), 0, len(sample_names), k, threads=threads
+        )
+    finally:
+        _unlink_genotypes(genos)
+    logging.info("Finished finding nearest neighbours")
 
-    logging.info("Finished calculating distance matrix")
-    matrix_file = f"{outprefix}.distance_matrix.txt.gz"
-    write_distance_matrix_file(sample_names, dists, matrix_file)
-    logging.info(f"Saved distance matrix to file {matrix_file}")
+    index = knn_index.KnnIndex.from_neighbours(sample_names, k, neighbours)
+    index_file = f"{outprefix}.knn_index.bin"
+    index.save(index_file)
+    logging.info(f"Saved nearest neighbours index to file {index_file}")
     var_counts_file = f"{outprefix}.variant_counts.tsv.gz"
-    variant_counts.save_variant_count_list_to_tsv(var_counts, var_counts_file)
+    variant_counts.save_variant_count_list_to_tsv(
+        var_counts, var_counts_file, gzip_level=gzip_level, gzip_threads=gzip_threads
+    )
     logging.info(f"Saved variant counts file {var_counts_file}")
+    return sample_names, index, var_counts
+
+
+def add_samples_to_distances(
+    existing_prefix,
+    existing_vcf_names_tsv,
+    new_vcf_names_tsv,
+    outprefix,
+    threads=1,
+    only_use_pass=True,
+    numeric_filters=None,
+    het_to_hom_key="COV",
+    het_to_hom_min_pc_depth=90.0,
+    mask_bed_file=None,
+    site_index_file=None,
+    packed_genotypes=False,
+    genotype_cache_dir=None,
+    gzip_level=None,
+    gzip_threads=None,
+):
+    """Adds new samples to the distance matrix and variant counts files made
+    by distances_between_vcf_files (or by this function) using outprefix
+    existing_prefix. Only distances involving the new samples are calculated.
+    The loading options must be the same as used to make the existing files.
+    The new samples are added after the existing samples, in sorted order"""
+    binary_matrix_file = f"{existing_prefix}.distance_matrix.bin"
+    if os.path.exists(binary_matrix_file):
+        matrix_file = binary_matrix_file
+    else:
+        matrix_file = f"{existing_prefix}.distance_matrix.txt.gz"
+    logging.info(f"Loading existing distance matrix {matrix_file}")
+    old_names, old_dists = load_distance_matrix_file(matrix_file)
+    if not np.array_equal(old_dists.data, np.round(old_dists.data)):
+        raise RuntimeError(
+            f"Distances in {matrix_file} are not all integers, so the file was not made from VCF files. Cannot continue"
+        )
+    old_dists = distance_matrix.DistanceMatrix(
+        len(old_names), data=old_dists.data.astype(np.uint32)
+    )
+    old_var_counts = variant_counts.load_variant_count_list_from_tsv(
+        f"{existing_prefix}.variant_counts.tsv.gz"
+    )
+    if len(old_var_counts) != len(old_names):
+        raise RuntimeError(
+            f"Mismatch in number of samples in distance matrix ({len(old_names)}) and variant counts ({len(old_var_counts)}) of existing files {existing_prefix}.*. Cannot continue"
+        )
+
+    old_filenames = utils.load_file_of_vcf_filenames(
+        existing_vcf_names_tsv, check_vcf_files_exist=False
+    )
+    missing = [x for x in old_names if x not in old_filenames]
+    if len(missing):
+        raise RuntimeError(
+            f"{len(missing)} samples in existing distance matrix not found in file of VCF filenames {existing_vcf_names_tsv}. First one is '{missing[0]}'. Cannot continue"
+        )
+    new_filenames = utils.load_file_of_vcf_filenames(
+        new_vcf_names_tsv, check_vcf_files_exist=False
+    )
+    already_there = sorted(set(new_filenames).intersection(old_names))
+    if len(already_there):
+        raise RuntimeError(
+            f"{len(already_there)} new samples are already in the existing distance matrix. First one is '{already_there[0]}'. Cannot continue"
+        )
+    new_names = sorted(new_filenames)
+    logging.info(
+        f"Adding {len(new_names)} new samples to {len(old_names)} existing samples"
+    )
+
+    sample_names = old_names + new_names
+    vcf_files = [old_filenames[x] for x in old_names]
+    vcf_files.extend([new_filenames[x] for x in new_names])
+    dists, var_counts = _load_genotypes_and_distances(
+        vcf_files,
+        threads=threads,
+        packed_genotypes=packed_genotypes,
+        existing=old_dists,
+        only_use_pass=only_use_pass,
+        numeric_filters=numeric_filters,
+        het_to_hom_key=het_to_hom_key,
+        het_to_hom_min_pc_depth=het_to_hom_min_pc_depth,
+        mask_bed_file=mask_bed_file,
+        site_index_file=site_index_file,
+        cache_dir=genotype_cache_dir,
+    )
+    if var_counts[: len(old_names)] != old_var_counts:
+        raise RuntimeError(
+            "Variant counts of existing samples have changed. Are the VCF files or the options used to load them different from the original run? Cannot continue"
+        )
+    _write_distances_and_variant_counts(
+        outprefix,
+        sample_names,
+        dists,
+        var_counts,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
+    )
     return sample_names, dists, var_counts
 
 
+def _load_query_and_reference_filenames(query_vcf_names_tsv, reference_vcf_names_tsv):
+    """Returns tuple: (query sample names, query VCF files, reference sample
+    names, reference VCF files), where each list is sorted by sample name"""
+    logging.info("Loading files of VCF filenames")
+    names_and_files = []
+    for filename in query_vcf_names_tsv, reference_vcf_names_tsv:
+        vcf_filenames = utils.load_file_of_vcf_filenames(
+            filename, check_vcf_files_exist=False
+        )
+        names, vcf_files = zip(*sorted(vcf_filenames.items()))
+        names_and_files.extend([list(names), list(vcf_files)])
+    return names_and_files
+
+
+def query_distances_between_vcf_files(
+    query_vcf_names_tsv,
+    reference_vcf_names_tsv,
+    outprefix,
+    threads=1,
+    only_use_pass=True,
+    numeric_filters=None,
+    het_to_hom_key="COV",
+    het_to_hom_min_pc_depth=90.0,
+    mask_bed_file=None,
+    site_index_file=None,
+    packed_genotypes=False,
+    genotype_cache_dir=None,
+    gzip_level=None,
+    gzip_threads=None,
+):
+    """Calculates the distance from each query sample to each reference
+    sample, but not between query samples or between reference samples.
+    Writes the query x reference distances to outprefix.query_distances.tsv.gz
+    and the query variant counts to outprefix.query_variant_counts.tsv.gz.
+    Returns tuple: (query names, reference names, numpy array of distances,
+    list of query VariantCounts)"""
+    query_names, query_vcfs, reference_names, reference_vcfs = (
+        _load_query_and_reference_filenames(
+            query_vcf_names_tsv, reference_vcf_names_tsv
+        )
+    )
+    logging.info(
+        f"Calculating distances from {len(query_names)} query samples to {len(reference_names)} reference samples"
+    )
+    dists, query_var_counts, _ = _load_genotypes_and_query_distances(
+        query_vcfs,
+        reference_vcfs,
+        threads=threads,
+        packed_genotypes=packed_genotypes,
+        only_use_pass=only_use_pass,
+        numeric_filters=numeric_filters,
+        het_to_hom_key=het_to_hom_key,
+        het_to_hom_min_pc_depth=het_to_hom_min_pc_depth,
+        mask_bed_file=mask_bed_file,
+        site_index_file=site_index_file,
+        cache_dir=genotype_cache_dir,
+    )
+    matrix_file = f"{outprefix}.query_distances.tsv.gz"
+    write_query_distances_file(
+        query_names,
+        reference_names,
+        dists,
+        matrix_file,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
+    )
+    logging.info(f"Saved query distances to file {matrix_file}")
+    var_counts_file = f"{outprefix}.query_variant_counts.tsv.gz"
+    variant_counts.save_variant_count_list_to_tsv(
+        query_var_counts,
+        var_counts_file,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
+    )
+    logging.info(f"Saved query variant counts file {var_counts_file}")
+    return query_names, reference_names, dists, query_var_counts
+
+
+def query_neighbours_between_vcf_files(
+    query_vcf_names_tsv,
+    reference_vcf_names_tsv,
+    outprefix,
+    top_k,
+    threads=1,
+    only_use_pass=True,
+    numeric_filters=None,
+    het_to_hom_key="COV",
+    het_to_hom_min_pc_depth=90.0,
+    mask_bed_file=None,
+    site_index_file=None,
+    packed_genotypes=False,
+    genotype_cache_dir=None,
+    gzip_level=None,
+    gzip_threads=None,
+):
+    """Finds the top_k nearest reference samples to each query sample (plus
+    any more that are tied with the top_k-th nearest one), without
+    calculating all the query x reference distances (see _nearest_neighbours).
+    Writes the neighbours to outprefix.query_neighbours.tsv.gz and the query
+    variant counts to outprefix.query_variant_counts.tsv.gz.
+    Returns tuple: (query names, list of lists of (reference name, distance)
+    tuples, list of query VariantCounts)"""
+    query_names, query_vcfs, reference_names, reference_vcfs = (
+        _load_query_and_reference_filenames(
+            query_vcf_names_tsv, reference_vcf_names_tsv
+        )
+    )
+    genos, var_counts = _load_shared_genotypes(
+        query_vcfs + reference_vcfs,
+        threads=threads,
+        packed_genotypes=packed_genotypes,
+        only_use_pass=only_use_pass,
+        numeric_filters=numeric_filters,
+        het_to_hom_key=het_to_hom_key,
+        het_to_hom_min_pc_depth=het_to_hom_min_pc_depth,
+        mask_bed_file=mask_bed_file,
+        site_index_file=site_index_file,
+        cache_dir=genotype_cache_dir,
+    )
+    logging.info(
+        f"Finding {top_k} nearest neighbours of {len(query_names)} query samples in {len(reference_names)} reference samples"
+    )
+    query_count = len(query_names)
+    try:
+        results = _run_nearest_neighbours(
+            genos,
+            range(query_count),
+            query_count,
+            query_count + len(reference_names),
+            top_k,
+            threads=threads,
+        )
+    finally:
+        _unlink_genotypes(genos)
+    logging.info("Finished finding nearest neighbours")
+
+    neighbours = [
+        [(reference_names[i - query_count], int(d)) for i, d in zip(*x)]
+        for x in results
+    ]
+    neighbours_file = f"{outprefix}.query_neighbours.tsv.gz"
+    write_neighbours_file(
+        query_names,
+        neighbours,
+        neighbours_file,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
+    )
+    logging.info(f"Saved query nearest neighbours to file {neighbours_file}")
+    query_var_counts = var_counts[:query_count]
+    var_counts_file = f"{outprefix}.query_variant_counts.tsv.gz"
+    variant_counts.save_variant_count_list_to_tsv(
+        query_var_counts,
+        var_counts_file,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
+    )
+    logging.info(f"Saved query variant counts file {var_counts_file}")
+    return query_names, neighbours, query_var_counts
+
+
 def _load_one_sample_distances_file(filename):
     """Loads a distance file into memory. Returns a list of tuples,
        where each tuple is (sample_name, distance)"""
@@ -95,18 +1113,21 @@ def _load_one_sample_distances_file(filename):
 def _update_distances_for_one_sample(
     sample_index, new_distances, all_distances, sample_name_to_index
 ):
-    """Updates all distance data in dictionary all_distances.
+    """Updates all distance data in DistanceMatrix all_distances, where
+    distances not yet known are NaN.
     new_distances=list of tuples, made by _load_one_sample_distances_file"""
     for other_sample, distance in new_distances:
         other_index = sample_name_to_index[other_sample]
         if other_index == sample_index:
             continue
-        key = tuple(sorted([sample_index, other_index]))
-        if key in all_distances and all_distances[key] != distance:
+        distance = all_distances.data.dtype.type(distance)
+        existing = all_distances[sample_index, other_index]
+        if not np.isnan(existing) and existing != distance:
+            key = tuple(sorted([sample_index, other_index]))
             raise RuntimeError(
                 f"Pair of samples seen twice when loading distances, with different distances: {key}"
             )
-        all_distances[key] = distance
+        all_distances[sample_index, other_index] = distance
 
 
 def _load_sample_distances_file_of_filenames(infile):
@@ -127,17 +1148,24 @@ def _load_sample_distances_file_of_filenames(infile):
 
 
 def distances_from_all_one_sample_distances_files(
-    file_of_filenames, outfile, threads=1
+    file_of_filenames,
+    outfile,
+    threads=1,
+    binary_outfile=None,
+    gzip_level=None,
+    gzip_threads=None,
 ):
     """Loads data from all per sample distances files.
     filenames = dict of sample name -> distance file name.
-    <threads> files in parallel. Writes ditance matrix to outfile, returns
-    tuple: sample names list, distances dictionary"""
+    <threads> files in parallel. Writes ditance matrix to outfile (and
+    binary_outfile, if given), returns tuple: sample names list, DistanceMatrix"""
     sample_names, distance_files = _load_sample_distances_file_of_filenames(
         file_of_filenames
     )
     sample_name_to_index = {name: i for i, name in enumerate(sample_names)}
-    all_distances = {}
+    all_distances = distance_matrix.DistanceMatrix(
+        len(sample_names), dtype=np.float32, fill=np.nan
+    )
     # To reduce memory, load in a batch of files in parallel, then
     # update the distance data in serial.
     for i in range(0, len(sample_names), threads):
@@ -152,28 +1180,181 @@ def distances_from_all_one_sample_distances_files(
                 sample_index, new_distances, all_distances, sample_name_to_index
             )
 
-    write_distance_matrix_file(sample_names, all_distances, outfile)
+    missing = np.count_nonzero(np.isnan(all_distances.data))
+    if missing > 0:
+        raise RuntimeError(
+            f"Distances missing for {missing} pairs of samples. Cannot continue"
+        )
+
+    write_distance_matrix_file(
+        sample_names,
+        all_distances,
+        outfile,
+        gzip_level=gzip_level,
+        gzip_threads=gzip_threads,
+    )
+    if binary_outfile is not None:
+        write_binary_distance_matrix_file(sample_names, all_distances, binary_outfile)
     return sample_names, all_distances
 
 
-def write_distance_matrix_file(sample_names, distance_matrix, outfile):
-    with utils.open_file(outfile, "w") as f:
+def _distances_to_tsv_string(distances):
+    """Returns the array of distances as a tab-separated string, with each
+    distance formatted in the same way as str() of the numpy value"""
+    if np.issubdtype(distances.dtype, np.integer):
+        return "\t".join(map(str, distances.tolist()))
+
+    # str() of a numpy float is "<integer>.0" for whole numbers that are not
+    # too large, which covers almost all distances. This is much faster than
+    # formatting each float
+    if np.all((0 <= distances) & (distances < 1_000_000)) and not np.any(
+        np.signbit(distances)
+    ):
+        as_ints = distances.astype(np.int64)
+        if len(as_ints) > 0 and np.array_equal(as_ints, distances):
+            return ".0\t".join(map(str, as_ints.tolist())) + ".0"
+
+    return "\t".join(distances.astype(str).tolist())
+
+
+def write_distance_matrix_file(
+    sample_names, distance_matrix, outfile, gzip_level=None, gzip_threads=None
+):
+    with utils.open_file(
+        outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+    ) as f:
         print(len(sample_names), file=f)
         for i, sample in enumerate(sample_names):
-            out = []
+            # The distance of each sample to itself is always written as 0,
+            # even when the other distances are floats
+            row = distance_matrix.row(i)
+            fields = [sample]
+            if i > 0:
+                fields.append(_distances_to_tsv_string(row[:i]))
+            fields.append("0")
+            if i < len(row) - 1:
+                fields.append(_distances_to_tsv_string(row[i + 1 :]))
+            print(*fields, sep="\t", file=f)
+
+
+def write_query_distances_file(
+    query_names, reference_names, dists, outfile, gzip_level=None, gzip_threads=None
+):
+    """Writes the queries x references array of distances dists to a TSV
+    file, with one row per query, and one column per reference"""
+    with utils.open_file(
+        outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+    ) as f:
+        print("sample", *reference_names, sep="\t", file=f)
+        for query, row in zip(query_names, dists):
+            print(query, _distances_to_tsv_string(row), sep="\t", file=f)
+
+
+def load_query_distances_file(infile):
+    """Loads a file written by write_query_distances_file. Returns tuple:
+    (query names, reference names, numpy array of distances)"""
+    query_names = []
+    rows = []
+    with utils.open_file(infile) as f:
+        reference_names = f.readline().rstrip("\n").split("\t")[1:]
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != len(reference_names) + 1:
+                raise RuntimeError(
+                    f"Expected {len(reference_names)} distances for sample {fields[0]} in file {infile}, but got {len(fields) - 1}"
+                )
+            query_names.append(fields[0])
+            rows.append(np.array(fields[1:], dtype=np.float64))
+    dists = np.array(rows, dtype=np.float32).reshape(
+        len(query_names), len(reference_names)
+    )
+    return query_names, reference_names, dists
+
+
+def write_neighbours_file(
+    sample_names, neighbours, outfile, gzip_level=None, gzip_threads=None
+):
+    """Writes nearest neighbours to a TSV file, with columns sample,
+    neighbour, distance. neighbours = list of lists of (neighbour name,
+    distance) tuples, one list for each sample in sample_names"""
+    with utils.open_file(
+        outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+    ) as f:
+        print("sample", "neighbour", "distance", sep="\t", file=f)
+        for sample, sample_neighbours in zip(sample_names, neighbours):
+            for neighbour, distance in sample_neighbours:
+                print(sample, neighbour, distance, sep="\t", file=f)
+
+
+def load_neighbours_file(infile):
+    """Loads a file written by write_neighbours_file. Returns a dictionary of
+    sample name -> list of (neighbour name, distance) tuples"""
+    neighbours = {}
+    with utils.open_file(infile) as f:
+        for d in csv.DictReader(f, delimiter="\t"):
+            neighbours.setdefault(d["sample"], []).append(
+                (d["neighbour"], int(d["distance"]))
+            )
+    return neighbours
+
+
+def write_binary_distance_matrix_file(
+    sample_names, distance_matrix, outfile, dtype=np.float32
+):
+    """Writes distance matrix in binary format. By default stores float32,
+    which is the same type used when loading a phylip distance matrix file"""
+    dtype = np.dtype(dtype).newbyteorder("<")
+    header = json.dumps(
+        {"dtype": dtype.str, "sample_names": list(sample_names)}
+    ).encode()
+    data_start = len(BINARY_MAGIC) + 8 + len(header)
+    header += b" " * (-data_start % BINARY_ALIGNMENT)
+    with open(outfile, "wb") as f:
+        f.write(BINARY_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        distance_matrix.data.astype(dtype, copy=False).tofile(f)
 
-            for j, sample2 in enumerate(sample_names):
-                if i == j:
-                    out.append(0)
-                else:
-                    out.append(distance_matrix[tuple(sorted([i, j]))])
 
-            print(sample, *out, sep="\t", file=f)
+def is_binary_distance_matrix_file(infile):
+    with open(infile, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def load_binary_distance_matrix_file(infile):
+    """Loads a file made by write_binary_distance_matrix_file. The distances
+    are memory-mapped read-only, instead of loaded into memory"""
+    with open(infile, "rb") as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise RuntimeError(f"Not a binary distance matrix file: {infile}")
+        header_length = int.from_bytes(f.read(8), "little")
+        try:
+            header = json.loads(f.read(header_length))
+        except:
+            raise RuntimeError(f"Error reading header of distance matrix file {infile}")
+
+    sample_names = header["sample_names"]
+    sample_count = len(sample_names)
+    length = sample_count * (sample_count - 1) // 2
+    dtype = np.dtype(header["dtype"])
+    offset = len(BINARY_MAGIC) + 8 + header_length
+    if os.path.getsize(infile) != offset + length * dtype.itemsize:
+        raise RuntimeError(
+            f"Wrong size of binary distance matrix file {infile}. Expected {offset + length * dtype.itemsize} bytes"
+        )
+    if length == 0:
+        data = np.zeros(0, dtype=dtype)
+    else:
+        data = np.memmap(infile, dtype=dtype, mode="r", offset=offset, shape=(length,))
+    return sample_names, distance_matrix.DistanceMatrix(sample_count, data=data)
 
 
 def load_distance_matrix_file(infile):
+    if is_binary_distance_matrix_file(infile):
+        return load_binary_distance_matrix_file(infile)
+
     sample_names = []
-    distances = {}
+    distances = None
 
     with utils.open_file(infile) as f:
         for line_number, line in enumerate(f):
@@ -186,16 +1367,27 @@ def load_distance_matrix_file(infile):
                     )
 
                 sample_names = []
+                distances = distance_matrix.DistanceMatrix(
+                    number_of_samples, dtype=np.float32
+                )
+            elif line_number > number_of_samples:
+                raise RuntimeError(
+                    f"Expected {number_of_samples} samples in distance matrix file, but got more than that"
+                )
             elif line_number == 1:
                 sample_names.append(line.split()[0])
                 continue
             else:
                 fields = line.rstrip().split("\t", maxsplit=line_number)
-                sample_names.append(fields[0])
-                for i in range(1, line_number):
-                    distances[tuple(sorted([line_number - 1, i - 1]))] = float(
-                        fields[i]
+                if len(fields) < line_number:
+                    raise RuntimeError(
+                        f"Expected at least {line_number - 1} distances for sample {fields[0]} in distance matrix file, but got {len(fields) - 1}"
                     )
+                sample_names.append(fields[0])
+                # Parse as float64 then convert, to get the same values
+                # as using float() on each distance
+                row = np.array(fields[1:line_number], dtype=np.float64)
+                distances.set_lower_row(line_number - 1, row)
 
     if len(sample_names) != number_of_samples:
         raise RuntimeError(
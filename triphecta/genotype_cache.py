@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from triphecta import variant_counts
+
+
+class GenotypeCache:
+    """On-disk cache of genotypes made by vcf.load_vcf_file_for_distance_calc,
+    so that each VCF file only needs to be parsed once. Each entry is a .npy
+    file of genotypes plus a variant counts file. Entries are keyed by the VCF
+    file path, size and modification time, and by the settings used to
+    load it, so changing any of those means the VCF is parsed again"""
+
+    def __init__(
+        self,
+        cache_dir,
+        only_use_pass=True,
+        numeric_filters=None,
+        het_to_hom_key="COV",
+        het_to_hom_min_pc_depth=90.0,
+        mask=None,
+    ):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if mask is None:
+            mask = {}
+        mask_json = json.dumps(
+            {k: sorted(v) for k, v in mask.items()}, sort_keys=True
+        ).encode()
+        self.settings = {
+            "only_use_pass": only_use_pass,
+            "numeric_filters": {} if numeric_filters is None else numeric_filters,
+            "het_to_hom_key": het_to_hom_key,
+            "het_to_hom_min_pc_depth": het_to_hom_min_pc_depth,
+            "mask": hashlib.sha256(mask_json).hexdigest(),
+        }
+
+    def _key(self, vcf_file):
+        vcf_file = os.path.abspath(vcf_file)
+        stat = os.stat(vcf_file)
+        key_data = {
+            "vcf_file": vcf_file,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            **self.settings,
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def _filenames(self, vcf_file):
+        prefix = os.path.join(self.cache_dir, self._key(vcf_file))
+        return f"{prefix}.npy", f"{prefix}.variant_counts.tsv"
+
+    def get(self, vcf_file):
+        """Returns tuple (genotypes, VariantCounts) for the VCF file, where
+        genotypes are memory-mapped read-only. Returns None if the VCF file
+        is not in the cache"""
+        genos_file, counts_file = self._filenames(vcf_file)
+        if not (os.path.exists(genos_file) and os.path.exists(counts_file)):
+            return None
+        logging.debug(f"Loading genotypes of {vcf_file} from cache {genos_file}")
+        genos = np.load(genos_file, mmap_mode="r")
+        counts = variant_counts.load_variant_count_list_from_tsv(counts_file)
+        return genos, counts[0]
+
+    def put(self, vcf_file, genos, var_counts):
+        genos_file, counts_file = self._filenames(vcf_file)
+        # Write to temporary files and then rename, so that other processes
+        # never see a partially written entry
+        tmp_suffix = f".tmp.{os.getpid()}"
+        with open(genos_file + tmp_suffix, "wb") as f:
+            np.save(f, genos)
+        variant_counts.save_variant_count_list_to_tsv(
+            [var_counts], counts_file + tmp_suffix
+        )
+        os.replace(counts_file + tmp_suffix, counts_file)
+        os.replace(genos_file + tmp_suffix, genos_file)
+        logging.debug(f"Saved genotypes of {vcf_file} to cache {genos_file}")
@@ -1,7 +1,8 @@
-import collections
 import os
 
-from triphecta import distances, utils, variant_counts
+import numpy as np
+
+from triphecta import distance_matrix, distances, knn_index, utils, variant_counts
 
 
 class Genotypes:
@@ -29,10 +30,11 @@ class Genotypes:
             else os.path.abspath(variant_counts_file)
         )
         self.check_vcf_files_exist = check_vcf_files_exist
+        self.knn = None
 
         if testing:
             self.sample_names_list = []
-            self.distances = {}
+            self.distances = distance_matrix.DistanceMatrix(0)
             self.vcf_variant_counts = []
             self.vcf_files = {}
         else:
@@ -57,6 +59,10 @@ class Genotypes:
 
         if self.distance_matrix_file is None:
             raise RuntimeError("Must provide distance matrix file")
+        elif knn_index.is_knn_index_file(self.distance_matrix_file):
+            self.knn = knn_index.load(self.distance_matrix_file)
+            self.sample_names_list = self.knn.sample_names
+            self.distances = None
         else:
             (
                 self.sample_names_list,
@@ -69,34 +75,84 @@ class Genotypes:
             )
 
     def distance(self, sample1, sample2):
-        key = tuple(
-            sorted(
-                [self.sample_name_to_index[sample1], self.sample_name_to_index[sample2]]
-            )
+        i = self.sample_name_to_index[sample1]
+        j = self.sample_name_to_index[sample2]
+        if self.knn is None:
+            return self.distances[i, j]
+        elif i == j:
+            return self.knn.distances.dtype.type(0)
+
+        for x, y in (i, j), (j, i):
+            neighbours, dists = self.knn.neighbours_of(x)
+            found = np.flatnonzero(neighbours == y)
+            if len(found) > 0:
+                return dists[found[0]]
+
+        raise RuntimeError(
+            f"Distance between samples {sample1} and {sample2} not found in kNN index {self.distance_matrix_file}. Cannot continue"
         )
-        return self.distances[key]
 
     def sample_names(self):
         for sample in self.sample_names_list:
             yield sample
 
-    def distance_dict(self, sample, top_n=None):
-        all_distances = {
-            other: self.distance(sample, other)
-            for other in self.sample_names()
-            if sample != other and other not in self.excluded_samples
-        }
-        if top_n is None:
-            return all_distances
+    def _excluded_indexes(self):
+        return np.array(
+            [
+                self.sample_name_to_index[x]
+                for x in self.excluded_samples
+                if x in self.sample_name_to_index
+            ],
+            dtype=np.int64,
+        )
+
+    def _knn_neighbours(self, sample_index, top_n):
+        neighbours, dists = self.knn.neighbours_of(sample_index)
+        keep = ~np.isin(neighbours, self._excluded_indexes())
+        # The index has every sample at least as close as the k-th nearest
+        # neighbour, so the answer is only known to be right if there are
+        # enough neighbours left after removing excluded samples
+        if not self.knn.is_complete(sample_index) and (
+            top_n is None or np.count_nonzero(keep) < top_n
+        ):
+            wanted = "all samples" if top_n is None else f"{top_n} samples"
+            raise RuntimeError(
+                f"Not enough neighbours of sample {self.sample_names_list[sample_index]} in kNN index {self.distance_matrix_file} (made with k={self.knn.k}) to get the nearest {wanted}, after removing excluded samples. Make a kNN index with a larger k, or use a distance matrix. Cannot continue"
+            )
+        return neighbours[keep].astype(np.int64), dists[keep]
+
+    def _matrix_neighbours(self, sample_index):
+        keep = np.ones(len(self.sample_names_list), dtype=bool)
+        keep[sample_index] = False
+        keep[self._excluded_indexes()] = False
+        indexes = np.flatnonzero(keep)
+        return indexes, self.distances.row(sample_index)[indexes]
+
+    def neighbour_arrays(self, sample, top_n=None):
+        """Same as distance_dict(), but returns tuple of numpy arrays:
+        (indexes of the other samples, distances), sorted by index"""
+        sample_index = self.sample_name_to_index[sample]
+        if self.knn is None:
+            indexes, dists = self._matrix_neighbours(sample_index)
         else:
-            value_counts = collections.Counter(all_distances.values())
-            total = 0
-            for max_value, count in sorted(value_counts.items()):
-                total += count
-                if total >= top_n:
-                    break
-
-            return {k: v for k, v in all_distances.items() if v <= max_value}
+            indexes, dists = self._knn_neighbours(sample_index, top_n)
+
+        if top_n is not None and top_n < len(dists):
+            max_value = np.partition(dists, top_n - 1)[top_n - 1]
+            keep = dists <= max_value
+            indexes = indexes[keep]
+            dists = dists[keep]
+
+        order = np.argsort(indexes)
+        return indexes[order], dists[order]
+
+    def distance_dict(self, sample, top_n=None):
+        """Returns dictionary of other sample name -> distance to sample,
+        not including excluded samples. If top_n is not None, only has the
+        top_n nearest samples, plus any more that are tied with the
+        top_n-th nearest one"""
+        indexes, dists = self.neighbour_arrays(sample, top_n=top_n)
+        return {self.sample_names_list[i]: d for i, d in zip(indexes, dists)}
 
     def update_excluded_samples_using_variant_counts(
         self, minimum_percent_hom_calls=90.0, count_het_to_hom_as_hom=True
@@ -0,0 +1,157 @@
+import json
+import os
+
+import numpy as np
+
+# kNN index files start with this, followed by the length of a JSON header
+# as a little-endian uint64, then the header (padded so that the data is
+# aligned), and then the arrays offsets, neighbours and distances
+MAGIC = b"TRIPHKN1"
+ALIGNMENT = 64
+
+
+class KnnIndex:
+    """The k nearest neighbours of each sample, plus any more neighbours
+    that are tied with the k-th nearest one. Stored in compressed sparse row
+    format: the neighbours of sample i are neighbours[offsets[i]:offsets[i+1]],
+    sorted by distance then index, with distances in the same positions
+    in the array distances"""
+
+    def __init__(self, sample_names, k, offsets, neighbours, distances):
+        if len(offsets) != len(sample_names) + 1:
+            raise RuntimeError(
+                f"Expected {len(sample_names) + 1} offsets in kNN index, got {len(offsets)}"
+            )
+        if not len(neighbours) == len(distances) == offsets[-1]:
+            raise RuntimeError(
+                f"Mismatch in kNN index lengths: {offsets[-1]}, {len(neighbours)}, {len(distances)}"
+            )
+        self.sample_names = sample_names
+        self.k = k
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.distances = distances
+
+    def __eq__(self, other):
+        return (
+            type(other) is type(self)
+            and self.sample_names == other.sample_names
+            and self.k == other.k
+            and np.array_equal(self.offsets, other.offsets)
+            and np.array_equal(self.neighbours, other.neighbours)
+            and np.array_equal(self.distances, other.distances)
+        )
+
+    def __len__(self):
+        return len(self.sample_names)
+
+    def neighbours_of(self, i):
+        """Returns tuple: (array of neighbour indexes, array of distances)
+        of sample i"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.neighbours[start:end], self.distances[start:end]
+
+    def is_complete(self, i):
+        """Returns True if every other sample is a neighbour of sample i"""
+        return self.offsets[i + 1] - self.offsets[i] == len(self) - 1
+
+    @classmethod
+    def from_neighbours(cls, sample_names, k, neighbours, dtype=np.float32):
+        """Makes a new KnnIndex from a list of tuples (array of neighbour
+        indexes, array of distances), one per sample, where each sample's
+        neighbours are already sorted"""
+        offsets = np.zeros(len(sample_names) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(x[0]) for x in neighbours])
+        if len(neighbours) == 0:
+            all_neighbours = np.zeros(0, dtype=np.uint32)
+            all_distances = np.zeros(0, dtype=dtype)
+        else:
+            all_neighbours = np.concatenate([x[0] for x in neighbours])
+            all_distances = np.concatenate([x[1] for x in neighbours])
+        return cls(
+            sample_names,
+            k,
+            offsets,
+            all_neighbours.astype(np.uint32),
+            all_distances.astype(dtype),
+        )
+
+    @classmethod
+    def from_distance_matrix(cls, sample_names, matrix, k, dtype=np.float32):
+        """Makes a new KnnIndex from the DistanceMatrix matrix"""
+        neighbours = []
+        for i in range(len(sample_names)):
+            row = matrix.row(i)
+            others = np.delete(np.arange(len(row)), i)
+            dists = row[others]
+            if len(dists) > k:
+                keep = dists <= np.partition(dists, k - 1)[k - 1]
+                others = others[keep]
+                dists = dists[keep]
+            order = np.lexsort((others, dists))
+            neighbours.append((others[order], dists[order]))
+        return cls.from_neighbours(sample_names, k, neighbours, dtype=dtype)
+
+    def save(self, outfile):
+        header = json.dumps(
+            {
+                "k": self.k,
+                "sample_count": len(self),
+                "neighbour_count": int(self.offsets[-1]),
+                "distance_dtype": self.distances.dtype.newbyteorder("<").str,
+                "sample_names": list(self.sample_names),
+            }
+        ).encode()
+        data_start = len(MAGIC) + 8 + len(header)
+        header += b" " * (-data_start % ALIGNMENT)
+        with open(outfile, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            self.offsets.astype("<u8", copy=False).tofile(f)
+            self.neighbours.astype("<u4", copy=False).tofile(f)
+            self.distances.astype(
+                self.distances.dtype.newbyteorder("<"), copy=False
+            ).tofile(f)
+
+
+def is_knn_index_file(infile):
+    with open(infile, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load(infile):
+    """Loads a file made by KnnIndex.save(). The arrays are memory-mapped
+    read-only, instead of loaded into memory"""
+    with open(infile, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError(f"Not a kNN index file: {infile}")
+        header_length = int.from_bytes(f.read(8), "little")
+        try:
+            header = json.loads(f.read(header_length))
+        except:
+            raise RuntimeError(f"Error reading header of kNN index file {infile}")
+
+    sample_count = header["sample_count"]
+    neighbour_count = header["neighbour_count"]
+    distance_dtype = np.dtype(header["distance_dtype"])
+    offset = len(MAGIC) + 8 + header_length
+    arrays = []
+    for dtype, length in [
+        (np.dtype("<u8"), sample_count + 1),
+        (np.dtype("<u4"), neighbour_count),
+        (distance_dtype, neighbour_count),
+    ]:
+        if length == 0:
+            arrays.append(np.zeros(0, dtype=dtype))
+        else:
+            arrays.append(
+                np.memmap(infile, dtype=dtype, mode="r", offset=offset, shape=(length,))
+            )
+        offset += length * dtype.itemsize
+
+    if os.path.getsize(infile) != offset:
+        raise RuntimeError(
+            f"Wrong size of kNN index file {infile}. Expected {offset} bytes"
+        )
+    return KnnIndex(header["sample_names"], header["k"], *arrays)
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class PhenotypeCompare:
     def __init__(self, constraints, count_unknown_as_diff=True):
         self.compare_functions = {
@@ -95,6 +98,20 @@ class PhenotypeCompare:
                 return False
         return True
 
+    def column_agrees_with_value(self, values, valid, key, value):
+        """Vectorized phenos_agree_on_one_feature(), for comparing every
+        value of one phenotype with the same value. values and valid are
+        the arrays returned by Phenotypes.column(key). Returns bool array,
+        where element i says if values[i] agrees with value"""
+        if value is None:
+            return np.full(len(values), not self.count_unknown_as_diff)
+        constraint = self.constraints[key]
+        compare_function = VECTORIZED_COMPARE_FUNCTIONS[constraint["method"]]
+        agree = compare_function(
+            values.astype(np.float64), value, **constraint["params"]
+        )
+        return np.where(valid, agree, not self.count_unknown_as_diff)
+
     def differences(self, pheno1, pheno2):
         """Returns number of differences between the two phenotypes.
         Assumes that satisfy_required_differences(pheno1, pheno2) is True.
@@ -109,3 +126,113 @@ class PhenotypeCompare:
                 differences += 1
 
         return differences
+
+    def compile(self, phenos, sample_names):
+        """Returns a CompiledPhenotypeCompare, for comparing the phenotypes
+        of the samples in sample_names, using the Phenotypes phenos"""
+        return CompiledPhenotypeCompare(self, phenos, sample_names)
+
+
+class CompiledPhenotypeCompare:
+    """Same comparisons as PhenotypeCompare, but the phenotypes of all the
+    samples are stored column-wise in numpy arrays (one array of values
+    and one of nulls per phenotype), so that one sample can be compared
+    with many others in one call. Samples are referred to by their index
+    in sample_names. Bool phenotypes are stored as 0.0/1.0, which compare
+    the same as True/False"""
+
+    def __init__(self, pheno_compare, phenos, sample_names):
+        self.pheno_compare = pheno_compare
+        self.sample_names = list(sample_names)
+        missing = [x for x in pheno_compare.constraints if x not in phenos.pheno_types]
+        if len(missing):
+            raise RuntimeError(
+                f"Phenotype(s) in constraints not found in phenotypes: {', '.join(missing)}"
+            )
+        pheno_indexes = [
+            phenos.sample_name_to_index.get(x, -1) for x in self.sample_names
+        ]
+        pheno_indexes = np.array(pheno_indexes, dtype=np.int64)
+        self.has_phenos = pheno_indexes >= 0
+        pheno_indexes[~self.has_phenos] = 0
+        self.values = {}
+        self.nulls = {}
+        for key in pheno_compare.constraints:
+            values, valid = phenos.column(key)
+            self.values[key] = values.astype(np.float64)[pheno_indexes]
+            self.nulls[key] = ~(valid[pheno_indexes] & self.has_phenos)
+        self.required_diff_keys = sorted(pheno_compare.required_diff_keys)
+        self.must_be_same_keys = [
+            k for k, v in pheno_compare.constraints.items() if v["must_be_same"]
+        ]
+
+    @staticmethod
+    def _compare_method_equal(p1, p2):
+        return p1 == p2
+
+    @staticmethod
+    def _compare_method_range(p1, p2, low=None, high=None):
+        return ((low <= p1) & (p1 <= high)) == ((low <= p2) & (p2 <= high))
+
+    @staticmethod
+    def _compare_method_abs_distance(p1, p2, max_dist=None):
+        return np.abs(p1 - p2) <= max_dist
+
+    @staticmethod
+    def _compare_method_percent_distance(p1, p2, max_percent=None):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent = 100 * np.abs(p1 - p2) / np.maximum(np.abs(p1), np.abs(p2))
+        return ((p1 == 0) & (p2 == 0)) | (percent <= max_percent)
+
+    def _agree_on_one_feature(self, sample, others, key, count_unknown_as_diff):
+        """Returns bool array, where element i is the same as
+        PhenotypeCompare._phenos_equal_account_for_none() for the phenotype
+        key of sample and others[i]"""
+        constraint = self.pheno_compare.constraints[key]
+        compare_function = VECTORIZED_COMPARE_FUNCTIONS[constraint["method"]]
+        values = self.values[key]
+        nulls = self.nulls[key]
+        agree = compare_function(values[sample], values[others], **constraint["params"])
+        either_null = nulls[sample] | nulls[others]
+        return np.where(either_null, not count_unknown_as_diff, agree)
+
+    def compare(self, sample, others=None):
+        """Compares the sample with index sample against the samples with
+        indexes others (default is all the samples). Returns tuple of arrays
+        (satisfy, differences), where satisfy[i] is the same as
+        PhenotypeCompare.satisfy_required_differences() and differences[i]
+        the same as PhenotypeCompare.differences(), for sample and
+        others[i]"""
+        if others is None:
+            others = np.arange(len(self.sample_names))
+        else:
+            others = np.asarray(others, dtype=np.int64)
+        if not self.has_phenos[sample] or not np.all(self.has_phenos[others]):
+            missing = [
+                self.sample_names[i]
+                for i in [sample, *others]
+                if not self.has_phenos[i]
+            ]
+            raise RuntimeError(
+                f"Sample(s) not found in phenotypes: {', '.join(missing)}"
+            )
+
+        satisfy = np.ones(len(others), dtype=bool)
+        for key in self.required_diff_keys:
+            satisfy &= ~self._agree_on_one_feature(sample, others, key, False)
+
+        differences = np.zeros(len(others), dtype=np.int64)
+        for key in self.must_be_same_keys:
+            differences += ~self._agree_on_one_feature(
+                sample, others, key, self.pheno_compare.count_unknown_as_diff
+            )
+        return satisfy, differences
+
+
+# Same as PhenotypeCompare.compare_functions, but these work with numpy arrays
+VECTORIZED_COMPARE_FUNCTIONS = {
+    "equal": CompiledPhenotypeCompare._compare_method_equal,
+    "range": CompiledPhenotypeCompare._compare_method_range,
+    "abs_distance": CompiledPhenotypeCompare._compare_method_abs_distance,
+    "percent_distance": CompiledPhenotypeCompare._compare_method_percent_distance,
+}
@@ -2,6 +2,8 @@ import csv
 import json
 import logging
 
+import numpy as np
+
 from triphecta import utils
 
 data_lookup = {
@@ -23,11 +25,22 @@ data_lookup = {
 
 
 class Phenotypes:
+    """Phenotypes of samples, stored column-wise. For each phenotype there
+    is a numpy array of values (bool, or float64 if the phenotype is
+    numeric) and a bool array saying which values are not null. Element i
+    of each array is for sample self.sample_names[i]"""
+
     def __init__(self, input_phenos_tsv):
         self.input_phenos_tsv = input_phenos_tsv
-        self.phenos, self.pheno_types = Phenotypes._load_phenotypes_tsv_file(
-            self.input_phenos_tsv
-        )
+        (
+            self.sample_names,
+            self.values,
+            self.valid,
+            self.pheno_types,
+        ) = Phenotypes._load_phenotypes_tsv_file(self.input_phenos_tsv)
+        self.sample_name_to_index = {
+            name: i for i, name in enumerate(self.sample_names)
+        }
         self.pheno_types, self.bool_pheno_types = Phenotypes._get_pheno_types(
             self.pheno_types
         )
@@ -44,32 +57,67 @@ class Phenotypes:
             )
 
     @classmethod
-    def _load_phenotypes_tsv_file(cls, infile):
-        phenos = {}
+    def _strings_to_column(cls, strings):
+        """Converts a list of strings from one column of the phenotypes file.
+        Each distinct string is only converted once. Returns tuple: (array of
+        values, array of bools saying which values are not null, set of types
+        of the values)"""
+        unique_strings = {x: i for i, x in enumerate(dict.fromkeys(strings))}
+        inverse = np.fromiter(
+            map(unique_strings.__getitem__, strings), dtype=np.int64, count=len(strings)
+        )
+        unique_values = [
+            Phenotypes.convert_one_variable_string(x) for x in unique_strings
+        ]
+        types = {type(x) for x in unique_values}
+        unique_valid = np.array([x is not None for x in unique_values], dtype=bool)
+        if types.issubset({bool, type(None)}):
+            dtype, null = bool, False
+        else:
+            dtype, null = np.float64, np.nan
+        unique_values = np.array(
+            [null if x is None else x for x in unique_values], dtype=dtype
+        )
+        return unique_values[inverse], unique_valid[inverse], types
 
+    @classmethod
+    def _load_phenotypes_tsv_file(cls, infile):
         with utils.open_file(infile) as f:
-            reader = csv.DictReader(f, delimiter="\t")
-            if "sample" not in reader.fieldnames:
+            rows = [x for x in csv.reader(f, delimiter="\t") if len(x)]
+
+        fieldnames = rows[0] if len(rows) else []
+        if "sample" not in fieldnames:
+            raise RuntimeError(
+                f"Must have a 'sample' column in phenotypes file. Not found in file {infile}"
+            )
+        for i, row in enumerate(rows):
+            if len(row) != len(fieldnames):
                 raise RuntimeError(
-                    f"Must have a 'sample' column in phenotypes file. Not found in file {infile}"
+                    f"Expected {len(fieldnames)} columns but got {len(row)} in line {i+1} of phenotypes file {infile}"
                 )
-            pheno_types = {x: set() for x in reader.fieldnames if x != "sample"}
 
-            for row in reader:
-                if row["sample"] in phenos:
+        columns = dict(zip(fieldnames, zip(*rows[1:])))
+        sample_names = list(columns.get("sample", []))
+        if len(sample_names) != len(set(sample_names)):
+            seen = set()
+            for name in sample_names:
+                if name in seen:
                     raise RuntimeError(
-                        f"Duplicate sample name '{row['sample']}' in phenotypes file {infile}"
+                        f"Duplicate sample name '{name}' in phenotypes file {infile}"
                     )
+                seen.add(name)
+
+        values = {}
+        valid = {}
+        pheno_types = {}
+        for pheno in fieldnames:
+            if pheno == "sample":
+                continue
+            values[pheno], valid[pheno], pheno_types[pheno] = cls._strings_to_column(
+                columns.get(pheno, ())
+            )
 
-                phenos[row["sample"]] = {
-                    x: Phenotypes.convert_one_variable_string(row[x])
-                    for x in row
-                    if x != "sample"
-                }
-                for p in pheno_types:
-                    pheno_types[p].add(type(phenos[row["sample"]][p]))
-
-        return phenos, pheno_types
+        return sample_names, values, valid, pheno_types
 
     @classmethod
     def _get_pheno_types(cls, types):
@@ -95,7 +143,9 @@ class Phenotypes:
         assert len(infer_type) == len(types)
         return infer_type, bools
 
-    def write_template_constraints_json(self, outfile):
+    def write_template_constraints_json(
+        self, outfile, gzip_level=None, gzip_threads=None
+    ):
         constraints = {}
         for pheno, pheno_type in self.pheno_types.items():
             constraints[pheno] = {"must_be_same": True, "params": {}}
@@ -107,22 +157,52 @@ class Phenotypes:
             else:
                 raise TypeError
 
-        with utils.open_file(outfile, "w") as f:
+        with utils.open_file(
+            outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+        ) as f:
             json.dump(constraints, f, sort_keys=True, indent=2)
 
+    def __contains__(self, sample):
+        return sample in self.sample_name_to_index
+
+    def __len__(self):
+        return len(self.sample_names)
+
     def __getitem__(self, sample):
-        return self.phenos[sample]
+        """Returns dictionary of phenotype name -> value for the sample,
+        where values are True, False, a float, or None"""
+        i = self.sample_name_to_index[sample]
+        return {
+            pheno: self.values[pheno][i].item() if self.valid[pheno][i] else None
+            for pheno in self.values
+        }
+
+    def value(self, sample, pheno):
+        """Returns the value of phenotype pheno of the sample, which is True,
+        False, a float, or None. Use this instead of phenos[sample][pheno]
+        when only a few phenotypes are needed, because phenos[sample]
+        makes a dictionary of all the phenotypes"""
+        i = self.sample_name_to_index[sample]
+        return self.values[pheno][i].item() if self.valid[pheno][i] else None
+
+    def column(self, pheno):
+        """Returns tuple of arrays (values, valid) of the phenotype pheno"""
+        return self.values[pheno], self.valid[pheno]
 
     def find_matching_cases(self, wanted_phenos, pheno_compare):
+        """Returns sorted list of the samples whose phenotypes agree with
+        all of the phenotypes in the dictionary wanted_phenos, using the
+        PhenotypeCompare pheno_compare"""
         wanted_phenos = {k: data_lookup.get(v, v) for k, v in wanted_phenos.items()}
-        wanted_pheno_keys = set(wanted_phenos.keys())
-        matching_samples = []
+        matches = np.ones(len(self.sample_names), dtype=bool)
 
-        for sample_name in self.phenos:
-            if pheno_compare.phenos_agree_on_features(
-                self[sample_name], wanted_phenos, wanted_pheno_keys
-            ):
-                matching_samples.append(sample_name)
+        for pheno, value in wanted_phenos.items():
+            if pheno not in self.values:
+                raise RuntimeError(
+                    f"Wanted phenotype '{pheno}' not found in phenotypes file {self.input_phenos_tsv}"
+                )
+            matches &= pheno_compare.column_agrees_with_value(
+                *self.column(pheno), pheno, value
+            )
 
-        matching_samples.sort()
-        return matching_samples
+        return sorted(self.sample_names[i] for i in np.flatnonzero(matches))
@@ -1,6 +1,16 @@
 from collections import namedtuple
+import multiprocessing
 from operator import attrgetter
 
+import numpy as np
+
+# ranked_neighbours_for_samples() ranks this many samples at once
+RANKING_BATCH_SIZE = 256
+
+# Set by _init_ranking_worker in each worker of the pool used by
+# ranked_neighbours_for_samples()
+ranking_genos = None
+ranking_compiled_compare = None
 
 RankData = namedtuple(
     "RankData",
@@ -76,3 +86,151 @@ def ranked_neighbours_for_one_sample(
     return _geno_and_pheno_distances_to_rank_table(
         geno_dist, pheno_dist, max_pheno_dist=max_pheno_dist
     )
+
+
+def _dense_ranks(groups, values):
+    """groups is a sorted array of group ids, and values is an array of the
+    same length. Returns array of the dense rank of each value within its
+    group: the smallest value in a group has rank 0, the next smallest
+    distinct value has rank 1, and so on"""
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.lexsort((values, groups))
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+    group_start = np.ones(len(values), dtype=bool)
+    group_start[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    new_value = group_start.copy()
+    new_value[1:] |= sorted_values[1:] != sorted_values[:-1]
+    sorted_ranks = np.cumsum(new_value) - 1
+    start_positions = np.maximum.accumulate(
+        np.where(group_start, np.arange(len(values)), 0)
+    )
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[order] = sorted_ranks - sorted_ranks[start_positions]
+    return ranks
+
+
+def _ranked_neighbours_for_batch(
+    genos, compiled_compare, samples, top_n_genos=None, max_pheno_dist=None
+):
+    """Returns list of rank tables, one per sample in samples. Each rank
+    table is the same as made by ranked_neighbours_for_one_sample().
+    compiled_compare is a CompiledPhenotypeCompare, made using the samples
+    in genos.sample_names_list.
+    The distances of all the samples are put into one set of arrays,
+    with the array groups saying which sample each element belongs to, so
+    that ranking and sorting is done for all samples at once"""
+    groups = []
+    others = []
+    geno_dists = []
+    pheno_dists = []
+    for i, sample in enumerate(samples):
+        indexes, dists = genos.neighbour_arrays(sample, top_n=top_n_genos)
+        keep, sample_pheno_dists = compiled_compare.compare(
+            genos.sample_name_to_index[sample], indexes
+        )
+        groups.append(np.full(np.count_nonzero(keep), i, dtype=np.int64))
+        others.append(indexes[keep])
+        geno_dists.append(dists[keep])
+        pheno_dists.append(sample_pheno_dists[keep])
+
+    groups = np.concatenate(groups)
+    others = np.concatenate(others)
+    geno_dists = np.concatenate(geno_dists)
+    pheno_dists = np.concatenate(pheno_dists)
+    # Ranks use all the samples that satisfy the required differences,
+    # before removing the ones that have too many phenotype differences
+    geno_ranks = _dense_ranks(groups, geno_dists)
+    pheno_ranks = _dense_ranks(groups, pheno_dists)
+    rank_sums = geno_ranks + pheno_ranks
+
+    if max_pheno_dist is None:
+        keep = np.arange(len(groups))
+    else:
+        keep = np.flatnonzero(pheno_dists <= max_pheno_dist)
+    # lexsort is stable, so samples with the same ranks stay in index order
+    order = keep[
+        np.lexsort((pheno_ranks[keep], geno_ranks[keep], rank_sums[keep], groups[keep]))
+    ]
+    bounds = np.searchsorted(groups[order], np.arange(len(samples) + 1))
+    rank_tables = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        rank_tables.append(
+            [
+                RankData(
+                    sample=genos.sample_names_list[others[j]],
+                    rank_sum=int(rank_sums[j]),
+                    geno_rank=int(geno_ranks[j]),
+                    pheno_rank=int(pheno_ranks[j]),
+                    geno_dist=geno_dists[j],
+                    pheno_dist=int(pheno_dists[j]),
+                )
+                for j in order[start:end]
+            ]
+        )
+    return rank_tables
+
+
+def _init_ranking_worker(genotypes, compiled_phenotype_compare):
+    global ranking_genos, ranking_compiled_compare
+    ranking_genos = genotypes
+    ranking_compiled_compare = compiled_phenotype_compare
+
+
+def _ranked_neighbours_for_batch_in_worker(samples, top_n_genos, max_pheno_dist):
+    global ranking_genos, ranking_compiled_compare
+    if ranking_genos is None or ranking_compiled_compare is None:
+        raise RuntimeError(
+            "Ranking worker not initialised. Must use _init_ranking_worker first"
+        )
+    return _ranked_neighbours_for_batch(
+        ranking_genos,
+        ranking_compiled_compare,
+        samples,
+        top_n_genos=top_n_genos,
+        max_pheno_dist=max_pheno_dist,
+    )
+
+
+def ranked_neighbours_for_samples(
+    genos,
+    phenos,
+    pheno_compare,
+    samples,
+    top_n_genos=None,
+    max_pheno_dist=None,
+    processes=1,
+):
+    """Returns list of rank tables, one per sample in samples, where each
+    one is the same as returned by ranked_neighbours_for_one_sample(). The
+    samples are ranked in batches, using <processes> processes"""
+    samples = list(samples)
+    compiled_compare = pheno_compare.compile(phenos, genos.sample_names_list)
+    batches = [
+        samples[i : i + RANKING_BATCH_SIZE]
+        for i in range(0, len(samples), RANKING_BATCH_SIZE)
+    ]
+    if processes > 1 and len(batches) > 1:
+        with multiprocessing.Pool(
+            processes=processes,
+            initializer=_init_ranking_worker,
+            initargs=(genos, compiled_compare),
+        ) as p:
+            results = p.starmap(
+                _ranked_neighbours_for_batch_in_worker,
+                [(batch, top_n_genos, max_pheno_dist) for batch in batches],
+            )
+    else:
+        results = [
+            _ranked_neighbours_for_batch(
+                genos,
+                compiled_compare,
+                batch,
+                top_n_genos=top_n_genos,
+                max_pheno_dist=max_pheno_dist,
+            )
+            for batch in batches
+        ]
+
+    return [table for batch_tables in results for table in batch_tables]
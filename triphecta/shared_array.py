@@ -0,0 +1,44 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray:
+    """Numpy array stored in a multiprocessing.shared_memory block, so that
+    other processes can use it without making a copy. Pickling only stores
+    the name of the block (plus the shape and dtype), and unpickling attaches
+    to the same block. This means a SharedArray can be sent to pool workers,
+    whatever the multiprocessing start method is. The process that made the
+    array must call unlink() when it is no longer needed"""
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        # Shared memory blocks cannot have size zero
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __reduce__(self):
+        return self.__class__, (self.shape, self.dtype, self.shm.name)
+
+    @classmethod
+    def from_array(cls, array):
+        """Returns a new SharedArray containing a copy of array"""
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def close(self):
+        """Detaches this process from the shared memory. The array must not
+        be used after calling this"""
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        """Closes and frees the shared memory block"""
+        self.close()
+        self.shm.unlink()
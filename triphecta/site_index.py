@@ -0,0 +1,273 @@
+import logging
+
+import numpy as np
+
+from triphecta import utils, vcf
+
+# Changes whenever the format of files made by SiteIndex.save() changes
+FORMAT_VERSION = 1
+
+
+def _strings_to_arrays(strings):
+    """Returns tuple (data, offsets) of numpy arrays, where string i is
+    data[offsets[i]:offsets[i+1]] as UTF-8 bytes. Uses much less memory
+    than a numpy array of strings when a few of the strings are long"""
+    encoded = [x.encode() for x in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def _string_from_arrays(data, offsets, i):
+    return data[offsets[i] : offsets[i + 1]].tobytes().decode()
+
+
+def _masked_sites(chrom_names, chrom_indexes, positions, ref_lengths, bed_file):
+    """Returns boolean array of the sites that overlap a region in the BED
+    file. A site is also masked if it has the same position as a site that
+    overlaps the BED file, which is the same as
+    vcf.vcf_to_variant_positions_to_mask_from_bed_file"""
+    mask = vcf._bed_mask_file_to_dict(bed_file)
+    masked = np.zeros(len(positions), dtype=bool)
+    for chrom_index, chrom in enumerate(chrom_names):
+        if chrom not in mask:
+            continue
+        sites = np.flatnonzero(chrom_indexes == chrom_index)
+        starts = positions[sites]
+        ends = starts + ref_lengths[sites] - 1
+        regions = np.array(mask[chrom], dtype=np.int64)
+        # Regions are sorted by start. A site overlaps a region if, of the
+        # regions starting at or before the end of the site, the one that
+        # ends last ends at or after the start of the site
+        max_region_ends = np.maximum.accumulate(regions[:, 1])
+        before = np.searchsorted(regions[:, 0], ends, side="right")
+        overlaps = np.zeros(len(sites), dtype=bool)
+        has_before = before > 0
+        overlaps[has_before] = (
+            max_region_ends[before[has_before] - 1] >= starts[has_before]
+        )
+        masked[sites] = np.isin(starts, starts[overlaps])
+    return masked
+
+
+class SiteIndex:
+    """The CHROM, POS, REF and ALT of each record of a VCF file, stored
+    column-wise, and optionally which records are masked. All the VCF files
+    are expected to have the same records in the same order, so this only
+    needs to be made once, from any one of the VCF files. Positions are
+    0-based, like vcf.Variant"""
+
+    def __init__(
+        self,
+        chrom_names,
+        chrom_indexes,
+        positions,
+        ref_data,
+        ref_offsets,
+        alt_data,
+        alt_offsets,
+        masked=None,
+    ):
+        if not (
+            len(chrom_indexes)
+            == len(positions)
+            == len(ref_offsets) - 1
+            == len(alt_offsets) - 1
+        ):
+            raise RuntimeError(
+                f"Mismatch in site index lengths: {len(chrom_indexes)}, {len(positions)}, {len(ref_offsets) - 1}, {len(alt_offsets) - 1}"
+            )
+        if masked is not None and len(masked) != len(positions):
+            raise RuntimeError(
+                f"Mismatch in site index lengths: {len(positions)} sites but {len(masked)} mask values"
+            )
+        self.chrom_names = list(chrom_names)
+        self.chrom_to_index = {x: i for i, x in enumerate(self.chrom_names)}
+        self.chrom_indexes = chrom_indexes
+        self.positions = positions
+        self.ref_data = ref_data
+        self.ref_offsets = ref_offsets
+        self.alt_data = alt_data
+        self.alt_offsets = alt_offsets
+        self.masked = masked
+
+    def __eq__(self, other):
+        return (
+            type(other) is type(self)
+            and self.chrom_names == other.chrom_names
+            and np.array_equal(self.chrom_indexes, other.chrom_indexes)
+            and np.array_equal(self.positions, other.positions)
+            and np.array_equal(self.ref_data, other.ref_data)
+            and np.array_equal(self.ref_offsets, other.ref_offsets)
+            and np.array_equal(self.alt_data, other.alt_data)
+            and np.array_equal(self.alt_offsets, other.alt_offsets)
+            and (self.masked is None) == (other.masked is None)
+            and (self.masked is None or np.array_equal(self.masked, other.masked))
+        )
+
+    def __len__(self):
+        return len(self.positions)
+
+    def variant(self, i):
+        return vcf.Variant(
+            CHROM=self.chrom_names[self.chrom_indexes[i]],
+            POS=int(self.positions[i]),
+            REF=_string_from_arrays(self.ref_data, self.ref_offsets, i),
+            ALTS=_string_from_arrays(self.alt_data, self.alt_offsets, i).split(","),
+        )
+
+    def variants(self):
+        """Returns list of vcf.Variant, one per site"""
+        return [self.variant(i) for i in range(len(self))]
+
+    def alt_counts(self):
+        """Returns array of the number of ALT alleles of each site"""
+        commas = np.zeros(len(self.alt_data) + 1, dtype=np.int64)
+        np.cumsum(self.alt_data == ord(","), out=commas[1:])
+        return commas[self.alt_offsets[1:]] - commas[self.alt_offsets[:-1]] + 1
+
+    def records_to_mask(self):
+        """Returns the masked positions in the same format as
+        vcf.vcf_to_variant_positions_to_mask_from_bed_file, or None if there
+        is no mask"""
+        if self.masked is None:
+            return None
+        to_mask = {}
+        for i in np.flatnonzero(self.masked):
+            chrom = self.chrom_names[self.chrom_indexes[i]]
+            if chrom not in to_mask:
+                to_mask[chrom] = set()
+            to_mask[chrom].add(int(self.positions[i]))
+        return to_mask
+
+    def check_positions(self, chroms, positions, vcf_file):
+        """Checks that the lists of chromosome names and 0-based positions
+        of the records of vcf_file are the same as the sites"""
+        if len(positions) != len(self):
+            raise RuntimeError(
+                f"Expected {len(self)} records in VCF file {vcf_file} but got {len(positions)}. Cannot continue"
+            )
+        try:
+            chrom_indexes = np.array([self.chrom_to_index[x] for x in chroms])
+        except KeyError as e:
+            raise RuntimeError(
+                f"Unexpected CHROM {e} in VCF file {vcf_file}. Cannot continue"
+            )
+        mismatches = np.flatnonzero(
+            (chrom_indexes != self.chrom_indexes)
+            | (np.array(positions, dtype=np.int64) != self.positions)
+        )
+        if len(mismatches) > 0:
+            i = mismatches[0]
+            raise RuntimeError(
+                f"Mismatch in variant calls. Expected to get {self.variant(i)} but got CHROM={chroms[i]} POS={positions[i]} in file {vcf_file}. Cannot continue"
+            )
+
+    @classmethod
+    def from_variants(cls, variants, mask_bed_file=None):
+        """Makes a new SiteIndex from a list of vcf.Variant. If mask_bed_file
+        is given, the sites that overlap its regions are masked"""
+        chrom_names = list(dict.fromkeys(x.CHROM for x in variants))
+        chrom_to_index = {x: i for i, x in enumerate(chrom_names)}
+        chrom_indexes = np.array(
+            [chrom_to_index[x.CHROM] for x in variants], dtype=np.uint32
+        )
+        positions = np.array([x.POS for x in variants], dtype=np.int64)
+        ref_data, ref_offsets = _strings_to_arrays([x.REF for x in variants])
+        alt_data, alt_offsets = _strings_to_arrays([",".join(x.ALTS) for x in variants])
+        if mask_bed_file is None:
+            masked = None
+        else:
+            masked = _masked_sites(
+                chrom_names,
+                chrom_indexes,
+                positions,
+                np.diff(ref_offsets),
+                mask_bed_file,
+            )
+        return cls(
+            chrom_names,
+            chrom_indexes,
+            positions,
+            ref_data,
+            ref_offsets,
+            alt_data,
+            alt_offsets,
+            masked=masked,
+        )
+
+    @classmethod
+    def from_vcf_file(cls, vcf_file, mask_bed_file=None):
+        """Makes a new SiteIndex from the records of vcf_file. If
+        mask_bed_file is given, the sites that overlap its regions are
+        masked"""
+        variants = []
+        with utils.open_file(vcf_file) as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                try:
+                    fields = line.rstrip("\r\n").split("\t", maxsplit=5)
+                    chrom, pos, _, ref, alt = fields[:5]
+                    variants.append(
+                        vcf.Variant(
+                            CHROM=chrom, POS=int(pos) - 1, REF=ref, ALTS=alt.split(",")
+                        )
+                    )
+                except:
+                    raise RuntimeError(
+                        f"Error parsing the following line of VCF file {vcf_file}:\n{line}"
+                    )
+        return cls.from_variants(variants, mask_bed_file=mask_bed_file)
+
+    def save(self, outfile):
+        arrays = {
+            "format_version": np.array(FORMAT_VERSION),
+            "chrom_names": np.array(self.chrom_names, dtype=str),
+            "chrom_indexes": self.chrom_indexes,
+            "positions": self.positions,
+            "ref_data": self.ref_data,
+            "ref_offsets": self.ref_offsets,
+            "alt_data": self.alt_data,
+            "alt_offsets": self.alt_offsets,
+        }
+        if self.masked is not None:
+            arrays["masked"] = np.packbits(self.masked, bitorder="little")
+        with open(outfile, "wb") as f:
+            np.savez(f, **arrays)
+        logging.info(f"Saved site index of {len(self)} sites to file {outfile}")
+
+
+def load(infile):
+    """Loads a file made by SiteIndex.save()"""
+    try:
+        data = np.load(infile)
+    except:
+        raise RuntimeError(f"Error reading site index file {infile}. Cannot continue")
+
+    with data:
+        if (
+            "format_version" not in data
+            or int(data["format_version"]) != FORMAT_VERSION
+        ):
+            raise RuntimeError(
+                f"Not a site index file, or made by a different version of triphecta: {infile}. Cannot continue"
+            )
+        positions = data["positions"]
+        if "masked" in data:
+            masked = np.unpackbits(
+                data["masked"], count=len(positions), bitorder="little"
+            ).astype(bool)
+        else:
+            masked = None
+        return SiteIndex(
+            data["chrom_names"].tolist(),
+            data["chrom_indexes"],
+            positions,
+            data["ref_data"],
+            data["ref_offsets"],
+            data["alt_data"],
+            data["alt_offsets"],
+            masked=masked,
+        )
@@ -1,7 +1,13 @@
 import logging
 
+import numpy as np
+
 from triphecta import utils, vcf
 
+# variants_of_interest_bitmap() uses chunks of sites, with this many
+# (sites x triples) elements in each chunk
+BITMAP_CHUNK_ELEMENTS = 2**24
+
 
 class StrainTriple:
     def __init__(self, case, control1, control2):
@@ -13,7 +19,27 @@ class StrainTriple:
         self.variant_indexes_of_interest = set()
 
     def __eq__(self, other):
-        return type(other) is type(self) and self.__dict__ == other.__dict__
+        if type(other) is not type(self):
+            return False
+        # variant_calls has numpy arrays, which cannot be compared with ==
+        this_attributes = {
+            k: v for k, v in self.__dict__.items() if k != "variant_calls"
+        }
+        other_attributes = {
+            k: v for k, v in other.__dict__.items() if k != "variant_calls"
+        }
+        if this_attributes != other_attributes:
+            return False
+        if self.variant_calls.keys() != other.variant_calls.keys():
+            return False
+        for key, calls in self.variant_calls.items():
+            other_calls = other.variant_calls[key]
+            if calls is None or other_calls is None:
+                if calls is not other_calls:
+                    return False
+            elif not np.array_equal(calls, other_calls):
+                return False
+        return True
 
     def set_variants(self, variants):
         self.variants = variants
@@ -35,33 +61,38 @@ class StrainTriple:
             control2_vcf, expected_variants=self.variants
         )
 
+    def set_variant_calls(self, case_calls, control1_calls, control2_calls):
+        self.variant_calls = {
+            "case": case_calls,
+            "control1": control1_calls,
+            "control2": control2_calls,
+        }
+
     def clear_variant_calls(self):
         self.variant_calls = {"case": None, "control1": None, "control2": None}
 
     @classmethod
     def genotypes_are_of_interest(cls, case, control1, control2):
+        """Arguments are genotype bitmasks (see vcf.alleles_to_bitmask), either
+        single values or numpy arrays. Returns True where all three calls are
+        not null, the controls share an allele, and the case does not share
+        an allele with either control"""
         return (
-            case is not None
-            and control1 is not None
-            and control2 is not None
-            and len(control1.intersection(control2)) > 0
-            and (
-                len(case.intersection(control1))
-                == 0
-                == len(case.intersection(control2))
-            )
+            (case != vcf.NULL_GENOTYPE)
+            & (control1 != vcf.NULL_GENOTYPE)
+            & (control2 != vcf.NULL_GENOTYPE)
+            & ((control1 & control2) != 0)
+            & ((case & control1) == 0)
+            & ((case & control2) == 0)
         )
 
     def update_variants_of_interest(self):
-        self.variant_indexes_of_interest = set()
-
-        for i, variant in enumerate(self.variants):
-            if StrainTriple.genotypes_are_of_interest(
-                self.variant_calls["case"][i],
-                self.variant_calls["control1"][i],
-                self.variant_calls["control2"][i],
-            ):
-                self.variant_indexes_of_interest.add(i)
+        of_interest = StrainTriple.genotypes_are_of_interest(
+            self.variant_calls["case"],
+            self.variant_calls["control1"],
+            self.variant_calls["control2"],
+        )
+        self.variant_indexes_of_interest = set(np.flatnonzero(of_interest).tolist())
 
     @classmethod
     def genotype_to_string(cls, geno):
@@ -88,31 +119,82 @@ class StrainTriple:
                 sep="\t",
                 file=f,
             )
-            for i, variant in enumerate(self.variants):
-                if i in self.variant_indexes_of_interest:
-                    if (
-                        vcf_records_to_mask is not None
-                        and variant.CHROM in vcf_records_to_mask
-                        and variant.POS in vcf_records_to_mask[variant.CHROM]
-                    ):
-                        in_mask = 1
-                    else:
-                        in_mask = 0
-
-                    print(
-                        i + 1,
-                        in_mask,
-                        variant.CHROM,
-                        variant.POS + 1,
-                        variant.REF,
-                        ",".join(variant.ALTS),
-                        StrainTriple.genotype_to_string(self.variant_calls["case"][i]),
-                        StrainTriple.genotype_to_string(
-                            self.variant_calls["control1"][i]
-                        ),
+            for i in sorted(self.variant_indexes_of_interest):
+                variant = self.variants[i]
+                if (
+                    vcf_records_to_mask is not None
+                    and variant.CHROM in vcf_records_to_mask
+                    and variant.POS in vcf_records_to_mask[variant.CHROM]
+                ):
+                    in_mask = 1
+                else:
+                    in_mask = 0
+
+                print(
+                    i + 1,
+                    in_mask,
+                    variant.CHROM,
+                    variant.POS + 1,
+                    variant.REF,
+                    ",".join(variant.ALTS),
+                    *[
                         StrainTriple.genotype_to_string(
-                            self.variant_calls["control2"][i]
-                        ),
-                        sep="\t",
-                        file=f,
-                    )
+                            vcf.bitmask_to_alleles(self.variant_calls[x][i])
+                        )
+                        for x in ("case", "control1", "control2")
+                    ],
+                    sep="\t",
+                    file=f,
+                )
+
+
+def variants_of_interest_bitmap(genotypes, triples):
+    """genotypes = numpy array of genotype bitmasks (samples x sites).
+    triples = array of (case, control1, control2) sample indexes, one row
+    per triple. Returns bit-packed array (sites x ceil(triples / 8)) of
+    uint8, where bit t of row i (little-endian bit order within each byte)
+    is set if site i is of interest for triple t (see
+    StrainTriple.genotypes_are_of_interest)"""
+    triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+    site_count = genotypes.shape[1]
+    bitmap = np.zeros((site_count, (len(triples) + 7) // 8), dtype=np.uint8)
+    chunk_size = max(1, BITMAP_CHUNK_ELEMENTS // max(1, len(triples)))
+    for start in range(0, site_count, chunk_size):
+        chunk = genotypes[:, start : start + chunk_size]
+        of_interest = StrainTriple.genotypes_are_of_interest(
+            chunk[triples[:, 0]], chunk[triples[:, 1]], chunk[triples[:, 2]]
+        )
+        bitmap[start : start + chunk_size] = np.packbits(
+            of_interest.T, axis=1, bitorder="little"
+        )
+    return bitmap
+
+
+def bitmap_triple_sites(bitmap, triple_index):
+    """Returns array of the indexes of the sites that are of interest for
+    one triple, from a bitmap made by variants_of_interest_bitmap()"""
+    byte, bit = divmod(triple_index, 8)
+    return np.flatnonzero((bitmap[:, byte] >> bit) & 1)
+
+
+def bitmap_from_triples(triples, site_count):
+    """Returns a bitmap in the same format as variants_of_interest_bitmap(),
+    using the variant_indexes_of_interest of each StrainTriple in triples"""
+    bitmap = np.zeros((site_count, (len(triples) + 7) // 8), dtype=np.uint8)
+    for i, triple in enumerate(triples):
+        indexes = np.array(sorted(triple.variant_indexes_of_interest), dtype=np.int64)
+        bitmap[indexes, i // 8] |= np.uint8(1 << (i % 8))
+    return bitmap
+
+
+def bitmap_site_counts(bitmap):
+    """Returns array of the number of triples that each site is of interest
+    for, from a bitmap made by variants_of_interest_bitmap()"""
+    counts = np.zeros(bitmap.shape[0], dtype=np.int64)
+    chunk_size = max(1, BITMAP_CHUNK_ELEMENTS // max(1, bitmap.shape[1]))
+    for start in range(0, bitmap.shape[0], chunk_size):
+        chunk = bitmap[start : start + chunk_size]
+        counts[start : start + chunk_size] = utils.popcount(chunk).sum(
+            axis=1, dtype=np.int64
+        )
+    return counts
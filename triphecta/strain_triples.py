@@ -3,23 +3,81 @@ import logging
 import multiprocessing
 import os
 
-from triphecta import sample_neighbours_finding, strain_triple, utils, vcf
+import numpy as np
 
+from triphecta import (
+    sample_neighbours_finding,
+    site_index,
+    strain_triple,
+    utils,
+    vcf,
+)
+
+VARIANTS_OUTPUT_FORMATS = ["wide", "sparse"]
 
 global expect_variants
 global vcf_records_to_mask
+global triples_sites
+global triples_genotypes
+global triples_sample_indexes
+global triples_bitmap
+
 
-def _process_one_triple(
-    triple, triple_index, vcf_files, root_out
+def _init_triples_worker(
+    variants,
+    records_to_mask,
+    sites=None,
+    genotypes=None,
+    sample_indexes=None,
+    bitmap=None,
 ):
+    """Initializer for the pools of workers in run_analysis. sites is the
+    site_index.SiteIndex that the VCF files are checked against. genotypes is
+    the matrix of genotype bitmasks (samples x sites) of the samples in
+    the triples, where sample_indexes is a dictionary of sample name ->
+    row index. bitmap is made by strain_triple.variants_of_interest_bitmap"""
+    global expect_variants
+    global vcf_records_to_mask
+    global triples_sites
+    global triples_genotypes
+    global triples_sample_indexes
+    global triples_bitmap
+    expect_variants = variants
+    vcf_records_to_mask = records_to_mask
+    triples_sites = sites
+    triples_genotypes = genotypes
+    triples_sample_indexes = sample_indexes
+    triples_bitmap = bitmap
+
+
+def _load_variant_calls(vcf_file):
+    global triples_sites
+    logging.info(f"Loading VCF file {vcf_file}")
+    return vcf.load_variant_calls_from_vcf_file_using_site_index(
+        vcf_file, triples_sites
+    )
+
+
+def _process_one_triple(triple, triple_index, root_out):
     global expect_variants
     global vcf_records_to_mask
+    global triples_genotypes
+    global triples_sample_indexes
+    global triples_bitmap
     logging.info(f"Processing triple {triple_index+1}")
     triple.set_variants(expect_variants)
-    triple.load_variants_from_vcf_files(*vcf_files)
-    triple.update_variants_of_interest()
+    triple.set_variant_calls(
+        triples_genotypes[triples_sample_indexes[triple.case]],
+        triples_genotypes[triples_sample_indexes[triple.control1.sample]],
+        triples_genotypes[triples_sample_indexes[triple.control2.sample]],
+    )
+    triple.variant_indexes_of_interest = set(
+        strain_triple.bitmap_triple_sites(triples_bitmap, triple_index).tolist()
+    )
     outfile = os.path.join(root_out, f"{triple_index+1}.tsv")
-    triple.write_variants_of_interest_file(outfile, vcf_records_to_mask=vcf_records_to_mask)
+    triple.write_variants_of_interest_file(
+        outfile, vcf_records_to_mask=vcf_records_to_mask
+    )
     triple.clear_variant_calls()
     logging.info(f"Finished triple {triple_index+1}")
     return triple
@@ -52,21 +110,25 @@ class StrainTriples:
         # as resistant to drug X), and "control" to mean does not have the phenotype
         # (such as sensitive to drug X).
         triples_list = []
+        cases = []
         for sample_name in case_sample_names:
             if sample_name in self.genos.excluded_samples:
                 logging.info(f"Case '{sample_name}' excluded. Skipping")
-                continue
+            else:
+                cases.append(sample_name)
 
-            logging.info(f"Looking for control samples for case sample '{sample_name}'")
-            neighbours = sample_neighbours_finding.ranked_neighbours_for_one_sample(
-                self.genos,
-                self.phenos,
-                self.pheno_compare,
-                sample_name,
-                top_n_genos=self.top_n_genos,
-                max_pheno_dist=self.max_pheno_diffs,
-            )
+        logging.info(f"Looking for control samples for {len(cases)} case samples")
+        all_neighbours = sample_neighbours_finding.ranked_neighbours_for_samples(
+            self.genos,
+            self.phenos,
+            self.pheno_compare,
+            cases,
+            top_n_genos=self.top_n_genos,
+            max_pheno_dist=self.max_pheno_diffs,
+            processes=self.processes,
+        )
 
+        for sample_name, neighbours in zip(cases, all_neighbours):
             if len(neighbours) < 2:
                 logging.info(
                     f"Not enough ({len(neighbours)}) controls found for case sample '{sample_name}'"
@@ -103,6 +165,7 @@ class StrainTriples:
                 file=f,
             )
             for i, triple in enumerate(triples):
+                samples = [triple.case, triple.control1.sample, triple.control2.sample]
                 print(
                     i + 1,
                     triple.case,
@@ -112,16 +175,37 @@ class StrainTriples:
                     triple.control2.sample,
                     triple.control2.geno_dist,
                     triple.control2.pheno_dist,
-                    *[
-                        f"{phenos[triple.case][x]}\t{phenos[triple.control1.sample][x]}\t{phenos[triple.control2.sample][x]}"
-                        for x in pheno_names
-                    ],
+                    *[phenos.value(s, x) for x in pheno_names for s in samples],
                     sep="\t",
                     file=f,
                 )
 
     @classmethod
-    def _write_variants_summary_file(cls, triples, outfile, vcf_records_to_mask=None):
+    def _write_variants_summary_file(
+        cls,
+        triples,
+        outfile,
+        vcf_records_to_mask=None,
+        bitmap=None,
+        variant_indexes=None,
+        per_triple_columns=True,
+    ):
+        """bitmap is made by strain_triple.variants_of_interest_bitmap. If
+        not given, it is made from the variant_indexes_of_interest of the
+        triples. Only writes the variants in variant_indexes, or all
+        variants if it is None. If per_triple_columns is False, the column
+        for each triple is not written"""
+        variants = triples[0].variants
+        if bitmap is None:
+            bitmap = strain_triple.bitmap_from_triples(triples, len(variants))
+        if variant_indexes is None:
+            variant_indexes = range(len(variants))
+        triple_counts = strain_triple.bitmap_site_counts(bitmap)
+        if per_triple_columns:
+            triple_columns = [f"Triple.{i+1}" for i in range(len(triples))]
+        else:
+            triple_columns = []
+
         with utils.open_file(outfile, "w") as f:
             print(
                 "variant_id",
@@ -131,12 +215,13 @@ class StrainTriples:
                 "ref",
                 "alt",
                 "freq",
-                *[f"Triple.{i+1}" for i in range(len(triples))],
+                *triple_columns,
                 sep="\t",
                 file=f,
             )
 
-            for variant_index, variant in enumerate(triples[0].variants):
+            for variant_index in variant_indexes:
+                variant = variants[variant_index]
                 if (
                     vcf_records_to_mask is not None
                     and variant.CHROM in vcf_records_to_mask
@@ -145,11 +230,14 @@ class StrainTriples:
                     in_mask = 1
                 else:
                     in_mask = 0
-                in_triples = [
-                    (1 if variant_index in t.variant_indexes_of_interest else 0)
-                    for t in triples
-                ]
-                freq = round(sum(in_triples) / len(in_triples), 4)
+                if per_triple_columns:
+                    in_triples = np.unpackbits(
+                        bitmap[variant_index], count=len(triples), bitorder="little"
+                    )
+                    in_triples = ["\t".join(map(str, in_triples.tolist()))]
+                else:
+                    in_triples = []
+                freq = round(int(triple_counts[variant_index]) / len(triples), 4)
                 print(
                     variant_index + 1,
                     in_mask,
@@ -163,7 +251,85 @@ class StrainTriples:
                     file=f,
                 )
 
-    def run_analysis(self, case_sample_names, outprefix, mask_file=None):
+    @classmethod
+    def _write_variant_triples_file(
+        cls,
+        bitmap,
+        triple_count,
+        outfile,
+        variant_indexes,
+        gzip_level=None,
+        gzip_threads=None,
+    ):
+        """Writes sparse long-format file of the bitmap made by
+        strain_triple.variants_of_interest_bitmap, with one line
+        (variant_id, triple_id) for each triple that each variant is of
+        interest in. Only writes the variants in variant_indexes"""
+        chunk_size = max(1, strain_triple.BITMAP_CHUNK_ELEMENTS // max(1, triple_count))
+        with utils.open_file(
+            outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+        ) as f:
+            print("variant_id", "triple_id", sep="\t", file=f)
+            for start in range(0, len(variant_indexes), chunk_size):
+                indexes = variant_indexes[start : start + chunk_size]
+                in_triples = np.unpackbits(
+                    bitmap[indexes], axis=1, count=triple_count, bitorder="little"
+                )
+                rows, cols = np.nonzero(in_triples)
+                if len(rows) > 0:
+                    np.savetxt(
+                        f,
+                        np.column_stack((indexes[rows] + 1, cols + 1)),
+                        fmt="%d",
+                        delimiter="\t",
+                    )
+
+    @classmethod
+    def _write_variants_bitmap_file(
+        cls, bitmap, triple_count, outfile, variant_indexes
+    ):
+        """Writes compressed npz file of the rows in variant_indexes of the
+        bitmap made by strain_triple.variants_of_interest_bitmap. Load it
+        with load_variants_bitmap_file()"""
+        with open(outfile, "wb") as f:
+            np.savez_compressed(
+                f,
+                variant_ids=variant_indexes + 1,
+                bitmap=bitmap[variant_indexes],
+                triple_count=np.array(triple_count),
+            )
+
+    def run_analysis(
+        self,
+        case_sample_names,
+        outprefix,
+        mask_file=None,
+        variants_format="wide",
+        skip_zero_freq=False,
+        site_index_file=None,
+        gzip_level=None,
+        gzip_threads=None,
+    ):
+        """Finds the strain triples and writes the output files. If
+        variants_format is "wide", the variants file has one column per
+        triple. If it is "sparse", the variants file only has the frequency
+        of each variant, and which triples each variant is of interest in
+        is written to a sparse (variant_id, triple_id) file and to an npz
+        file of the bit-packed variants x triples matrix. If skip_zero_freq
+        is True, variants that are not of interest in any triple are not
+        written. If site_index_file is given, the variants and mask are
+        taken from that file (see site_index.SiteIndex), and mask_file must
+        be None. gzip_level and gzip_threads are used for the gzipped output
+        files"""
+        if variants_format not in VARIANTS_OUTPUT_FORMATS:
+            raise RuntimeError(
+                f"Unknown variants output format '{variants_format}'. Must be one of: {','.join(VARIANTS_OUTPUT_FORMATS)}. Cannot continue"
+            )
+        if mask_file is not None and site_index_file is not None:
+            raise RuntimeError(
+                "Cannot use a mask file and a site index file together. Make the site index using the mask file instead. Cannot continue"
+            )
+
         global vcf_records_to_mask
         global expect_variants
         triples_list = self.find_strain_triples(case_sample_names)
@@ -171,30 +337,85 @@ class StrainTriples:
             logging.info("No strain triples found. Stopping")
             return
 
-        # The VCFs are expected to have the same positions. Use the first
-        # VCF to load the variants and get the mask positions
-        vcf_file = self.genos.vcf_files[triples_list[0].case]
-        logging.info(f"Load variant positions from first VCF file {vcf_file}")
-        _, expect_variants = vcf.load_variant_calls_from_vcf_file(vcf_file)
-        if mask_file is None:
-            vcf_records_to_mask = None
+        samples = set()
+        for t in triples_list:
+            samples.update([t.case, t.control1.sample, t.control2.sample])
+        samples = sorted(samples)
+        calls = []
+
+        # The VCFs are expected to have the same positions. If there is no
+        # site index, make one from the first VCF, keeping its calls so that
+        # it is only read once
+        if site_index_file is None:
+            first_sample = triples_list[0].case
+            vcf_file = self.genos.vcf_files[first_sample]
+            logging.info(f"Load variant positions from first VCF file {vcf_file}")
+            first_calls, variants = vcf.load_variant_calls_from_vcf_file(vcf_file)
+            if mask_file is not None:
+                logging.info(f"Loading mask from file {mask_file}")
+            sites = site_index.SiteIndex.from_variants(
+                variants, mask_bed_file=mask_file
+            )
+            samples.remove(first_sample)
+            samples.insert(0, first_sample)
+            calls.append(first_calls)
+            del first_calls
         else:
-            logging.info(f"Loading mask from file {mask_file}")
-            vcf_records_to_mask = vcf.vcf_to_variant_positions_to_mask_from_bed_file(
-                vcf_file, mask_file
+            logging.info(f"Loading site index file {site_index_file}")
+            sites = site_index.load(site_index_file)
+            variants = sites.variants()
+        expect_variants = variants
+        vcf_records_to_mask = sites.records_to_mask()
+
+        # Samples can be in many triples. Load each sample's VCF file once,
+        # instead of once per triple
+        to_load = samples[len(calls) :]
+        logging.info(f"Loading VCF files of {len(to_load)} samples in triples")
+        with multiprocessing.Pool(
+            processes=self.processes,
+            initializer=_init_triples_worker,
+            initargs=(expect_variants, vcf_records_to_mask, sites),
+        ) as pool:
+            calls.extend(
+                pool.map(
+                    _load_variant_calls, [self.genos.vcf_files[s] for s in to_load]
+                )
             )
+        sample_indexes = {s: i for i, s in enumerate(samples)}
+        genotypes = np.stack(calls)
+        del calls
+
+        logging.info(f"Finding variants of interest in {len(triples_list)} triples")
+        triple_indexes = [
+            [
+                sample_indexes[t.case],
+                sample_indexes[t.control1.sample],
+                sample_indexes[t.control2.sample],
+            ]
+            for t in triples_list
+        ]
+        bitmap = strain_triple.variants_of_interest_bitmap(genotypes, triple_indexes)
 
         file_per_triple_dir = outprefix + ".triples"
         os.mkdir(file_per_triple_dir)
-        vcf_files = [(self.genos.vcf_files[t.case], self.genos.vcf_files[t.control1.sample], self.genos.vcf_files[t.control2.sample]) for t in triples_list]
 
-        with multiprocessing.Pool(processes=self.processes) as pool:
+        with multiprocessing.Pool(
+            processes=self.processes,
+            initializer=_init_triples_worker,
+            initargs=(
+                expect_variants,
+                vcf_records_to_mask,
+                sites,
+                genotypes,
+                sample_indexes,
+                bitmap,
+            ),
+        ) as pool:
             self.triples = pool.starmap(
                 _process_one_triple,
                 zip(
                     triples_list,
                     range(len(triples_list)),
-                    vcf_files,
                     repeat(file_per_triple_dir),
                 ),
             )
@@ -205,14 +426,57 @@ class StrainTriples:
             self.triples, self.phenos, triple_names_file
         )
 
+        if skip_zero_freq:
+            variant_indexes = np.flatnonzero(bitmap.any(axis=1))
+        else:
+            variant_indexes = np.arange(len(expect_variants))
         variants_file = outprefix + ".variants.tsv"
         logging.info(f"Writing file of variants {variants_file}")
         StrainTriples._write_variants_summary_file(
-            self.triples, variants_file, vcf_records_to_mask=vcf_records_to_mask
+            self.triples,
+            variants_file,
+            vcf_records_to_mask=vcf_records_to_mask,
+            bitmap=bitmap,
+            variant_indexes=variant_indexes,
+            per_triple_columns=variants_format == "wide",
         )
-
-        return {
+        files = {
             "triples_names_file": triple_names_file,
             "variants_file": variants_file,
             "triples_dir": file_per_triple_dir,
         }
+
+        if variants_format == "sparse":
+            files["variant_triples_file"] = outprefix + ".variant_triples.tsv.gz"
+            logging.info(
+                f"Writing sparse file of variants in triples {files['variant_triples_file']}"
+            )
+            StrainTriples._write_variant_triples_file(
+                bitmap,
+                len(self.triples),
+                files["variant_triples_file"],
+                variant_indexes,
+                gzip_level=gzip_level,
+                gzip_threads=gzip_threads,
+            )
+            files["variants_bitmap_file"] = outprefix + ".variants_bitmap.npz"
+            logging.info(
+                f"Writing bitmap file of variants in triples {files['variants_bitmap_file']}"
+            )
+            StrainTriples._write_variants_bitmap_file(
+                bitmap,
+                len(self.triples),
+                files["variants_bitmap_file"],
+                variant_indexes,
+            )
+
+        return files
+
+
+def load_variants_bitmap_file(infile):
+    """Loads file made by StrainTriples._write_variants_bitmap_file. Returns
+    tuple: (array of variant ids, bitmap, number of triples). Row i of the
+    bitmap is variant variant_ids[i], and bit t (little-endian bit order
+    within each byte) is set if the variant is of interest in triple t + 1"""
+    with np.load(infile) as data:
+        return data["variant_ids"], data["bitmap"], int(data["triple_count"])
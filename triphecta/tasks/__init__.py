@@ -2,6 +2,7 @@ __all__ = [
     "distance_matrix",
     "find_cases",
     "pheno_constraints_template",
+    "site_index",
     "tree",
     "triples",
     "vcfs_to_names",
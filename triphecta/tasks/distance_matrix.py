@@ -2,21 +2,84 @@ from triphecta import distances, utils
 
 
 def run(options):
-    if options.method == "vcf":
-        numeric_filters = utils.command_line_filter_list_to_dict(
-            options.vcf_numeric_filter
+    if options.top_k is not None and options.query is None:
+        raise RuntimeError("Must use --query when using --top_k. Cannot continue")
+    if options.knn is not None and options.query is not None:
+        raise RuntimeError("Cannot use --knn and --query together. Cannot continue")
+    if options.method != "vcf" and (
+        options.query is not None or options.knn is not None
+    ):
+        raise RuntimeError(
+            f"Can only use --query or --knn when method is 'vcf', not '{options.method}'. Cannot continue"
         )
+
+    if options.method in ["vcf", "add"]:
+        load_options = {
+            "threads": options.threads,
+            "only_use_pass": not options.vcf_ignore_filter_pass,
+            "numeric_filters": utils.command_line_filter_list_to_dict(
+                options.vcf_numeric_filter
+            ),
+            "het_to_hom_key": options.het_to_hom_key,
+            "het_to_hom_min_pc_depth": options.het_to_hom_cutoff,
+            "mask_bed_file": options.mask_bed_file,
+            "site_index_file": options.site_index,
+            "packed_genotypes": options.packed_genotypes,
+            "genotype_cache_dir": options.genotype_cache,
+        }
+    write_options = {
+        "gzip_level": options.gzip_level,
+        "gzip_threads": options.gzip_threads,
+    }
+
+    if options.method == "vcf" and options.query is not None:
+        if options.top_k is None:
+            distances.query_distances_between_vcf_files(
+                options.query,
+                options.filenames_tsv,
+                options.out,
+                **load_options,
+                **write_options,
+            )
+        else:
+            distances.query_neighbours_between_vcf_files(
+                options.query,
+                options.filenames_tsv,
+                options.out,
+                options.top_k,
+                **load_options,
+                **write_options,
+            )
+    elif options.method == "vcf" and options.knn is not None:
+        distances.knn_index_between_vcf_files(
+            options.filenames_tsv,
+            options.out,
+            options.knn,
+            **load_options,
+            **write_options,
+        )
+    elif options.method == "vcf":
         distances.distances_between_vcf_files(
+            options.filenames_tsv, options.out, **load_options, **write_options
+        )
+    elif options.method == "add":
+        if options.existing_prefix is None or options.existing_vcfs_tsv is None:
+            raise RuntimeError(
+                "Must use --existing_prefix and --existing_vcfs_tsv when method is 'add'"
+            )
+        distances.add_samples_to_distances(
+            options.existing_prefix,
+            options.existing_vcfs_tsv,
             options.filenames_tsv,
             options.out,
-            threads=options.threads,
-            only_use_pass=not options.vcf_ignore_filter_pass,
-            numeric_filters=numeric_filters,
-            het_to_hom_key=options.het_to_hom_key,
-            het_to_hom_min_pc_depth=options.het_to_hom_cutoff,
-            mask_bed_file=options.mask_bed_file,
+            **load_options,
+            **write_options,
         )
     else:
         sample_names, dists = distances.distances_from_all_one_sample_distances_files(
-            options.filenames_tsv, options.out, threads=options.threads
+            options.filenames_tsv,
+            options.out,
+            threads=options.threads,
+            binary_outfile=f"{options.out}.bin",
+            **write_options,
         )
@@ -1,16 +1,35 @@
 import json
+import logging
 
 from triphecta import phenotype_compare, phenotypes, utils
 
 
 def run(options):
-    wanted_phenos = utils.command_line_wanted_phenos_to_dict(options.wanted_pheno)
+    if (options.wanted_pheno is None) == (options.wanted_phenos_tsv is None):
+        raise RuntimeError(
+            "Must use exactly one of the options --wanted_pheno or --wanted_phenos_tsv"
+        )
     phenos = phenotypes.Phenotypes(options.phenos_tsv)
     with open(options.pheno_constraints_json) as f:
         pheno_constraints = json.load(f)
     pheno_compare = phenotype_compare.PhenotypeCompare(pheno_constraints)
-    samples = phenos.find_matching_cases(wanted_phenos, pheno_compare)
-    if len(samples) == 0:
-        raise RuntimeError("No matching samples found")
-    with open(options.outfile, "w") as f:
-        print(*samples, sep="\n", file=f)
+
+    if options.wanted_pheno is not None:
+        wanted_phenos = utils.command_line_wanted_phenos_to_dict(options.wanted_pheno)
+        samples = phenos.find_matching_cases(wanted_phenos, pheno_compare)
+        if len(samples) == 0:
+            raise RuntimeError("No matching samples found")
+        with open(options.outfile, "w") as f:
+            print(*samples, sep="\n", file=f)
+        return
+
+    wanted_sets = utils.load_wanted_phenos_tsv(options.wanted_phenos_tsv)
+    for name, wanted_phenos in wanted_sets.items():
+        samples = phenos.find_matching_cases(wanted_phenos, pheno_compare)
+        outfile = f"{options.outfile}.{name}.txt"
+        logging.info(f"Found {len(samples)} matching samples for '{name}'")
+        if len(samples) == 0:
+            logging.warning(f"WARNING: no matching samples found for '{name}'")
+        with open(outfile, "w") as f:
+            for sample in samples:
+                print(sample, file=f)
@@ -3,4 +3,8 @@ from triphecta import phenotypes
 
 def run(options):
     phenos = phenotypes.Phenotypes(options.phenos_tsv)
-    phenos.write_template_constraints_json(options.json_out)
+    phenos.write_template_constraints_json(
+        options.json_out,
+        gzip_level=options.gzip_level,
+        gzip_threads=options.gzip_threads,
+    )
@@ -0,0 +1,8 @@
+from triphecta import site_index
+
+
+def run(options):
+    sites = site_index.SiteIndex.from_vcf_file(
+        options.vcf_file, mask_bed_file=options.mask_bed_file
+    )
+    sites.save(options.outfile)
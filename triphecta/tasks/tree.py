@@ -7,4 +7,6 @@ def run(options):
         options.out,
         options.method,
         force_dendropy=options.dendropy,
+        gzip_level=options.gzip_level,
+        gzip_threads=options.gzip_threads,
     )
@@ -30,5 +30,12 @@ def run(options):
         processes=options.processes,
     )
     triples.run_analysis(
-        case_sample_names, options.out, mask_file=options.mask_bed_file
+        case_sample_names,
+        options.out,
+        mask_file=options.mask_bed_file,
+        site_index_file=options.site_index,
+        variants_format=options.variants_format,
+        skip_zero_freq=options.skip_zero_freq,
+        gzip_level=options.gzip_level,
+        gzip_threads=options.gzip_threads,
     )
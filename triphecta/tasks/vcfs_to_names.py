@@ -3,5 +3,9 @@ from triphecta import vcf
 
 def run(options):
     vcf.sample_names_tsv_from_vcf_file_of_filenames(
-        options.file_of_vcf_filenames, options.out_tsv, threads=options.threads
+        options.file_of_vcf_filenames,
+        options.out_tsv,
+        threads=options.threads,
+        gzip_level=options.gzip_level,
+        gzip_threads=options.gzip_threads,
     )
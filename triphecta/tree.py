@@ -6,7 +6,9 @@ import dendropy
 from triphecta import utils
 
 
-def dendropy_newick_from_dist_matrix(infile, outfile, method):
+def dendropy_newick_from_dist_matrix(
+    infile, outfile, method, gzip_level=None, gzip_threads=None
+):
     logging.info("Calculating tree using dendropy")
     logging.info(f"Loading distance matrix file {infile}")
     with utils.open_file(infile) as f:
@@ -31,7 +33,9 @@ def dendropy_newick_from_dist_matrix(infile, outfile, method):
         )
 
     logging.info(f"Writing tree to file {outfile}")
-    with utils.open_file(outfile, "w") as f:
+    with utils.open_file(
+        outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+    ) as f:
         print(
             tree.as_string("newick", suppress_rooting=True).replace("'", ""),
             end="",
@@ -50,9 +54,13 @@ def quicktree_newick_from_dist_matrix(infile, outfile, method):
     utils.syscall(command)
 
 
-def newick_from_dist_matrix(infile, outfile, method, force_dendropy=False):
+def newick_from_dist_matrix(
+    infile, outfile, method, force_dendropy=False, gzip_level=None, gzip_threads=None
+):
     if force_dendropy or shutil.which("quicktree") is None:
-        dendropy_newick_from_dist_matrix(infile, outfile, method)
+        dendropy_newick_from_dist_matrix(
+            infile, outfile, method, gzip_level=gzip_level, gzip_threads=gzip_threads
+        )
     else:
         quicktree_newick_from_dist_matrix(infile, outfile, method)
 
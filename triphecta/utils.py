@@ -1,24 +1,109 @@
 from contextlib import contextmanager
 import csv
 import gzip
+import io
 import logging
 import os
+import shutil
+import signal
 import subprocess
 import sys
 
+import numpy as np
+
 from triphecta import phenotypes
 
+# Number of bits set in each possible byte. Only used by popcount() when
+# numpy is older than version 2.0, which added np.bitwise_count
+BYTE_POPCOUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
 
 def rm_rf(*paths):
     for path in paths:
         subprocess.check_output(f"rm -rf {path}", shell=True)
 
 
+def popcount(array):
+    """Returns array of the number of bits set in each element of the uint8
+    array"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(array)
+    return BYTE_POPCOUNTS[array]
+
+
+# Commands that are tried in order to decompress gzip files when reading them.
+# The first one found in the PATH is used. If none are found then python's
+# gzip module is used instead, which is much slower
+GZIP_READ_COMMANDS = [["pigz", "-dc"], ["bgzip", "-dc"]]
+READ_BUFFER_SIZE = 1_048_576
+
+# Default compression level and number of threads used when writing gzip
+# files. Functions that write files take gzip_level and gzip_threads
+# arguments, which are set by the global command line options --gzip_level
+# and --gzip_threads. More than one thread needs pigz to be in the PATH,
+# otherwise python's gzip module is used with one thread
+GZIP_WRITE_LEVEL = 6
+GZIP_WRITE_THREADS = 1
+WRITE_BUFFER_SIZE = 1_048_576
+
+
+def _gzip_read_command():
+    for command in GZIP_READ_COMMANDS:
+        if shutil.which(command[0]) is not None:
+            return command
+    return None
+
+
+def _gzip_write_command(level, threads):
+    if threads > 1 and shutil.which("pigz") is not None:
+        return ["pigz", "-c", f"-{level}", "-p", str(threads)]
+    return None
+
+
+def _open_gzip_with_command(filename, mode, command):
+    if "r" in mode:
+        with open(filename, "rb") as f_in:
+            process = subprocess.Popen(
+                command, stdin=f_in, stdout=subprocess.PIPE, bufsize=READ_BUFFER_SIZE
+            )
+        f = process.stdout
+    else:
+        with open(filename, "ab" if "a" in mode else "wb") as f_out:
+            process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=f_out, bufsize=WRITE_BUFFER_SIZE
+            )
+        f = process.stdin
+
+    if "b" in mode:
+        return f, process
+    else:
+        return io.TextIOWrapper(f), process
+
+
 @contextmanager
-def open_file(filename, mode="r"):
+def open_file(filename, mode="r", gzip_level=None, gzip_threads=None):
+    """Opens filename, (de)compressing it if it ends with .gz. gzip_level and
+    gzip_threads are used when writing, and default to GZIP_WRITE_LEVEL and
+    GZIP_WRITE_THREADS"""
+    if gzip_level is None:
+        gzip_level = GZIP_WRITE_LEVEL
+    if gzip_threads is None:
+        gzip_threads = GZIP_WRITE_THREADS
+    process = None
     if filename.endswith(".gz"):
+        if mode in {"r", "rb", "rt"}:
+            command = _gzip_read_command()
+        elif mode in {"w", "wb", "wt", "a", "ab", "at"}:
+            command = _gzip_write_command(gzip_level, gzip_threads)
+        else:
+            command = None
+
         try:
-            f = gzip.open(filename, f"{mode}t", compresslevel=9)
+            if command is None:
+                gzip_mode = mode if "b" in mode else f"{mode}t"
+                f = gzip.open(filename, gzip_mode, compresslevel=gzip_level)
+            else:
+                f, process = _open_gzip_with_command(filename, mode, command)
         except:
             raise OSError(
                 f"Error opening gzip file '{filename}' in mode '{mode}'. Cannot continue"
@@ -33,8 +118,19 @@ def open_file(filename, mode="r"):
                 f"Error opening file '{filename}' in mode '{mode}'. Cannot continue"
             )
 
-    yield f
-    f.close()
+    try:
+        yield f
+    finally:
+        f.close()
+        if process is not None:
+            process.wait()
+
+    # Closing the file before reading all of it kills the decompression
+    # process with SIGPIPE, which is fine
+    if process is not None and process.returncode not in {0, -signal.SIGPIPE}:
+        raise OSError(
+            f"Error running {' '.join(process.args)} on gzip file '{filename}'"
+        )
 
 
 def load_file_of_vcf_filenames(filename, check_vcf_files_exist=True):
@@ -102,6 +198,44 @@ def command_line_wanted_phenos_to_dict(pheno_list):
     return wanted_phenos
 
 
+def load_wanted_phenos_tsv(filename):
+    """Loads a TSV file of sets of wanted phenotypes. Must have a column
+    'name', and one column per phenotype. Each line is one set, where an
+    empty value means that phenotype is not used. Returns dictionary of
+    set name -> dictionary of phenotype -> value"""
+    wanted_sets = {}
+    with open_file(filename) as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        if "name" not in reader.fieldnames:
+            raise RuntimeError(
+                f"Must have a 'name' column in wanted phenotypes file. Not found in file {filename}"
+            )
+        for row in reader:
+            name = row.pop("name")
+            if name in wanted_sets:
+                raise RuntimeError(
+                    f"Duplicated name '{name}' in wanted phenotypes file {filename}. Cannot continue"
+                )
+            wanted_phenos = {}
+            for pheno, value in row.items():
+                if value is None or value.strip() == "":
+                    continue
+                try:
+                    value = phenotypes.Phenotypes.convert_one_variable_string(value)
+                except ValueError:
+                    raise RuntimeError(
+                        f"Error parsing value '{value}' of phenotype '{pheno}' for '{name}' in wanted phenotypes file {filename}. Cannot continue"
+                    )
+                wanted_phenos[pheno] = value
+            if len(wanted_phenos) == 0:
+                raise RuntimeError(
+                    f"No wanted phenotypes for '{name}' in wanted phenotypes file {filename}. Cannot continue"
+                )
+            wanted_sets[name] = wanted_phenos
+
+    return wanted_sets
+
+
 def syscall(command):
     logging.info(f"Run command: {command}")
     completed_process = subprocess.run(
@@ -8,8 +8,12 @@ VariantCounts = collections.namedtuple(
 )
 
 
-def save_variant_count_list_to_tsv(var_list, outfile):
-    with utils.open_file(outfile, "w") as f:
+def save_variant_count_list_to_tsv(
+    var_list, outfile, gzip_level=None, gzip_threads=None
+):
+    with utils.open_file(
+        outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+    ) as f:
         print(*VariantCounts._fields, sep="\t", file=f)
         for v in var_list:
             print(*v, sep="\t", file=f)
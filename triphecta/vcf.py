@@ -5,10 +5,13 @@ import multiprocessing
 
 import numpy as np
 
-from triphecta import utils, variant_counts
+from triphecta import genotype_cache, site_index, utils, variant_counts
 
 Variant = collections.namedtuple("Variant", ["CHROM", "POS", "REF", "ALTS"])
 
+# Genotype bitmask of a null call. See alleles_to_bitmask()
+NULL_GENOTYPE = 0
+
 
 def vcf_line_to_variant_and_gt(line):
     try:
@@ -49,7 +52,44 @@ def vcf_line_to_variant_and_gt(line):
     return gt, variant
 
 
+def alleles_to_bitmask(alleles):
+    """Returns the bitmask of a genotype call, which is a set of allele
+    numbers or None. Bit i is set if allele i is in the call. A null call
+    is NULL_GENOTYPE, which is zero: a call always has at least one allele"""
+    if alleles is None:
+        return NULL_GENOTYPE
+    bitmask = 0
+    for allele in alleles:
+        bitmask |= 1 << allele
+    return bitmask
+
+
+def bitmask_to_alleles(bitmask):
+    """Inverse of alleles_to_bitmask()"""
+    bitmask = int(bitmask)
+    if bitmask == NULL_GENOTYPE:
+        return None
+    return {i for i in range(bitmask.bit_length()) if bitmask >> i & 1}
+
+
+def genotype_bitmasks_to_array(bitmasks):
+    """Returns numpy array of the list of genotype bitmasks. Uses uint16 if
+    all the allele numbers are less than 16, which is nearly always the
+    case, otherwise uint64"""
+    max_bitmask = max(bitmasks, default=0)
+    for dtype in np.uint16, np.uint64:
+        if max_bitmask <= np.iinfo(dtype).max:
+            return np.array(bitmasks, dtype=dtype)
+    raise RuntimeError(
+        f"Allele number too large to store in genotype bitmask. Must be at most 63, but got {max_bitmask.bit_length() - 1}. Cannot continue"
+    )
+
+
 def load_variant_calls_from_vcf_file(infile, expected_variants=None):
+    """Returns tuple (calls, variants). calls is a numpy array of the
+    genotype bitmask (see alleles_to_bitmask) at each record of the VCF file.
+    If expected_variants is given, checks that the VCF records are the same
+    as those variants"""
     with utils.open_file(infile) as f:
         sample_name = None
         calls = []
@@ -64,7 +104,7 @@ def load_variant_calls_from_vcf_file(infile, expected_variants=None):
                 sample_name = line.rstrip().split("\t")[-1]
             elif not line.startswith("#"):
                 gt, variant = vcf_line_to_variant_and_gt(line)
-                calls.append(gt)
+                calls.append(alleles_to_bitmask(gt))
 
                 if checking_variants:
                     if len(calls) - 1 >= len(expected_variants):
@@ -88,7 +128,58 @@ def load_variant_calls_from_vcf_file(infile, expected_variants=None):
                 f"Expected {len(expected_variants)} calls in VCF file {infile} but got {len(calls)}"
             )
 
-    return calls, expected_variants
+    return genotype_bitmasks_to_array(calls), expected_variants
+
+
+def load_variant_calls_from_vcf_file_using_site_index(infile, sites):
+    """Returns numpy array of the genotype bitmask (see alleles_to_bitmask)
+    at each record of the VCF file, which is the same as the calls returned
+    by load_variant_calls_from_vcf_file. sites is a site_index.SiteIndex.
+    Instead of checking every record against the expected variant, this
+    only checks that the CHROM and POS of all the records are the same
+    as the sites"""
+    # Each distinct GT string is only parsed once, and looked up after that
+    gt_lookup = {}
+    chroms = []
+    positions = []
+    calls = []
+
+    with utils.open_file(infile) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip().split("\t")
+            if len(fields) != 10:
+                raise RuntimeError(
+                    f"Wrong number of columns in VCF file at this line:\n{line}"
+                )
+            chroms.append(fields[0])
+            try:
+                positions.append(int(fields[1]) - 1)
+            except:
+                raise RuntimeError(
+                    f"Error parsing the following line of VCF file:\n{line}"
+                )
+
+            if fields[6] != "PASS":
+                calls.append(NULL_GENOTYPE)
+                continue
+            if not fields[8].startswith("GT"):
+                raise RuntimeError(
+                    f"Need GT to be first key in FORMAT column at line:\n{line}"
+                )
+            gt = fields[9].split(":", maxsplit=1)[0]
+            try:
+                calls.append(gt_lookup[gt])
+            except KeyError:
+                if "." in gt:
+                    gt_lookup[gt] = NULL_GENOTYPE
+                else:
+                    gt_lookup[gt] = alleles_to_bitmask({int(x) for x in gt.split("/")})
+                calls.append(gt_lookup[gt])
+
+    sites.check_positions(chroms, positions, infile)
+    return genotype_bitmasks_to_array(calls)
 
 
 def _convert_het_to_hom(genos, info_dict, key, cutoff):
@@ -159,6 +250,19 @@ def vcf_to_variant_positions_to_mask_from_bed_file(vcf_file, bed_file):
     return vcf_records_to_mask
 
 
+def _gt_to_distance_calc_genotype(gt):
+    """Returns tuple (type of call, genotype) for the GT string gt, where the
+    type of call is "null", "het" or "hom". The genotype is None if null,
+    a set of allele strings if het, or the allele number plus one if hom"""
+    genos = set(gt.split("/"))
+    if "." in genos:
+        return "null", None
+    elif len(genos) > 1:
+        return "het", genos
+    else:
+        return "hom", int(genos.pop()) + 1
+
+
 def load_vcf_file_for_distance_calc(
     infile,
     only_use_pass=True,
@@ -173,101 +277,196 @@ def load_vcf_file_for_distance_calc(
     Format of numeric_filters is {"key": (bool, N)}.
     eg "GT_CONF": (True, 10) would require a minimum GT_CONF of 10 to use the
     called genotype. Otherwise the genotype is zero"""
+    # The file is parsed as bytes, only converting the parts of each line
+    # that are needed. The FORMAT column is usually the same on every line,
+    # so the positions of the wanted keys are only worked out when it
+    # changes. Each distinct GT string is only parsed once, and looked up
+    # after that.
     if mask is None:
         mask = {}
+    mask = {k.encode(): v for k, v in mask.items()}
 
     if numeric_filters is None:
         numeric_filters = {}
 
     data = []
     var_counts = {"hom": 0, "het": 0, "null": 0, "het_to_hom": 0}
+    gt_lookup = {}
+    format_str = None
 
-    with utils.open_file(infile) as f:
+    with utils.open_file(infile, "rb") as f:
         for line in f:
-            if line.startswith("#"):
+            if line.startswith(b"#"):
                 continue
-            fields = line.rstrip().split("\t")
+            fields = line.split(b"\t")
 
-            if fields[0] in mask and int(fields[1]) - 1 in mask[fields[0]]:
+            if mask and fields[0] in mask and int(fields[1]) - 1 in mask[fields[0]]:
                 continue
 
-            if only_use_pass and fields[6] != "PASS":
+            if only_use_pass and fields[6] != b"PASS":
                 var_counts["null"] += 1
                 data.append(0)
                 continue
 
             try:
-                info = dict(zip(fields[8].split(":"), fields[9].split(":")))
-                genos = set(info["GT"].split("/"))
+                if fields[8] != format_str:
+                    format_str = fields[8]
+                    format_keys = format_str.decode().split(":")
+                    gt_index = format_keys.index("GT")
+                    filter_indexes = [
+                        (format_keys.index(k), v)
+                        for k, v in numeric_filters.items()
+                        if k in format_keys
+                    ]
+                    if het_to_hom_key in format_keys:
+                        het_to_hom_index = format_keys.index(het_to_hom_key)
+                    else:
+                        het_to_hom_index = None
+                    # Only need to split up to the last wanted value
+                    max_split = 1 + max(
+                        [gt_index, -1 if het_to_hom_index is None else het_to_hom_index]
+                        + [x[0] for x in filter_indexes]
+                    )
+
+                values = fields[9].rstrip().split(b":", max_split)
+                call_type, geno = gt_lookup[values[gt_index]]
+            except KeyError:
+                gt = values[gt_index]
+                gt_lookup[gt] = _gt_to_distance_calc_genotype(gt.decode())
+                call_type, geno = gt_lookup[gt]
             except:
                 raise RuntimeError(
-                    f"Error parsing final two columns of VCF file {infile} at this line:\n{line}"
+                    f"Error parsing final two columns of VCF file {infile} at this line:\n{line.decode()}"
                 )
 
-            fail_filter = False
+            if call_type == "null":
+                data.append(0)
+                var_counts["null"] += 1
+                continue
 
-            for key, filt in numeric_filters.items():
-                if key in info:
-                    val = float(info[key])
+            fail_filter = False
+            for i, filt in filter_indexes:
+                if i < len(values):
+                    val = float(values[i])
                     if (filt[0] and val < filt[1]) or (not filt[0] and val > filt[1]):
                         fail_filter = True
                         break
 
-            if fail_filter or "." in genos:
+            if fail_filter:
                 data.append(0)
                 var_counts["null"] += 1
-            elif len(genos) > 1:
-                hom_allele = _convert_het_to_hom(
-                    genos, info, het_to_hom_key, het_to_hom_min_pc_depth
-                )
+            elif call_type == "hom":
+                var_counts["hom"] += 1
+                data.append(geno)
+            else:
+                if het_to_hom_index is None or het_to_hom_index >= len(values):
+                    hom_allele = None
+                else:
+                    hom_allele = _convert_het_to_hom(
+                        geno,
+                        {het_to_hom_key: values[het_to_hom_index].decode()},
+                        het_to_hom_key,
+                        het_to_hom_min_pc_depth,
+                    )
                 if hom_allele is None:
                     var_counts["het"] += 1
                     data.append(0)
                 else:
                     var_counts["het_to_hom"] += 1
                     data.append(hom_allele + 1)
-            else:
-                var_counts["hom"] += 1
-                data.append(int(genos.pop()) + 1)
 
     logging.debug(f"loaded {infile}")
     var_counts = variant_counts.VariantCounts(**var_counts)
     return np.array(data, dtype=np.uint16), var_counts
 
 
-def load_vcf_files_for_distance_calc(
+def _load_vcf_file_for_distance_calc_using_cache(infile, cache, **kwargs):
+    cached = cache.get(infile)
+    if cached is not None:
+        return cached
+    genos, var_counts = load_vcf_file_for_distance_calc(infile, **kwargs)
+    cache.put(infile, genos, var_counts)
+    return genos, var_counts
+
+
+def make_distance_calc_loader(
     filenames,
-    threads=1,
     only_use_pass=True,
     numeric_filters=None,
     het_to_hom_key="COV",
     het_to_hom_min_pc_depth=90.0,
     mask_bed_file=None,
+    cache_dir=None,
+    site_index_file=None,
 ):
+    """Returns a function that takes a VCF filename and returns the same as
+    load_vcf_file_for_distance_calc, using the given options. The mask is
+    made using the first file in filenames, or is taken from
+    site_index_file (made by site_index.SiteIndex.save) if it is given,
+    which means no VCF file needs to be read to make it. If cache_dir is given, then
+    genotypes are taken from a GenotypeCache in that directory where
+    possible, and any VCF files that are not in the cache are added to it.
+    The function can be pickled, so can be sent to other processes"""
     if numeric_filters is None:
         numeric_filters = {}
 
-    if mask_bed_file is None:
+    if site_index_file is not None:
+        if mask_bed_file is not None:
+            raise RuntimeError(
+                "Cannot use a mask BED file and a site index file together. Make the site index using the mask BED file instead. Cannot continue"
+            )
+        mask = site_index.load(site_index_file).records_to_mask()
+    elif mask_bed_file is None:
         mask = None
     else:
         mask = vcf_to_variant_positions_to_mask_from_bed_file(
             filenames[0], mask_bed_file
         )
 
-    with multiprocessing.Pool(processes=threads) as p:
-        return p.map(
-            functools.partial(
-                load_vcf_file_for_distance_calc,
-                only_use_pass=only_use_pass,
-                numeric_filters=numeric_filters,
-                het_to_hom_key=het_to_hom_key,
-                het_to_hom_min_pc_depth=het_to_hom_min_pc_depth,
-                mask=mask,
-            ),
-            filenames,
+    load_options = {
+        "only_use_pass": only_use_pass,
+        "numeric_filters": numeric_filters,
+        "het_to_hom_key": het_to_hom_key,
+        "het_to_hom_min_pc_depth": het_to_hom_min_pc_depth,
+        "mask": mask,
+    }
+    if cache_dir is None:
+        return functools.partial(load_vcf_file_for_distance_calc, **load_options)
+    else:
+        cache = genotype_cache.GenotypeCache(cache_dir, **load_options)
+        return functools.partial(
+            _load_vcf_file_for_distance_calc_using_cache, cache=cache, **load_options
         )
 
 
+def multiallelic_sites_for_distance_calc(
+    filenames, mask_bed_file=None, site_index_file=None
+):
+    """Returns boolean array with one value per genotype returned by the
+    loader made by make_distance_calc_loader (ie excluding masked records),
+    that is True if the record has more than one ALT allele. Uses the site
+    index file if given, otherwise the first file in filenames"""
+    if site_index_file is None:
+        sites = site_index.SiteIndex.from_vcf_file(
+            filenames[0], mask_bed_file=mask_bed_file
+        )
+    else:
+        sites = site_index.load(site_index_file)
+    multiallelic = sites.alt_counts() > 1
+    if sites.masked is not None:
+        multiallelic = multiallelic[~sites.masked]
+    return multiallelic
+
+
+def load_vcf_files_for_distance_calc(filenames, threads=1, **load_options):
+    """Loads all the VCF files using load_vcf_file_for_distance_calc, with
+    <threads> files in parallel. load_options are passed to
+    make_distance_calc_loader"""
+    load_function = make_distance_calc_loader(filenames, **load_options)
+    with multiprocessing.Pool(processes=threads) as p:
+        return p.map(load_function, filenames)
+
+
 def sample_name_from_vcf(infile):
     """Gets sample name from VCF (in its #CHROM... line).
     Assumes the VCF file only conatins one sample"""
@@ -282,7 +481,9 @@ def sample_name_from_vcf(infile):
     raise RuntimeError(f"#CHROM line not found in file {infile}")
 
 
-def sample_names_tsv_from_vcf_file_of_filenames(infile, outfile, threads=1):
+def sample_names_tsv_from_vcf_file_of_filenames(
+    infile, outfile, threads=1, gzip_level=None, gzip_threads=None
+):
     """Input is a file of VCF file names, one name per line.
     Writes a TSV file with columns sample_name, vcf_file"""
     with utils.open_file(infile) as f:
@@ -296,7 +497,9 @@ def sample_names_tsv_from_vcf_file_of_filenames(infile, outfile, threads=1):
 
     assert len(vcf_files) == len(sample_names)
     logging.debug(f"Writing sample/vcf TSV file {outfile}")
-    with utils.open_file(outfile, "w") as f:
+    with utils.open_file(
+        outfile, "w", gzip_level=gzip_level, gzip_threads=gzip_threads
+    ) as f:
         print("sample", "vcf_file", sep="\t", file=f)
         for sample, vcf_file in zip(sample_names, vcf_files):
             print(sample, vcf_file, sep="\t", file=f)